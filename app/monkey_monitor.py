@@ -167,14 +167,15 @@ class MonkeyMonitor(object):
                     break
                 try:
                     if task[0] == 'image':
-                        img_path = self.parent.get_image()
-                        res_dict = client.upload_media('image', img_path)
+                        jpeg_data = self.parent.get_image()
+                        res_dict = client.upload_media('image', data=jpeg_data,
+                                                       filename='snapshot.jpg',
+                                                       mimetype='image/jpeg')
                         if 'media_id' in res_dict:
                             ret = client.send_media(
                                     'image', {'media_id': res_dict['media_id']}, task[1])
                             if ret['errcode'] != 0:
                                 raise RuntimeError(ret['errmsg'])
-                        os.remove(img_path)
                     else:
                         mp4_path = self.parent.get_video()
                         res_dict = client.upload_media('video', mp4_path)
@@ -205,13 +206,15 @@ class MonkeyMonitor(object):
         self.worker.start()
 
     def get_image(self):
-        file_path = tempfile.mktemp('.jpg')
-        ret_code = subprocess.call(['raspistill', '-t', '1500',
-                                    '-w', '1280', '-h', '920', '-o', file_path])
-        if ret_code != 0:
+        # 照片直接输出到标准输出, 不经过临时文件
+        proc = subprocess.Popen(['raspistill', '-t', '1500',
+                                 '-w', '1280', '-h', '920', '-o', '-'],
+                                stdout=subprocess.PIPE)
+        jpeg_data = proc.communicate()[0]
+        if proc.returncode != 0 or not jpeg_data:
             raise CameraError(u"raspistill命令失败, 可能是由于摄像头被占用")
 
-        return file_path
+        return jpeg_data
 
     def get_video(self):
         file_path = tempfile.mktemp('.h264')
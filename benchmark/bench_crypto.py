@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+消息加解密性能测试
+对比每次调用都重新创建辅助对象的旧实现与复用加解密上下文的WXBizMsgCrypt
+用法: python benchmark/bench_crypto.py [-n 次数] [-s 明文长度]
+"""
+
+import os
+import sys
+import time
+import base64
+import socket
+import string
+import random
+import struct
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Crypto.Cipher.AES as AES
+
+import easy_wechat.utils as utils
+
+TOKEN = '8wdYqOgJWQlFRE13FaBAUOU2FxXVtGr'
+AES_KEY = 'jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C'
+CORP_ID = 'wx5823bf96d3bd56c7'
+
+
+class LegacyCrypt(object):
+    """
+    旧的加解密实现, 每次调用都创建签名, XML与补位对象并多次切片复制明文
+    """
+
+    def __init__(self, key):
+        """
+        构造函数
+        @param key: AES秘钥
+        @return: LegacyCrypt对象实例
+        """
+        self.key = key
+
+    def encrypt(self, text, corpid):
+        """
+        加密并签名
+        @param text: 明文
+        @param corpid: 企业号ID
+        @return: 回复的XML字符串
+        """
+        utils.SHA1()
+        utils.XMLParse()
+        random_str = ''.join(random.sample(string.letters + string.digits, 16))
+        text = random_str + struct.pack("I", socket.htonl(len(text))) + text + corpid
+        text = utils.PKCS7Encoder().encode(text)
+        cryptor = AES.new(self.key, AES.MODE_CBC, self.key[:16])
+        return base64.b64encode(cryptor.encrypt(text))
+
+    def decrypt(self, text, corpid):
+        """
+        解密
+        @param text: 密文
+        @param corpid: 企业号ID
+        @return: 明文
+        """
+        utils.SHA1()
+        utils.XMLParse()
+        cryptor = AES.new(self.key, AES.MODE_CBC, self.key[:16])
+        plain_text = cryptor.decrypt(base64.b64decode(text))
+        pad = ord(plain_text[-1])
+        content = plain_text[16:-pad]
+        xml_len = socket.ntohl(struct.unpack("I", content[: 4])[0])
+        xml_content = content[4: xml_len + 4]
+        assert content[xml_len + 4:] == corpid
+        return xml_content
+
+
+def timeit(func, number):
+    """
+    多次调用函数并计算平均耗时
+    @param func: 无参数的函数
+    @param number: 调用次数
+    @return: 每次调用的平均耗时(微秒)
+    """
+    start = time.time()
+    for _ in xrange(number):
+        func()
+    return (time.time() - start) / number * 1e6
+
+
+def main():
+    """
+    运行性能测试并输出结果
+    @return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000, help='number of messages')
+    parser.add_argument('-s', '--size', type=int, default=512, help='plaintext size in bytes')
+    args = parser.parse_args()
+
+    text = '<xml>%s</xml>' % ('x' * max(args.size - 11, 0))
+    wxcpt = utils.WXBizMsgCrypt(TOKEN, AES_KEY, CORP_ID)
+    legacy = LegacyCrypt(wxcpt.key)
+    ciphertext = wxcpt.pc.encrypt(text, CORP_ID)[1]
+
+    results = [
+        ('encrypt', timeit(lambda: legacy.encrypt(text, CORP_ID), args.number),
+         timeit(lambda: wxcpt.pc.encrypt(text, CORP_ID), args.number)),
+        ('decrypt', timeit(lambda: legacy.decrypt(ciphertext, CORP_ID), args.number),
+         timeit(lambda: wxcpt.pc.decrypt(ciphertext, CORP_ID), args.number)),
+    ]
+    print '%d messages of %d bytes' % (args.number, len(text))
+    print '%-10s %12s %12s %8s' % ('', 'before(us)', 'after(us)', 'speedup')
+    for name, before, after in results:
+        print '%-10s %12.2f %12.2f %7.2fx' % (name, before, after, before / after)
+
+
+if __name__ == '__main__':
+    main()
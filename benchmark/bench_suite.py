@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+热点路径性能测试集
+覆盖消息加解密, URL验证, XML编解码, CDATA包裹以及经过WeChatServer.app的完整加密回调请求,
+结果保存为JSON基线, 与之后的结果对比时标出变慢的用例
+用法: python benchmark/bench_suite.py run [-o 结果文件] [-k 用例名关键字]
+      python benchmark/bench_suite.py compare 基线文件 [结果文件] [-t 阈值]
+"""
+
+import os
+import sys
+import json
+import time
+import urllib
+import fnmatch
+import logging
+import argparse
+import platform
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import easy_wechat
+import easy_wechat.utils as utils
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(os.path.dirname(BENCH_DIR), 'config_test.ini')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+TIMESTAMP = '1450092658'
+NONCE = '2095700682'
+
+# 消息正文长度(字节), 分别对应普通聊天, 较长的文本与接近上限的长消息
+SIZES = (16, 512, 2048)
+
+
+def make_message(msg_type, size=16, corpid='wx82ef843a5129db66'):
+    """
+    构造一条企业号回调消息
+    @param msg_type: 消息类型, text/image/voice/location
+    @param size: 文本消息正文长度
+    @param corpid: 企业号ID
+    @return: 字典对象
+    """
+    message = {
+        'ToUserName': corpid,
+        'FromUserName': 'FinalTheory',
+        'CreateTime': 1450092658,
+        'MsgType': msg_type,
+        'AgentID': 2,
+    }
+    if msg_type == 'text':
+        # 中文字符按UTF-8编码为3字节
+        message['Content'] = u'拍照' * (size // 6) + u'x' * (size % 6)
+        message['MsgId'] = 4370793562735837214
+    elif msg_type == 'image':
+        message['PicUrl'] = 'http://mmbiz.qpic.cn/mmbiz/0/0'
+        message['MediaId'] = 'media_id_' + 'x' * 54
+        message['MsgId'] = 4370793562735837214
+    elif msg_type == 'location':
+        message['Location_X'] = '39.983798'
+        message['Location_Y'] = '116.309395'
+        message['Scale'] = 15
+        message['Label'] = u'北京市海淀区上地十街10号'
+        message['MsgId'] = 4370793562735837214
+    else:
+        message['MediaId'] = 'media_id_' + 'x' * 54
+        message['Format'] = 'amr'
+        message['MsgId'] = 4370793562735837214
+    return message
+
+
+def make_post(wxcpt, xml_string):
+    """
+    加密消息, 构造微信服务器推送的请求数据与URL参数
+    @param wxcpt: WXBizMsgCrypt对象
+    @param xml_string: 消息明文
+    @return: (请求数据, URL参数dict)
+    """
+    encrypt = wxcpt.pc.encrypt(xml_string, wxcpt.m_sCorpid)[1]
+    signature = wxcpt.sha1.getSHA1(wxcpt.m_sToken, TIMESTAMP, NONCE, encrypt)[1]
+    data = ('<xml><ToUserName><![CDATA[%s]]></ToUserName><Encrypt><![CDATA[%s]]></Encrypt>'
+            '<AgentID><![CDATA[2]]></AgentID></xml>' % (wxcpt.m_sCorpid, encrypt))
+    params = {'msg_signature': signature, 'timestamp': TIMESTAMP, 'nonce': NONCE}
+    return data, params
+
+
+def reply_func(param):
+    """
+    回复一条文本消息
+    @param param: 输入参数
+    @return: 返回参数
+    """
+    param['MsgType'] = 'text'
+    param['Content'] = u'请耐心等待拍照'
+    return param
+
+
+def make_cases():
+    """
+    构造所有性能测试用例
+    完整请求经过server.app的Flask视图与handle, 包含耗时统计, 不启用请求采样分析
+    @return: [(用例名, 无参数的函数)]列表
+    """
+    server = easy_wechat.WeChatServer('demo', CONFIG)
+    # 重复的消息会命中回复缓存, 关闭缓存以测试完整的处理流程
+    server.reply_cache = None
+    # 保留日志文件, 去掉输出到终端的日志, 以免终端输出的耗时掩盖处理流程本身
+    for handler in list(server.logger.handlers):
+        if type(handler) is logging.StreamHandler:
+            server.logger.removeHandler(handler)
+    for msg_type in ('text', 'image', 'voice', 'location'):
+        server.register_callback(msg_type, reply_func)
+    client = server.app.test_client()
+    wxcpt = server.wxcpt
+
+    cases = []
+    messages = [('text-%d' % size, make_message('text', size)) for size in SIZES]
+    messages += [(msg_type, make_message(msg_type)) for msg_type in ('image', 'voice', 'location')]
+    for name, message in messages:
+        xml_string = utils.dict_to_xml(message)
+        data, params = make_post(wxcpt, xml_string)
+        encrypt = wxcpt.xml_parse.extract(data)[1]
+        url = '%s?%s' % (server.route, urllib.urlencode(params))
+        cases += [
+            ('crypto.encrypt.%s' % name,
+             lambda xml_string=xml_string: wxcpt.EncryptMsg(xml_string, NONCE, TIMESTAMP)),
+            ('crypto.decrypt.%s' % name,
+             lambda data=data, params=params: wxcpt.DecryptMsg(
+                 data, params['msg_signature'], TIMESTAMP, NONCE)),
+            ('crypto.verify_url.%s' % name,
+             lambda params=params, encrypt=encrypt: wxcpt.VerifyURL(
+                 params['msg_signature'], TIMESTAMP, NONCE, encrypt)),
+            ('xml.parse.%s' % name, lambda xml_string=xml_string: utils.xml_to_dict(xml_string)),
+            ('xml.serialize.%s' % name, lambda message=message: utils.dict_to_xml(dict(message))),
+            ('xml.wrap_cdata.%s' % name, lambda message=message: utils.wrap_cdata(dict(message))),
+            ('server.post.%s' % name, lambda url=url, data=data: client.post(url, data=data)),
+        ]
+    return cases
+
+
+def measure(func, min_time, repeat):
+    """
+    测量函数的单次调用耗时
+    先倍增调用次数直到一轮耗时不少于min_time, 再重复多轮取最快的一轮, 以减少其他进程的干扰
+    @param func: 无参数的函数
+    @param min_time: 每轮的最短耗时(秒)
+    @param repeat: 重复轮数
+    @return: (每次调用的耗时(微秒), 每轮调用次数)
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    for _ in xrange(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return best / number * 1e6, number
+
+
+def matches(name, keyword):
+    """
+    @param name: 用例名
+    @param keyword: 关键字, 支持通配符, 为None时匹配所有用例
+    @return: 用例名是否匹配关键字
+    """
+    return not keyword or fnmatch.fnmatch(name, '*%s*' % keyword)
+
+
+def run(args):
+    """
+    运行性能测试, 输出结果并保存为JSON
+    @param args: 命令行参数
+    @return: 结果dict, 'results'为用例名到单次耗时(微秒)的dict
+    """
+    results = {}
+    for name, func in make_cases():
+        if not matches(name, args.keyword):
+            continue
+        results[name], number = measure(func, args.min_time, args.repeat)
+        print '%-36s %12.2f us %10d loops' % (name, results[name], number)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'unit': 'us',
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+            output_file.write('\n')
+    return report
+
+
+def load(path):
+    """
+    读取JSON结果
+    @param path: 文件路径
+    @return: 用例名到耗时的dict
+    """
+    with open(path) as input_file:
+        return json.load(input_file)['results']
+
+
+def compare(args):
+    """
+    与基线对比, 耗时增加超过阈值的用例记为变慢
+    @param args: 命令行参数
+    @return: 退出码, 有用例变慢时为1
+    """
+    baseline = dict((name, value) for name, value in load(args.baseline).items()
+                    if matches(name, args.keyword))
+    if args.current:
+        current = dict((name, value) for name, value in load(args.current).items()
+                       if matches(name, args.keyword))
+    else:
+        print 'running benchmarks...'
+        current = run(args)['results']
+        print
+    regressions = 0
+    print '%-36s %12s %12s %8s' % ('', 'baseline(us)', 'current(us)', 'change')
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print '%-36s %12s %12s %8s' % (name, '%.2f' % baseline[name] if name in baseline
+                                           else '-', '%.2f' % current[name] if name in current
+                                           else '-', 'missing')
+            continue
+        change = current[name] / baseline[name] - 1
+        flag = ''
+        if change > args.threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        elif change < -args.threshold:
+            flag = '  improved'
+        print '%-36s %12.2f %12.2f %+7.1f%%%s' % (name, baseline[name], current[name],
+                                                   change * 100, flag)
+    if regressions:
+        print '%d benchmark(s) more than %d%% slower than the baseline' % (
+            regressions, args.threshold * 100)
+        return 1
+    return 0
+
+
+def main():
+    """
+    解析命令行参数并运行对应的命令
+    @return: 退出码
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run benchmarks and save the results')
+    run_parser.add_argument('-o', '--output', help='JSON file to save the results to, '
+                            'e.g. %s' % os.path.relpath(DEFAULT_BASELINE))
+    compare_parser = subparsers.add_parser('compare', help='compare the results with a baseline')
+    compare_parser.add_argument('baseline', nargs='?', default=DEFAULT_BASELINE,
+                                help='baseline JSON file')
+    compare_parser.add_argument('current', nargs='?',
+                                help='JSON file to compare, run the benchmarks when omitted')
+    compare_parser.add_argument('-o', '--output', help='JSON file to save the new results to')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                                help='relative slowdown reported as a regression')
+    for sub_parser in (run_parser, compare_parser):
+        sub_parser.add_argument('-k', '--keyword', help='only run benchmarks matching KEYWORD')
+        sub_parser.add_argument('--min-time', type=float, default=0.1,
+                                help='minimum seconds per round')
+        sub_parser.add_argument('-r', '--repeat', type=int, default=5,
+                                help='number of rounds, the fastest one is reported')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+XML消息编解码性能测试
+对比基于xmltodict/dicttoxml的旧实现与utils中的单遍编解码器, 未安装旧依赖时只测试新实现
+用法: python benchmark/bench_xml.py [-n 次数]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import easy_wechat.utils as utils
+
+try:
+    import dicttoxml
+    import xmltodict
+except ImportError:
+    dicttoxml = xmltodict = None
+
+REQUEST_XML = '''<xml>
+<ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>
+<FromUserName><![CDATA[FinalTheory]]></FromUserName>
+<CreateTime>1450093931</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[拍照]]></Content>
+<MsgId>4370793562735837214</MsgId>
+<AgentID>218</AgentID>
+</xml>'''
+
+
+def legacy_dict_to_xml(dict_data):
+    """
+    旧的序列化实现
+    @param dict_data: 字典对象
+    @return: XML字符串
+    """
+    return ('<xml>%s</xml>' % dicttoxml.dicttoxml(utils.wrap_cdata(dict_data), root=False,
+                                                  custom_root='xml', attr_type=False, ids=False)) \
+        .replace('&lt;', '<').replace('&gt;', '>')
+
+
+def legacy_xml_to_dict(xml_string):
+    """
+    旧的解析实现
+    @param xml_string: XML字符串
+    @return: OrderedDict对象
+    """
+    return xmltodict.parse(xml_string)['xml']
+
+
+def make_reply():
+    """
+    构造一个典型的文本回复
+    @return: 字典对象
+    """
+    return {
+        'ToUserName': 'FinalTheory',
+        'FromUserName': 'wx5823bf96d3bd56c7',
+        'CreateTime': int(time.time()),
+        'MsgType': 'text',
+        'Content': u'请耐心等待拍照',
+    }
+
+
+def timeit(func, number):
+    """
+    多次调用函数并计算平均耗时
+    @param func: 无参数的函数
+    @param number: 调用次数
+    @return: 每次调用的平均耗时(微秒)
+    """
+    start = time.time()
+    for _ in xrange(number):
+        func()
+    return (time.time() - start) / number * 1e6
+
+
+def main():
+    """
+    运行性能测试并输出结果
+    @return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000, help='number of messages')
+    args = parser.parse_args()
+
+    cases = [
+        ('parse', lambda: legacy_xml_to_dict(REQUEST_XML), lambda: utils.xml_to_dict(REQUEST_XML)),
+        ('serialize', lambda: legacy_dict_to_xml(make_reply()),
+         lambda: utils.dict_to_xml(make_reply())),
+    ]
+    print '%d messages' % args.number
+    print '%-10s %12s %12s %8s' % ('', 'before(us)', 'after(us)', 'speedup')
+    for name, legacy, current in cases:
+        after = timeit(current, args.number)
+        if dicttoxml is None:
+            print '%-10s %12s %12.2f %8s' % (name, '-', after, '-')
+            continue
+        before = timeit(legacy, args.number)
+        print '%-10s %12.2f %12.2f %7.2fx' % (name, before, after, before / after)
+
+
+if __name__ == '__main__':
+    main()
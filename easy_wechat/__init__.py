@@ -15,3 +15,6 @@ package初始化, 导入类
 
 from easy_wechat.wechat import WeChatServer
 from easy_wechat.wechat import WeChatClient
+from easy_wechat.wechat import AsyncWeChatClient
+from easy_wechat.dispatcher import Dispatcher
+from easy_wechat.message import InboundMessage
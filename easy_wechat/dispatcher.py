@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+后台消息发送模块
+调用方将消息放入队列后立即返回, 由工作线程按照企业号的频率限制与每日配额发送
+"""
+
+import time
+import Queue
+import logging
+import datetime
+import threading
+
+import easy_wechat.utils as utils
+import easy_wechat.wechat as wechat
+
+# 接口调用频率超过限制的错误码
+FREQ_LIMIT_ERRCODES = (45009, 45011)
+
+
+class TokenBucket(object):
+    """
+    令牌桶限流器
+    令牌不足时允许预支, 调用方按照返回的时间等待, 从而平滑地消耗配额
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        构造函数
+        @param rate: 每秒补充的令牌数
+        @param capacity: 令牌桶容量, 即允许的突发数量
+        @return: TokenBucket对象实例
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, count=1):
+        """
+        预支令牌
+        @param count: 令牌数
+        @return: 需要等待的秒数, 为0表示可以立即执行
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, count=1):
+        """
+        获取令牌, 令牌不足时阻塞等待
+        @param count: 令牌数
+        @return: None
+        """
+        wait = self.reserve(count)
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        清空令牌桶, 使之后的调用方至少等待指定时间
+        用于服务器提示频率超限之后的退避
+        @param seconds: 等待时间(秒)
+        @return: None
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class DailyBudget(object):
+    """
+    每日配额计数器, 在本地时间的零点重置
+    """
+
+    def __init__(self, limit):
+        """
+        构造函数
+        @param limit: 每日配额, 为0表示不限制
+        @return: DailyBudget对象实例
+        """
+        self.limit = limit
+        self.used = 0
+        self.day = datetime.date.today()
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        """
+        消耗配额
+        @param count: 消耗的数量
+        @return: 配额充足返回True, 否则返回False
+        """
+        with self.lock:
+            today = datetime.date.today()
+            if today != self.day:
+                self.day = today
+                self.used = 0
+            if self.limit and self.used + count > self.limit:
+                return False
+            self.used += count
+            return True
+
+    def refund(self, count=1):
+        """
+        归还已消耗的配额
+        @param count: 归还的数量
+        @return: None
+        """
+        with self.lock:
+            self.used = max(self.used - count, 0)
+
+    @property
+    def remaining(self):
+        """
+        当日剩余配额
+        @return: 剩余数量, 不限制时返回None
+        """
+        if not self.limit:
+            return None
+        return max(self.limit - self.used, 0)
+
+
+# 同一个应用(agent)共享令牌桶, 同一个企业号共享每日配额
+_buckets = {}
+_budgets = {}
+_registry_lock = threading.Lock()
+
+
+def get_bucket(key, rate, capacity):
+    """
+    获取共享的令牌桶, 不存在时创建
+    @param key: 一般为(corpid, appid)
+    @param rate: 每秒补充的令牌数
+    @param capacity: 令牌桶容量
+    @return: TokenBucket对象
+    @raise ValueError: 已存在的令牌桶的速率或容量与参数不同
+    """
+    with _registry_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, capacity)
+        elif (bucket.rate, bucket.capacity) != (float(rate), capacity):
+            raise ValueError('rate limit of %s is already configured as %s/s with burst %s'
+                             % (key, bucket.rate, bucket.capacity))
+        return bucket
+
+
+def get_budget(key, limit):
+    """
+    获取共享的每日配额, 不存在时创建
+    @param key: 一般为corpid
+    @param limit: 每日配额
+    @return: DailyBudget对象
+    @raise ValueError: 已存在的每日配额与参数不同
+    """
+    with _registry_lock:
+        budget = _budgets.get(key)
+        if budget is None:
+            budget = _budgets[key] = DailyBudget(limit)
+        elif budget.limit != limit:
+            raise ValueError('daily budget of %s is already configured as %s'
+                             % (key, budget.limit))
+        return budget
+
+
+def count_recipients(touser, toparty='', totag=''):
+    """
+    计算一条消息消耗的配额, 即接收者的数量
+    部门, 标签与@all的成员数在本地无法得知, 各按一个接收者计算
+    @param touser: 用户名, '|'分割
+    @param toparty: 分组名, '|'分割
+    @param totag: 标签名, '|'分割
+    @return: 接收者数量, 至少为1
+    """
+    return max(sum(len(wechat.split_recipients(item)) for item in (touser, toparty, totag)), 1)
+
+
+class Dispatcher(object):
+    """
+    后台消息发送器
+    内部维护一个有界队列与若干工作线程, 按照令牌桶的速率发送消息
+    同一个应用的发送器共享令牌桶, 同一个企业号的发送器共享每日配额, 两者的设置必须一致
+    """
+
+    logger = logging.getLogger('easy_wechat')
+
+    # 服务器提示频率超限后暂停发送的时间(秒), 企业号的频率限制以分钟计
+    freq_limit_backoff = 60
+
+    def __init__(self, client, workers=None, queue_size=None, rate=None,
+                 burst=None, daily_budget=None):
+        """
+        构造函数, 未指定的参数从client的配置文件中读取
+        @param client: WeChatClient对象
+        @param workers: 工作线程数
+        @param queue_size: 队列长度上限
+        @param rate: 每分钟最多发送的消息数
+        @param burst: 允许的突发消息数
+        @param daily_budget: 每日最多发送的人次, 为0表示不限制
+        @return: Dispatcher对象实例
+        @raise ValueError: 同一个应用或企业号已有设置不同的发送器
+        """
+        config = client.config
+        if workers is None:
+            workers = utils.get_option(config, 'system', 'dispatch_workers', 4)
+        if queue_size is None:
+            queue_size = utils.get_option(config, 'system', 'dispatch_queue_size', 1000)
+        if rate is None:
+            rate = utils.get_option(config, 'system', 'dispatch_rate', 60)
+        if burst is None:
+            burst = utils.get_option(config, 'system', 'dispatch_burst', 10)
+        if daily_budget is None:
+            daily_budget = utils.get_option(config, 'system', 'daily_budget', 6000)
+        self.client = client
+        self.queue = Queue.Queue(queue_size)
+        self.bucket = get_bucket((client.CorpID, client.AppID), rate / 60.0, burst)
+        self.budget = get_budget(client.CorpID, daily_budget)
+        self.counters = {
+            'enqueued': 0,
+            'sent': 0,
+            'failed': 0,
+            'dropped': 0,
+            'over_budget': 0,
+            'outboxed': 0,
+        }
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work, name='easy_wechat-dispatcher-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def count(self, name):
+        """
+        计数器加一
+        @param name: 计数器名称
+        @return: None
+        """
+        with self.lock:
+            self.counters[name] += 1
+
+    def enqueue(self, media_type, media_content, touser, toparty='', totag='', callback=None):
+        """
+        将消息放入发送队列, 不会阻塞
+        参数与WeChatClient.send_media相同
+        @param callback: 发送完成后调用的函数, 参数为服务器返回值dict
+        @return: 成功放入队列返回True; 队列已满或超出当日配额时丢弃消息并返回False
+        """
+        # 配额按接收者人次计算, 发送失败时归还
+        cost = count_recipients(touser, toparty, totag)
+        if not self.budget.take(cost):
+            self.count('over_budget')
+            self.logger.error('daily budget exhausted, message to %s dropped' % touser)
+            return False
+        try:
+            self.queue.put_nowait((media_type, media_content, touser, toparty, totag, callback,
+                                   cost))
+        except Queue.Full:
+            self.budget.refund(cost)
+            self.count('dropped')
+            self.logger.error('dispatch queue is full, message to %s dropped' % touser)
+            return False
+        self.count('enqueued')
+        return True
+
+    def work(self):
+        """
+        工作线程主循环
+        @return: None
+        """
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                self.send(*task)
+            except Exception as e:
+                self.logger.error('dispatcher worker failed with exception: %s' % e)
+            finally:
+                self.queue.task_done()
+
+    def send(self, media_type, media_content, touser, toparty, totag, callback, cost=1):
+        """
+        按照令牌桶的速率发送一条消息
+        服务器提示频率超限时, 暂停所有工作线程一段时间后重试一次
+        配置了发件箱时, 失败的消息已由send_media放入发件箱, 不再重试以免重复投递
+        发送失败时归还全部配额, 部分用户无效时归还这些用户的配额
+        @param cost: 入队时消耗的配额
+        @return: None
+        """
+        try:
+            for attempt in range(2):
+                self.bucket.acquire()
+                res = self.client.send_media(media_type, media_content, touser, toparty, totag)
+                if res.get('errcode') in FREQ_LIMIT_ERRCODES:
+                    self.logger.error('api frequency limit reached, pause for %d seconds'
+                                      % self.freq_limit_backoff)
+                    self.bucket.pause(self.freq_limit_backoff)
+                    if attempt == 0 and 'outbox_key' not in res:
+                        continue
+                break
+        except Exception:
+            self.budget.refund(cost)
+            self.count('failed')
+            raise
+        if res.get('errcode') == 0:
+            self.budget.refund(min(len(wechat.split_recipients(res.get('invaliduser'))), cost))
+            self.count('sent')
+        elif 'outbox_key' in res:
+            # 由发件箱随后投递, 配额不归还
+            self.count('outboxed')
+        else:
+            self.budget.refund(cost)
+            self.count('failed')
+        if callback:
+            callback(res)
+
+    @property
+    def queue_depth(self):
+        """
+        当前队列中等待发送的消息数
+        @return: 消息数
+        """
+        return self.queue.qsize()
+
+    def stats(self):
+        """
+        获取发送统计信息
+        @return: 计数器dict, 包括队列长度与当日剩余配额
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = self.queue_depth
+        stats['budget_remaining'] = self.budget.remaining
+        return stats
+
+    def join(self):
+        """
+        等待队列中的消息全部发送完成
+        @return: None
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        发送完队列中剩余的消息后停止所有工作线程
+        @return: None
+        """
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
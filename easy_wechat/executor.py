@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回调函数执行器模块
+每种消息类型可以绑定各自的执行器: 在请求线程中直接执行, 在线程池中执行, 或在进程池中执行
+执行器限制并发数与排队数, 并统计每种消息类型的排队与执行耗时
+"""
+
+import os
+import time
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+
+class QueueFull(Exception):
+    """
+    执行器排队的任务数已达上限
+    """
+    pass
+
+
+def run_callback(func, arg):
+    """
+    执行回调函数并捕获异常, 在线程池与进程池中都以该函数为入口
+    @param func: 回调函数, 使用进程池时必须是可以被pickle的模块级函数
+    @param arg: 回调函数的参数
+    @return: (是否成功, 返回值或异常对象, 执行耗时)
+    """
+    start = time.time()
+    try:
+        return True, func(arg), time.time() - start
+    except Exception as e:
+        return False, e, time.time() - start
+
+
+class TaskHandle(object):
+    """
+    已提交任务的句柄
+    """
+
+    def __init__(self, async_result=None, outcome=None):
+        """
+        构造函数
+        @param async_result: 线程池或进程池返回的AsyncResult对象
+        @param outcome: 已经执行完毕时的run_callback返回值
+        @return: TaskHandle对象实例
+        """
+        self.async_result = async_result
+        self.outcome = outcome
+
+    def get(self, timeout=None):
+        """
+        等待任务完成
+        @param timeout: 最长等待时间(秒), 超时抛出multiprocessing.TimeoutError
+        @return: 回调函数的返回值, 回调函数抛出的异常会被重新抛出
+        """
+        if self.outcome is None:
+            # 不带超时的get在Python 2中无法被KeyboardInterrupt打断
+            self.outcome = self.async_result.get(timeout if timeout is not None else 1e9)
+        ok, value, unused = self.outcome
+        if not ok:
+            raise value
+        return value
+
+    def ready(self):
+        """
+        @return: 任务是否已完成
+        """
+        return self.outcome is not None or self.async_result.ready()
+
+    def wait(self, timeout=None):
+        """
+        等待任务完成, 超时不抛出异常
+        @param timeout: 最长等待时间(秒)
+        @return: None
+        """
+        if self.outcome is None:
+            self.async_result.wait(timeout)
+
+
+def is_future(obj):
+    """
+    判断回调函数的返回值是否为尚未取得结果的异步对象
+    支持TaskHandle, multiprocessing的AsyncResult, gevent的Greenlet与AsyncResult等
+    同时提供ready与get方法, 并提供wait或join方法的对象
+    @param obj: 回调函数的返回值
+    @return: bool
+    """
+    return hasattr(obj, 'ready') and hasattr(obj, 'get') and \
+        (hasattr(obj, 'wait') or hasattr(obj, 'join'))
+
+
+def wait_future(future, timeout=None):
+    """
+    等待异步对象完成
+    @param future: 异步对象
+    @param timeout: 最长等待时间(秒), 为None则一直等待
+    @return: 是否已完成
+    """
+    if hasattr(future, 'wait'):
+        future.wait(timeout)
+    else:
+        future.join(timeout)
+    return future.ready()
+
+
+class Executor(object):
+    """
+    执行器基类, 负责排队数限制与耗时统计
+    """
+
+    kind = None
+
+    def __init__(self, workers=1, max_pending=None):
+        """
+        构造函数
+        @param workers: 并发数
+        @param max_pending: 最多排队与执行中的任务数, 为None则不限制
+        @return: Executor对象实例
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.total_run_time = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, func, arg, callback=None):
+        """
+        提交任务
+        @param func: 回调函数
+        @param arg: 回调函数的参数
+        @param callback: 任务完成后调用的函数, 参数为(是否成功, 返回值或异常对象)
+        @return: TaskHandle对象
+        """
+        with self.lock:
+            if self.max_pending is not None and self.pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull('%s executor has %d pending tasks' % (self.kind, self.pending))
+            self.pending += 1
+        submitted = time.time()
+
+        def done(outcome):
+            """
+            记录统计信息并调用完成回调
+            @param outcome: run_callback的返回值
+            @return: None
+            """
+            ok, value, run_time = outcome
+            latency = time.time() - submitted
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.failed += not ok
+                self.total_latency += latency
+                self.total_run_time += run_time
+                self.max_latency = max(self.max_latency, latency)
+            if callback:
+                callback(ok, value)
+
+        try:
+            return self.dispatch(func, arg, done)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+    def dispatch(self, func, arg, done):
+        """
+        将任务交给具体的执行方式, 由子类实现
+        @param func: 回调函数
+        @param arg: 回调函数的参数
+        @param done: 任务完成后必须调用的函数, 参数为run_callback的返回值
+        @return: TaskHandle对象
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        统计信息
+        @return: dict对象, 耗时单位为秒
+        """
+        with self.lock:
+            count = max(self.completed, 1)
+            return {
+                'kind': self.kind,
+                'workers': self.workers,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'avg_latency': self.total_latency / count,
+                'avg_queue_time': (self.total_latency - self.total_run_time) / count,
+                'max_latency': self.max_latency,
+            }
+
+    def close(self):
+        """
+        停止执行器
+        @return: None
+        """
+        pass
+
+
+class InlineExecutor(Executor):
+    """
+    在调用方线程中直接执行
+    """
+
+    kind = 'inline'
+
+    def dispatch(self, func, arg, done):
+        """
+        立即执行任务
+        @return: 已完成的TaskHandle对象
+        """
+        outcome = run_callback(func, arg)
+        done(outcome)
+        return TaskHandle(outcome=outcome)
+
+
+class PoolExecutor(Executor):
+    """
+    基于multiprocessing线程池或进程池的执行器
+    """
+
+    def __init__(self, workers=4, max_pending=None):
+        """
+        构造函数
+        @param workers: 线程或进程数
+        @param max_pending: 最多排队与执行中的任务数
+        @return: PoolExecutor对象实例
+        """
+        super(PoolExecutor, self).__init__(workers, max_pending)
+        self.pool = None
+        self.pid = None
+        self.pool_lock = threading.Lock()
+
+    def get_pool(self):
+        """
+        获取当前进程的线程池或进程池, 首次使用时创建
+        fork出的工作进程中没有父进程的线程, 因此会重新创建
+        @return: Pool对象
+        """
+        with self.pool_lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = self.create_pool(self.workers)
+                self.pid = os.getpid()
+            return self.pool
+
+    def create_pool(self, workers):
+        """
+        创建线程池或进程池, 由子类实现
+        @param workers: 线程或进程数
+        @return: Pool对象
+        """
+        raise NotImplementedError
+
+    def dispatch(self, func, arg, done):
+        """
+        将任务放入池中
+        @return: TaskHandle对象
+        """
+        return TaskHandle(self.get_pool().apply_async(run_callback, (func, arg), callback=done))
+
+    def close(self):
+        """
+        等待已提交的任务完成后停止线程或进程
+        @return: None
+        """
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.close()
+            self.pool.join()
+
+
+class ThreadExecutor(PoolExecutor):
+    """
+    在线程池中执行, 适合等待网络等I/O的回调函数
+    """
+
+    kind = 'thread'
+
+    def create_pool(self, workers):
+        """
+        @param workers: 线程数
+        @return: ThreadPool对象
+        """
+        return multiprocessing.pool.ThreadPool(workers)
+
+
+class ProcessExecutor(PoolExecutor):
+    """
+    在进程池中执行, 适合图像处理等CPU密集的回调函数
+    回调函数必须是模块级函数, 参数与返回值必须可以被pickle
+    """
+
+    kind = 'process'
+
+    def create_pool(self, workers):
+        """
+        @param workers: 进程数
+        @return: Pool对象
+        """
+        return multiprocessing.Pool(workers)
+
+
+def create_executor(spec):
+    """
+    根据描述字符串创建执行器
+    @param spec: 格式为'类型[:并发数[:排队数]]', 类型为inline, thread或process, 例如'process:4:100'
+    @return: Executor对象
+    """
+    executor_classes = {
+        'inline': InlineExecutor,
+        'thread': ThreadExecutor,
+        'process': ProcessExecutor,
+    }
+    parts = spec.strip().split(':')
+    if parts[0] not in executor_classes:
+        raise ValueError('Invalid executor type: %s' % parts[0])
+    kwargs = {}
+    if len(parts) > 1 and parts[1]:
+        kwargs['workers'] = int(parts[1])
+    if len(parts) > 2 and parts[2]:
+        kwargs['max_pending'] = int(parts[2])
+    return executor_classes[parts[0]](**kwargs)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+多媒体素材辅助模块
+包括按内容寻址的media_id缓存以及流式的multipart编码器
+"""
+
+import io
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import mimetypes
+import threading
+import collections
+
+# 读取文件时每块的大小
+CHUNK_SIZE = 64 * 1024
+
+
+def hash_file(file_path):
+    """
+    计算文件内容的SHA1摘要
+    @param file_path: 文件路径
+    @return: 十六进制摘要字符串
+    """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(CHUNK_SIZE), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_data(data):
+    """
+    计算内存数据或可定位文件对象的SHA1摘要
+    文件对象读取完毕后会回到原来的位置
+    @param data: 字符串, bytearray, memoryview或文件对象
+    @return: 十六进制摘要字符串, 分块迭代器等无法重复读取的数据返回None
+    """
+    sha = hashlib.sha1()
+    if isinstance(data, (str, bytearray, memoryview, buffer)):
+        sha.update(memoryview(data))
+        return sha.hexdigest()
+    if not hasattr(data, 'read'):
+        return None
+    try:
+        pos = data.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    for chunk in iter(lambda: data.read(CHUNK_SIZE), ''):
+        sha.update(chunk)
+    data.seek(pos)
+    return sha.hexdigest()
+
+
+class MemoryReader(object):
+    """
+    以只读文件的方式读取内存中的数据
+    底层数据不会被整体复制, 每次只复制读取的那一块
+    """
+
+    def __init__(self, data):
+        """
+        构造函数
+        @param data: 字符串, bytearray, memoryview或buffer对象
+        @return: MemoryReader对象实例
+        """
+        self.view = memoryview(data)
+        self.size = len(self.view) * self.view.itemsize
+        self.pos = 0
+
+    def read(self, size=-1):
+        """
+        读取下一块数据
+        @param size: 最多读取的字节数, 负数表示读取全部
+        @return: 字符串, 读取完毕时返回空字符串
+        """
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+        chunk = self.view[self.pos:end].tobytes()
+        self.pos = end
+        return chunk
+
+    def close(self):
+        """
+        释放对底层数据的引用
+        @return: None
+        """
+        self.view = memoryview('')
+        self.size = self.pos = 0
+
+
+class ChunkReader(object):
+    """
+    以文件的方式读取分块迭代器
+    每次read返回迭代器产生的下一块, 不会重新切分, 因此只用于长度未知的分块传输
+    """
+
+    def __init__(self, chunks):
+        """
+        构造函数
+        @param chunks: 产生字符串的可迭代对象
+        @return: ChunkReader对象实例
+        """
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        """
+        读取下一块数据, 忽略size参数
+        @return: 字符串, 读取完毕时返回空字符串
+        """
+        for chunk in self.chunks:
+            if chunk:
+                return bytes(chunk)
+        return ''
+
+    def close(self):
+        """
+        关闭迭代器
+        @return: None
+        """
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+def open_data(data):
+    """
+    将内存数据, 文件对象或分块迭代器转换为文件对象
+    @param data: 字符串, bytearray, memoryview, 文件对象或产生字符串的可迭代对象
+    @return: (文件对象, 字节数), 长度未知时字节数为None
+    """
+    if isinstance(data, (str, bytearray, memoryview, buffer)):
+        reader = MemoryReader(data)
+        return reader, reader.size
+    if hasattr(data, 'read'):
+        try:
+            pos = data.tell()
+            data.seek(0, os.SEEK_END)
+            size = data.tell() - pos
+            data.seek(pos)
+        except (AttributeError, IOError, OSError, ValueError):
+            size = None
+        return data, size
+    if isinstance(data, unicode):
+        raise TypeError('unicode data must be encoded before upload')
+    return ChunkReader(data), None
+
+
+class MediaCache(object):
+    """
+    按内容寻址的media_id缓存
+    以(企业号, 素材类型, 内容摘要)为键, 相同内容的素材在有效期内无需重复上传
+    """
+
+    logger = logging.getLogger('easy_wechat')
+
+    # 临时素材的有效期为3天, 提前一小时失效以免发送时素材恰好过期
+    lifetime = 3 * 24 * 3600 - 3600
+
+    def __init__(self, capacity=1000, index_path=None):
+        """
+        构造函数
+        @param capacity: 最多缓存的素材数, 超出后淘汰最久未使用的素材
+        @param index_path: 磁盘索引文件路径, 为None则只在内存中缓存
+        @return: MediaCache对象实例
+        """
+        self.capacity = capacity
+        self.index_path = index_path
+        # key -> (media_id, expires_at), 按照最近使用的顺序排列
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if index_path:
+            self.load()
+
+    @staticmethod
+    def make_key(corpid, media_type, digest):
+        """
+        生成缓存键
+        @param corpid: 企业号ID, media_id只在同一个企业号内有效
+        @param media_type: 素材类型
+        @param digest: 内容摘要
+        @return: 字符串
+        """
+        return '%s:%s:%s' % (corpid, media_type, digest)
+
+    def get(self, key):
+        """
+        查找未过期的media_id
+        @param key: 缓存键
+        @return: (media_id, expires_at), 不存在或已过期时返回None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[1] > time.time():
+                # 重新插入到末尾, 表示最近使用过
+                self.entries[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+        if entry:
+            self.save()
+        return None
+
+    def put(self, key, media_id, created_at=None):
+        """
+        缓存上传得到的media_id
+        @param key: 缓存键
+        @param media_id: 服务器返回的media_id
+        @param created_at: 服务器返回的上传时间戳, 为None则使用当前时间
+        @return: None
+        """
+        created_at = float(created_at) if created_at else time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (media_id, created_at + self.lifetime)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        self.save()
+
+    def load(self):
+        """
+        从磁盘索引加载未过期的缓存项
+        @return: None
+        """
+        try:
+            with open(self.index_path, 'rb') as fid:
+                items = json.load(fid)
+        except (IOError, OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for key, media_id, expires_at in items[-self.capacity:]:
+                if expires_at > now:
+                    self.entries[key] = (media_id, expires_at)
+
+    def save(self):
+        """
+        将缓存写入磁盘索引, 先写临时文件再重命名以保证原子性
+        @return: None
+        """
+        if not self.index_path:
+            return
+        with self.lock:
+            items = [(key, media_id, expires_at)
+                     for key, (media_id, expires_at) in self.entries.items()]
+        dirname = os.path.dirname(os.path.abspath(self.index_path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.media')
+            with os.fdopen(fd, 'wb') as fid:
+                json.dump(items, fid)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError) as e:
+            self.logger.error('failed to save media cache index: %s' % e)
+
+
+class MultipartEncoder(object):
+    """
+    流式的multipart/form-data编码器
+    按块读取文件内容而不是在内存中构造完整的请求体, 并预先计算Content-Length
+    可以作为requests的data参数, 同时支持with语句以确保文件被关闭
+    内容长度未知时应使用iter_chunks()作为data参数, 以分块传输编码发送
+    """
+
+    def __init__(self, fileobj, size, file_name, content_type=None,
+                 field_name='file', progress=None, close_file=True):
+        """
+        构造函数
+        @param fileobj: 支持read方法的文件对象
+        @param size: 文件内容的字节数, 未知时为None
+        @param file_name: 上传的文件名
+        @param content_type: 文件的MIME类型, 为None则根据文件名猜测
+        @param field_name: 表单字段名
+        @param progress: 进度回调函数, 参数为(已发送字节数, 总字节数), 长度未知时总字节数为None
+        @param close_file: 关闭编码器时是否同时关闭文件对象
+        @return: MultipartEncoder对象实例
+        """
+        if content_type is None:
+            content_type = mimetypes.guess_type(file_name, strict=False)[0] \
+                or 'application/octet-stream'
+        if isinstance(file_name, unicode):
+            file_name = file_name.encode('utf-8')
+        self.boundary = uuid.uuid4().hex
+        filelength = '; filelength=%d' % size if size is not None else ''
+        head = ('--%s\r\n'
+                'Content-Disposition: form-data; name="%s"; filename="%s"%s\r\n'
+                'Content-Type: %s\r\n'
+                'Expires: 0\r\n\r\n') % (self.boundary, field_name,
+                                           file_name.replace('"', '%22'), filelength, content_type)
+        tail = '\r\n--%s--\r\n' % self.boundary
+        self.fileobj = fileobj
+        self.close_file = close_file
+        self.parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self.length = len(head) + size + len(tail) if size is not None else None
+        self.progress = progress
+        self.sent = 0
+        self.start_time = None
+
+    @classmethod
+    def from_path(cls, file_path, content_type=None, field_name='file', progress=None):
+        """
+        根据文件路径创建编码器
+        @param file_path: 文件路径
+        @param content_type: 文件的MIME类型, 为None则根据文件名猜测
+        @param field_name: 表单字段名
+        @param progress: 进度回调函数
+        @return: MultipartEncoder对象
+        """
+        fileobj = open(file_path, 'rb')
+        try:
+            size = os.fstat(fileobj.fileno()).st_size
+            return cls(fileobj, size, os.path.basename(file_path), content_type,
+                       field_name, progress)
+        except Exception:
+            fileobj.close()
+            raise
+
+    @classmethod
+    def from_data(cls, data, file_name, content_type=None, field_name='file', progress=None):
+        """
+        根据内存数据, 文件对象或分块迭代器创建编码器, 不会写入临时文件
+        调用方传入的文件对象不会被编码器关闭
+        @param data: 字符串, bytearray, memoryview, 文件对象或产生字符串的可迭代对象
+        @param file_name: 上传的文件名
+        @param content_type: 文件的MIME类型, 为None则根据文件名猜测
+        @param field_name: 表单字段名
+        @param progress: 进度回调函数
+        @return: MultipartEncoder对象
+        """
+        fileobj, size = open_data(data)
+        return cls(fileobj, size, file_name, content_type, field_name, progress,
+                   close_file=fileobj is not data)
+
+    @property
+    def content_type(self):
+        """
+        请求体的Content-Type
+        @return: 字符串
+        """
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        """
+        请求体的总字节数, requests据此设置Content-Length
+        @return: 字节数
+        """
+        return self.length
+
+    def read(self, size=-1):
+        """
+        读取下一块请求体
+        @param size: 最多读取的字节数, 负数表示读取全部
+        @return: 字符串, 读取完毕时返回空字符串
+        """
+        if self.start_time is None:
+            self.start_time = time.time()
+        if size is None or size < 0:
+            size = self.length - self.sent if self.length is not None else CHUNK_SIZE
+        chunks = []
+        remaining = size
+        while remaining > 0 and self.parts:
+            chunk = self.parts[0].read(remaining)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = ''.join(chunks)
+        self.sent += len(data)
+        if self.progress and data:
+            self.progress(self.sent, self.length)
+        return data
+
+    def iter_chunks(self):
+        """
+        按块迭代请求体, 文件内容的每一块原样产生, 用于长度未知的分块传输
+        @return: 产生字符串的生成器
+        """
+        if self.start_time is None:
+            self.start_time = time.time()
+        while self.parts:
+            chunk = self.parts[0].read(CHUNK_SIZE)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            self.sent += len(chunk)
+            if self.progress:
+                self.progress(self.sent, self.length)
+            yield chunk
+
+    @property
+    def throughput(self):
+        """
+        已发送部分的平均速率
+        @return: 字节/秒
+        """
+        if not self.start_time:
+            return 0.0
+        return self.sent / max(time.time() - self.start_time, 1e-6)
+
+    def close(self):
+        """
+        关闭由编码器打开的文件对象
+        @return: None
+        """
+        if self.close_file:
+            self.fileobj.close()
+
+    def __enter__(self):
+        """
+        支持with语句
+        @return: 对象自身
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        退出with语句时关闭文件
+        @return: None
+        """
+        self.close()
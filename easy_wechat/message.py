@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回调消息对象模块
+InboundMessage保存收到的XML及其解析结果, 只解析一次, 可以像只读的dict一样使用,
+但不是dict的子类, 传给回调函数的是其顶层字段的浅拷贝
+"""
+
+import collections
+
+import easy_wechat.utils as utils
+
+
+class MessageBase(object):
+    """
+    消息对象的公共基类, 根据__getitem__, __iter__与__len__实现dict的其余只读接口
+    """
+
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        """
+        读取字段
+        @param key: 字段名
+        @param default: 字段不存在时的默认值
+        @return: 字段值
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        """
+        判断字段是否存在
+        @param key: 字段名
+        @return: bool
+        """
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        """
+        @return: 字段名列表
+        """
+        return list(self)
+
+    def values(self):
+        """
+        @return: 字段值列表
+        """
+        return [self[key] for key in self]
+
+    def items(self):
+        """
+        @return: (字段名, 字段值)列表
+        """
+        return [(key, self[key]) for key in self]
+
+    def iterkeys(self):
+        """
+        @return: 字段名迭代器
+        """
+        return iter(self)
+
+    def itervalues(self):
+        """
+        @return: 字段值迭代器
+        """
+        return (self[key] for key in self)
+
+    def iteritems(self):
+        """
+        @return: (字段名, 字段值)迭代器
+        """
+        return ((key, self[key]) for key in self)
+
+    def has_key(self, key):
+        """
+        判断字段是否存在
+        @param key: 字段名
+        @return: bool
+        """
+        return key in self
+
+    def copy(self):
+        """
+        复制为普通的dict对象
+        @return: dict对象
+        """
+        return dict(self.iteritems())
+
+    to_dict = copy
+
+    def __reduce__(self):
+        """
+        序列化为普通的dict对象, 以便传给进程池中的回调函数
+        @return: pickle使用的(构造函数, 参数)
+        """
+        return dict, (self.copy(),)
+
+    def __eq__(self, other):
+        """
+        与其他dict或消息对象比较内容
+        @param other: 比较对象
+        @return: bool
+        """
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return self.copy() == dict(other.items())
+
+    def __ne__(self, other):
+        """
+        @param other: 比较对象
+        @return: bool
+        """
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        """
+        @return: 字符串表示
+        """
+        return '%s(%r)' % (type(self).__name__, self.copy())
+
+
+class InboundMessage(MessageBase):
+    """
+    收到的回调消息, 只读
+    原始XML在调用parse或首次访问字段时才被解析, 结果会被缓存
+    """
+
+    __slots__ = ('raw', 'fields')
+
+    def __init__(self, raw):
+        """
+        构造函数
+        @param raw: 解密后的XML字符串
+        @return: InboundMessage对象实例
+        """
+        self.raw = raw
+        self.fields = None
+
+    def parse(self):
+        """
+        解析原始XML, 结果会被缓存
+        @return: 字段dict
+        """
+        if self.fields is None:
+            self.fields = utils.xml_to_dict(self.raw)
+        return self.fields
+
+    @property
+    def msg_type(self):
+        """
+        消息类型
+        @return: 字符串, 不存在时为空字符串
+        """
+        return self.parse().get('MsgType') or ''
+
+    def __getitem__(self, key):
+        """
+        @param key: 字段名
+        @return: 字段值
+        """
+        return self.parse()[key]
+
+    def __iter__(self):
+        """
+        @return: 字段名迭代器
+        """
+        return iter(self.parse())
+
+    def __len__(self):
+        """
+        @return: 字段数
+        """
+        return len(self.parse())
+
+
+collections.Mapping.register(InboundMessage)
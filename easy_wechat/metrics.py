@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+耗时统计模块
+以固定分桶的直方图记录各处理阶段的耗时, 并输出Prometheus文本格式
+每次记录只有一次二分查找与几次加法, 可以在生产环境中一直开启
+"""
+
+import time
+import bisect
+import threading
+
+# 默认的直方图分桶上界(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Timer(object):
+    """
+    记录with语句块耗时的上下文管理器
+    """
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        """
+        构造函数
+        @param histogram: Histogram对象
+        @return: Timer对象实例
+        """
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        """
+        开始计时
+        @return: Timer对象
+        """
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        结束计时, 抛出异常时同样记录
+        @return: False, 不吞掉异常
+        """
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+
+class Histogram(object):
+    """
+    固定分桶的直方图
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        构造函数
+        @param buckets: 递增的分桶上界
+        @return: Histogram对象实例
+        """
+        self.buckets = tuple(buckets)
+        # 最后一个桶对应+Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        记录一个数值
+        @param value: 耗时(秒)
+        @return: None
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        @return: 记录with语句块耗时的Timer对象
+        """
+        return Timer(self)
+
+    def snapshot(self):
+        """
+        @return: (各分桶的累计数列表, 总和, 总数)
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+
+def format_labels(labels):
+    """
+    格式化标签
+    @param labels: (标签名, 标签值)元组
+    @return: 字符串, 如{stage="decrypt"}
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels)
+
+
+def format_bound(bound):
+    """
+    @param bound: 分桶上界
+    @return: 字符串
+    """
+    return repr(float(bound))
+
+
+class Registry(object):
+    """
+    直方图注册表
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        构造函数
+        @param buckets: 新建直方图的默认分桶
+        @return: Registry对象实例
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # 指标名 -> 说明
+        self.descriptions = {}
+        # (指标名, 标签元组) -> Histogram对象
+        self.histograms = {}
+
+    def histogram(self, name, description='', **labels):
+        """
+        获取直方图, 不存在时创建, 热路径中应预先获取并保存
+        @param name: 指标名
+        @param description: 指标说明
+        @param labels: 标签
+        @return: Histogram对象
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(self.buckets)
+                if description:
+                    self.descriptions[name] = description
+        return histogram
+
+    def time(self, name, **labels):
+        """
+        记录with语句块的耗时
+        @param name: 指标名
+        @param labels: 标签
+        @return: Timer对象
+        """
+        return self.histogram(name, **labels).time()
+
+    def render(self, collectors=()):
+        """
+        输出Prometheus文本格式
+        @param collectors: 额外的采集函数, 返回(指标名, 类型, 说明, [(标签dict, 数值)])列表
+        @return: 字符串
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        last_name = None
+        for (name, labels), histogram in histograms:
+            if name != last_name:
+                last_name = name
+                if name in self.descriptions:
+                    lines.append('# HELP %s %s' % (name, self.descriptions[name]))
+                lines.append('# TYPE %s histogram' % name)
+            cumulative, total, count = histogram.snapshot()
+            bounds = [format_bound(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, value in zip(bounds, cumulative):
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bound),)),
+                                                 value))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        for collector in collectors:
+            for name, metric_type, description, samples in collector():
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in samples:
+                    lines.append('%s%s %r' % (name, format_labels(sorted(labels.items())),
+                                              float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# 同一进程中的WeChatServer与WeChatClient共用的注册表
+REGISTRY = Registry()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+持久化发件箱模块
+发送失败或需要排队的消息先写入SQLite数据库, 再由后台线程按照指数退避重试发送
+"""
+
+import json
+import time
+import uuid
+import random
+import sqlite3
+import logging
+import threading
+
+# 可以重试的错误码: 本地请求失败, 系统繁忙以及接口调用频率超限
+RETRYABLE_ERRCODES = (-1, 45009, 45011)
+
+# 消息状态
+STATE_PENDING = 0
+STATE_SENT = 1
+STATE_DEAD = 2
+
+
+class OutboxTimeout(Exception):
+    """
+    在限定时间内未能将消息写入磁盘
+    """
+    pass
+
+
+class Outbox(object):
+    """
+    持久化发件箱
+    put操作默认只写入内存缓冲区, 由写线程批量提交, 进程崩溃时尚未提交的消息会丢失,
+    需要确保消息已写入磁盘时传入durable=True; 投递线程负责发送到期的消息
+    每条消息带有唯一的幂等键, 相同键的消息只会被投递一次
+    """
+
+    logger = logging.getLogger('easy_wechat')
+
+    # 首次重试的等待时间与最长等待时间(秒)
+    base_delay = 5.0
+    max_delay = 3600.0
+    # 最多尝试次数, 超出后消息被标记为失败
+    max_attempts = 10
+    # 投递中的消息被其他进程接管前的租期(秒)
+    lease_time = 60.0
+    # 已发送消息的保留时间(秒), 在此期间相同幂等键的消息会被忽略
+    retention = 3 * 24 * 3600
+
+    def __init__(self, client, path, batch_size=500, flush_interval=0.05,
+                 poll_interval=1.0, durable_timeout=5.0, start=True):
+        """
+        构造函数
+        @param client: WeChatClient对象
+        @param path: 数据库文件路径
+        @param batch_size: 缓冲区达到该数量时立即提交
+        @param flush_interval: 写线程提交缓冲区的最长间隔(秒)
+        @param poll_interval: 投递线程检查到期消息的间隔(秒)
+        @param durable_timeout: durable=True时等待写入磁盘的最长时间(秒)
+        @param start: 是否立即启动后台线程
+        @return: Outbox对象实例
+        """
+        self.client = client
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.durable_timeout = durable_timeout
+        self.buffer = []
+        self.queued = 0
+        self.flushed = 0
+        self.closing = False
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.threads = []
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'key TEXT NOT NULL UNIQUE, '
+                     'payload TEXT NOT NULL, '
+                     'state INTEGER NOT NULL DEFAULT 0, '
+                     'attempts INTEGER NOT NULL DEFAULT 0, '
+                     'next_try REAL NOT NULL, '
+                     'last_error TEXT, '
+                     'created REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_try)')
+        conn.close()
+        if start:
+            self.start()
+
+    def connect(self):
+        """
+        创建数据库连接, 每个线程使用各自的连接
+        @return: sqlite3.Connection对象
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self):
+        """
+        启动写线程与投递线程, 数据库中未完成的消息会被继续投递
+        @return: None
+        """
+        for target in (self.write_loop, self.deliver_loop):
+            thread = threading.Thread(target=target, name='easy_wechat-outbox')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, media_type, media_content, touser, toparty='', totag='', key=None,
+            durable=False):
+        """
+        将消息放入发件箱
+        参数与WeChatClient.send_media相同
+        @param key: 幂等键, 为None则自动生成, 此时重复放入同一条消息会被投递多次
+        @param durable: 是否等待消息写入磁盘后再返回, 为False时返回后进程崩溃可能丢失该消息
+        @return: 幂等键
+        @raise OutboxTimeout: durable=True且超过durable_timeout仍未写入磁盘, 此时消息被撤回
+        """
+        if key is None:
+            key = uuid.uuid4().hex
+        payload = json.dumps([media_type, media_content, touser, toparty, totag])
+        item = (key, payload)
+        with self.cond:
+            self.buffer.append(item)
+            self.queued += 1
+            position = self.queued
+            if durable or len(self.buffer) >= self.batch_size:
+                self.cond.notify_all()
+        if durable and not self.flush(self.durable_timeout):
+            with self.cond:
+                # 写线程正在写入该消息时, 等本次写入结束才能确定是否已写入磁盘
+                while item not in self.buffer and self.flushed < position:
+                    self.cond.wait(self.flush_interval)
+                if item in self.buffer:
+                    # 撤回的消息视为已处理, 避免其他flush调用一直等待
+                    self.buffer.remove(item)
+                    self.flushed += 1
+                    raise OutboxTimeout('message %s is not written to outbox in %s seconds'
+                                        % (key, self.durable_timeout))
+        return key
+
+    def lookup(self, key):
+        """
+        查询幂等键对应的消息状态
+        @param key: 幂等键
+        @return: STATE_PENDING, STATE_SENT或STATE_DEAD, 不存在时返回None
+        """
+        with self.cond:
+            if any(item[0] == key for item in self.buffer):
+                return STATE_PENDING
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT state FROM outbox WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def flush(self, timeout=None):
+        """
+        等待当前缓冲区中的消息全部写入磁盘
+        @param timeout: 最长等待时间(秒)
+        @return: 是否全部写入
+        """
+        if not self.threads:
+            # 后台线程未启动时, 由调用方线程写入缓冲区
+            with self.cond:
+                batch, self.buffer = self.buffer, []
+            if batch:
+                conn = self.connect()
+                try:
+                    self.write_batch(conn, batch)
+                finally:
+                    conn.close()
+            return True
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            target = self.queued
+            self.cond.notify_all()
+            while self.flushed < target:
+                remaining = deadline - time.time() if deadline is not None else 1.0
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def write_loop(self):
+        """
+        写线程主循环, 将缓冲区中的消息批量提交
+        @return: None
+        """
+        conn = self.connect()
+        while True:
+            with self.cond:
+                if not self.buffer and not self.closing:
+                    self.cond.wait(self.flush_interval)
+                batch, self.buffer = self.buffer, []
+                closing = self.closing
+            if batch:
+                try:
+                    self.write_batch(conn, batch)
+                except sqlite3.Error as e:
+                    self.logger.error('outbox write failed with exception: %s' % e)
+                    with self.cond:
+                        self.buffer[:0] = batch
+                        self.cond.notify_all()
+                    time.sleep(self.flush_interval)
+            elif closing:
+                break
+        conn.close()
+
+    def write_batch(self, conn, batch):
+        """
+        在一个事务中写入一批消息, 已存在的幂等键会被忽略
+        @param conn: 数据库连接
+        @param batch: (key, payload)列表
+        @return: None
+        """
+        now = time.time()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO outbox (key, payload, next_try, created) '
+                             'VALUES (?, ?, ?, ?)',
+                             [(key, payload, now, now) for key, payload in batch])
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        with self.cond:
+            self.flushed += len(batch)
+            self.cond.notify_all()
+        self.wakeup.set()
+
+    def deliver_loop(self):
+        """
+        投递线程主循环
+        @return: None
+        """
+        conn = self.connect()
+        last_purge = 0
+        while not self.closing:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                while self.deliver_due(conn):
+                    pass
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    conn.execute('DELETE FROM outbox WHERE state != ? AND created < ?',
+                                 (STATE_PENDING, last_purge - self.retention))
+            except sqlite3.Error as e:
+                self.logger.error('outbox delivery failed with exception: %s' % e)
+        conn.close()
+
+    def deliver_due(self, conn, limit=100):
+        """
+        投递一批到期的消息
+        @param conn: 数据库连接
+        @param limit: 每批最多投递的数量
+        @return: 本批投递的消息数
+        """
+        now = time.time()
+        rows = conn.execute('SELECT id, payload, attempts, next_try FROM outbox '
+                            'WHERE state = ? AND next_try <= ? ORDER BY id LIMIT ?',
+                            (STATE_PENDING, now, limit)).fetchall()
+        delivered = 0
+        for row_id, payload, attempts, next_try in rows:
+            if self.closing:
+                break
+            # 通过租约认领消息, 多个进程共用同一个发件箱时不会重复投递
+            cursor = conn.execute('UPDATE outbox SET next_try = ? WHERE id = ? AND next_try = ?',
+                                  (now + self.lease_time, row_id, next_try))
+            if cursor.rowcount != 1:
+                continue
+            delivered += 1
+            res = self.client.send_media(*json.loads(payload), queue_on_failure=False)
+            errcode = res.get('errcode', 0)
+            attempts += 1
+            if errcode == 0:
+                conn.execute('UPDATE outbox SET state = ?, attempts = ? WHERE id = ?',
+                             (STATE_SENT, attempts, row_id))
+            elif errcode in RETRYABLE_ERRCODES and attempts < self.max_attempts:
+                conn.execute('UPDATE outbox SET attempts = ?, next_try = ?, last_error = ? '
+                             'WHERE id = ?', (attempts, time.time() + self.backoff(attempts),
+                                              res.get('errmsg'), row_id))
+            else:
+                self.logger.error('outbox gave up message %d after %d attempts: %s'
+                                  % (row_id, attempts, res.get('errmsg')))
+                conn.execute('UPDATE outbox SET state = ?, attempts = ?, last_error = ? '
+                             'WHERE id = ?', (STATE_DEAD, attempts, res.get('errmsg'), row_id))
+        return delivered
+
+    def backoff(self, attempts):
+        """
+        计算带随机抖动的指数退避时间
+        @param attempts: 已尝试次数
+        @return: 等待时间(秒)
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def stats(self):
+        """
+        统计发件箱中各状态的消息数
+        @return: dict对象
+        """
+        conn = self.connect()
+        try:
+            counts = dict(conn.execute('SELECT state, COUNT(*) FROM outbox GROUP BY state'))
+        finally:
+            conn.close()
+        with self.cond:
+            buffered = len(self.buffer)
+        return {
+            'buffered': buffered,
+            'pending': counts.get(STATE_PENDING, 0),
+            'sent': counts.get(STATE_SENT, 0),
+            'dead': counts.get(STATE_DEAD, 0),
+        }
+
+    def close(self):
+        """
+        将缓冲区写入磁盘并停止后台线程, 未投递的消息会在下次启动时继续投递
+        @return: None
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # 后台线程未启动时, 由调用方线程写入剩余的缓冲区
+        self.flush()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求采样分析模块
+每N个请求以cProfile分析一个, 或只保存耗时超过阈值的请求
+结果以pstats格式保存在目录中, 只保留最新的若干个文件, 并汇总出最耗时的函数
+"""
+
+import os
+import time
+import glob
+import pstats
+import cProfile
+import StringIO
+import threading
+
+
+class RequestProfiler(object):
+    """
+    请求采样分析器
+    """
+
+    def __init__(self, directory, every=0, slow_ms=0, keep=100, top=30):
+        """
+        构造函数
+        @param directory: 保存分析结果的目录
+        @param every: 每多少个请求分析一个, 为0时分析每个请求,
+                      只设置slow_ms时每个请求都要承担cProfile的开销, 生产环境中应同时设置every
+        @param slow_ms: 只保存耗时不少于该值(毫秒)的请求, 为0则全部保存
+        @param keep: 目录中最多保留的分析结果数
+        @param top: 汇总中列出的函数数
+        @return: RequestProfiler对象实例
+        """
+        self.directory = directory
+        self.every = every or 1
+        self.slow_ms = slow_ms
+        self.keep = keep
+        self.top = top
+        self.lock = threading.Lock()
+        self.count = 0
+        self.saved = 0
+        self.aggregate = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def call(self, func, *args):
+        """
+        调用函数, 被采样时进行分析
+        注意cProfile只分析当前线程, 在执行器中运行的回调函数只体现为等待时间
+        @param func: 被调用的函数
+        @param args: 参数列表
+        @return: 函数的返回值
+        """
+        with self.lock:
+            self.count += 1
+            sampled = self.count % self.every == 0
+        if not sampled:
+            return func(*args)
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            if elapsed_ms >= self.slow_ms:
+                self.save(profile, elapsed_ms)
+
+    def save(self, profile, elapsed_ms):
+        """
+        保存分析结果, 删除多余的旧文件并更新汇总
+        @param profile: cProfile.Profile对象
+        @param elapsed_ms: 请求耗时(毫秒)
+        @return: 保存的文件路径
+        """
+        with self.lock:
+            self.saved += 1
+            seq = self.saved
+        # 写文件与清理旧文件不持有锁, 以免阻塞其他请求线程
+        # 文件名以时间开头, 按名称排序即为时间顺序
+        path = os.path.join(self.directory, '%s-%d-%d-%dms.prof' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(), seq, elapsed_ms))
+        profile.dump_stats(path)
+        for old_path in sorted(glob.glob(os.path.join(self.directory, '*.prof')))[:-self.keep]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                # 其他线程或工作进程已经删除
+                pass
+        with self.lock:
+            if self.aggregate is None:
+                self.aggregate = pstats.Stats(profile)
+            else:
+                self.aggregate.add(profile)
+            self.write_summary()
+        return path
+
+    def write_summary(self):
+        """
+        将汇总写入summary-<pid>.txt, 调用方需持有锁
+        @return: None
+        """
+        stream = StringIO.StringIO()
+        stream.write('%d profiles saved from %d requests\n' % (self.saved, self.count))
+        self.aggregate.stream = stream
+        self.aggregate.sort_stats('tottime').print_stats(self.top)
+        path = os.path.join(self.directory, 'summary-%d.txt' % os.getpid())
+        with open(path + '.tmp', 'w') as summary_file:
+            summary_file.write(stream.getvalue())
+        os.rename(path + '.tmp', path)
+
+    def summary(self):
+        """
+        目前为止自身耗时最多的函数
+        @return: [(函数描述, 调用次数, 自身耗时, 累计耗时)]列表
+        """
+        with self.lock:
+            if self.aggregate is None:
+                return []
+            items = sorted(self.aggregate.stats.items(), key=lambda item: item[1][2],
+                           reverse=True)[:self.top]
+        return [(pstats.func_std_string(func), calls, tottime, cumtime)
+                for func, (unused, calls, tottime, cumtime, unused_callers) in items]
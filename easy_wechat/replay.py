@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+重放防护模块
+在解析XML与AES解密之前, 根据URL参数拒绝格式错误, 时间戳过期以及重放的请求
+已通过验证的请求按时间分桶记录, 微信服务器的重试可以直接由回复缓存应答
+"""
+
+import re
+import time
+import threading
+import collections
+
+# 拒绝原因
+# URL参数格式错误
+MALFORMED = 'malformed'
+# 时间戳超出允许的时间窗口
+STALE = 'stale'
+# 已处理过的请求再次出现, 且无法由回复缓存应答
+REPLAY = 'replay'
+# 签名验证失败, 由调用方在验证后记录
+SIGNATURE = 'signature'
+# XML格式或解密失败, 由调用方在验证后记录
+INVALID = 'invalid'
+
+SIGNATURE_RE = re.compile(r'^[0-9a-f]{40}\Z')
+TIMESTAMP_RE = re.compile(r'^[0-9]{1,12}\Z')
+NONCE_RE = re.compile(r'^[0-9A-Za-z]{1,64}\Z')
+
+
+class ReplayGuard(object):
+    """
+    请求重放防护
+    """
+
+    # 每个时间窗口划分的桶数
+    buckets_per_window = 4
+
+    def __init__(self, window=0, capacity=100000):
+        """
+        构造函数
+        @param window: 允许的时间戳偏差(秒), 为0则只检查参数格式
+        @param capacity: 最多记录的请求数, 超出后丢弃最早的桶
+        @return: ReplayGuard对象实例
+        """
+        self.window = window
+        self.capacity = capacity
+        self.bucket_width = max(float(window) / self.buckets_per_window, 1.0)
+        # 桶编号 -> {(签名, 时间戳, 随机串): 回复缓存键}
+        # 时间戳晚于当前时间的请求记在更晚的桶中, 桶的插入顺序与编号顺序不一定一致
+        self.buckets = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def admit(self, signature, timestamp, nonce, track=True):
+        """
+        检查请求的URL参数, 不做任何解析与解密
+        @param signature: msg_signature参数
+        @param timestamp: timestamp参数
+        @param nonce: nonce参数
+        @param track: 是否检查重放, 验证URL的请求不需要检查
+        @return: (拒绝原因, 回复缓存键), 允许时原因为None,
+                 回复缓存键不为None表示这是已处理过的请求的重试
+        """
+        if not (SIGNATURE_RE.match(signature or '') and TIMESTAMP_RE.match(str(timestamp or ''))
+                and NONCE_RE.match(nonce or '')):
+            return self.reject(MALFORMED), None
+        if not self.window:
+            return None, None
+        now = time.time()
+        if abs(now - int(timestamp)) > self.window:
+            return self.reject(STALE), None
+        if not track:
+            return None, None
+        key = (signature, timestamp, nonce)
+        with self.lock:
+            self.expire(now)
+            for entries in self.buckets.itervalues():
+                if key in entries:
+                    cache_key = entries[key]
+                    if cache_key is None:
+                        self.counters[REPLAY] += 1
+                        return REPLAY, None
+                    self.counters['retries'] += 1
+                    return None, cache_key
+        return None, None
+
+    def remember(self, signature, timestamp, nonce, cache_key=None):
+        """
+        记录已通过签名验证的请求
+        @param signature: msg_signature参数
+        @param timestamp: timestamp参数
+        @param nonce: nonce参数
+        @param cache_key: 该消息的回复缓存键, 为None时再次出现将被视为重放
+        @return: None
+        """
+        if not self.window:
+            return
+        now = time.time()
+        # 时间戳在now + window之内的请求在此之前都可以通过时间窗口检查,
+        # 按max(now, timestamp)分桶, 保证记录保留到时间戳超出窗口为止
+        bucket_id = int(max(now, int(timestamp)) // self.bucket_width)
+        key = (signature, timestamp, nonce)
+        with self.lock:
+            self.expire(now)
+            for entries in self.buckets.itervalues():
+                if key in entries:
+                    entries[key] = cache_key
+                    return
+            entries = self.buckets.get(bucket_id)
+            if entries is None:
+                entries = self.buckets[bucket_id] = {}
+            entries[key] = cache_key
+            self.size += 1
+            while self.size > self.capacity and len(self.buckets) > 1:
+                self.size -= len(self.buckets.pop(min(self.buckets)))
+
+    def expire(self, now):
+        """
+        丢弃超出时间窗口的桶, 调用方需持有锁
+        @param now: 当前时间
+        @return: None
+        """
+        oldest_id = int((now - self.window) // self.bucket_width)
+        for bucket_id in [bucket_id for bucket_id in self.buckets if bucket_id < oldest_id]:
+            self.size -= len(self.buckets.pop(bucket_id))
+
+    def reject(self, reason):
+        """
+        计数并返回拒绝原因
+        @param reason: 拒绝原因
+        @return: 拒绝原因
+        """
+        with self.lock:
+            self.counters[reason] += 1
+        return reason
+
+    def stats(self):
+        """
+        各拒绝原因的计数, 以及由回复缓存应答的重试数
+        @return: dict对象
+        """
+        with self.lock:
+            res = dict((reason, 0) for reason
+                       in (MALFORMED, STALE, REPLAY, SIGNATURE, INVALID, 'retries'))
+            res.update(self.counters)
+            res['tracked'] = self.size
+            return res
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回复去重缓存模块
+微信服务器在5秒内收不到回复时会重试同一条消息, 以MsgId(事件消息以发送者与创建时间)为键
+缓存已加密的回复, 重复的请求直接返回缓存或等待正在处理的请求, 不会再次调用回调函数
+通过可替换的存储后端, 多个工作进程也可以共享同一个缓存
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import collections
+
+# begin的返回状态
+# 首次收到该消息, 调用方负责生成回复并调用finish或abort
+CLAIMED = 0
+# 已有缓存的回复
+CACHED = 1
+# 其他请求正在处理该消息且认领仍然有效, 等待超时仍未完成
+IN_FLIGHT = 2
+
+
+class MemoryReplyStore(object):
+    """
+    进程内的回复存储, 超出容量后淘汰最久未使用的条目
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        构造函数
+        @param capacity: 最多缓存的消息数
+        @return: MemoryReplyStore对象实例
+        """
+        self.capacity = capacity
+        # key -> (reply, expires_at), reply为None表示正在处理
+        self.entries = collections.OrderedDict()
+        self.cond = threading.Condition()
+
+    def claim(self, key, lease):
+        """
+        查找缓存的回复, 不存在时认领该消息
+        @param key: 缓存键
+        @param lease: 认领的有效期(秒), 超时后其他请求可以重新认领
+        @return: (是否认领成功, 缓存的回复), 正在处理时回复为None
+        """
+        now = time.time()
+        with self.cond:
+            entry = self.entries.pop(key, None)
+            if entry and entry[1] > now:
+                self.entries[key] = entry
+                return False, entry[0]
+            self.entries[key] = (None, now + lease)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return True, None
+
+    def put(self, key, reply, ttl):
+        """
+        保存回复并唤醒等待的请求
+        @param key: 缓存键
+        @param reply: 加密后的回复
+        @param ttl: 有效期(秒)
+        @return: None
+        """
+        with self.cond:
+            self.entries.pop(key, None)
+            self.entries[key] = (reply, time.time() + ttl)
+            self.cond.notify_all()
+
+    def release(self, key):
+        """
+        放弃认领, 之后的重试会重新调用回调函数
+        @param key: 缓存键
+        @return: None
+        """
+        with self.cond:
+            entry = self.entries.get(key)
+            if entry and entry[0] is None:
+                del self.entries[key]
+            self.cond.notify_all()
+
+    def wait(self, key, timeout):
+        """
+        等待正在处理的消息生成回复
+        @param key: 缓存键
+        @param timeout: 最长等待时间(秒)
+        @return: 回复, 超时或处理失败时返回None
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                entry = self.entries.get(key)
+                if not entry or entry[0] is not None:
+                    return entry and entry[0]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+
+class SQLiteReplyStore(object):
+    """
+    基于SQLite的回复存储, 同一主机上的多个进程可以共享
+    认领通过BEGIN IMMEDIATE事务保证原子性, 等待时轮询数据库
+    """
+
+    # 等待时轮询数据库的间隔(秒)
+    poll_interval = 0.05
+    # 清理过期条目的间隔(秒)
+    purge_interval = 60
+
+    def __init__(self, path, timeout=30):
+        """
+        构造函数
+        @param path: 数据库文件路径
+        @param timeout: 等待数据库锁的超时时间(秒)
+        @return: SQLiteReplyStore对象实例
+        """
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.last_purge = time.time()
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS replies ('
+                     'key TEXT PRIMARY KEY, reply BLOB, expires_at REAL NOT NULL)')
+
+    def connect(self):
+        """
+        获取当前线程的数据库连接, fork出的子进程不会沿用父进程的连接
+        @return: sqlite3.Connection对象
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def claim(self, key, lease):
+        """
+        查找缓存的回复, 不存在时认领该消息
+        @param key: 缓存键
+        @param lease: 认领的有效期(秒)
+        @return: (是否认领成功, 缓存的回复), 正在处理时回复为None
+        """
+        now = time.time()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT reply, expires_at FROM replies WHERE key = ?',
+                               (key,)).fetchone()
+            if row and row[1] > now:
+                return False, str(row[0]) if row[0] is not None else None
+            conn.execute('INSERT OR REPLACE INTO replies VALUES (?, NULL, ?)', (key, now + lease))
+            return True, None
+        finally:
+            conn.execute('COMMIT')
+
+    def put(self, key, reply, ttl):
+        """
+        保存回复, 并定期清理过期的条目
+        @param key: 缓存键
+        @param reply: 加密后的回复
+        @param ttl: 有效期(秒)
+        @return: None
+        """
+        now = time.time()
+        conn = self.connect()
+        conn.execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?)',
+                     (key, buffer(reply), now + ttl))
+        if now - self.last_purge > self.purge_interval:
+            self.last_purge = now
+            conn.execute('DELETE FROM replies WHERE expires_at < ?', (now,))
+
+    def release(self, key):
+        """
+        放弃认领
+        @param key: 缓存键
+        @return: None
+        """
+        self.connect().execute('DELETE FROM replies WHERE key = ? AND reply IS NULL', (key,))
+
+    def wait(self, key, timeout):
+        """
+        轮询等待正在处理的消息生成回复
+        @param key: 缓存键
+        @param timeout: 最长等待时间(秒)
+        @return: 回复, 超时或处理失败时返回None
+        """
+        deadline = time.time() + timeout
+        conn = self.connect()
+        while True:
+            row = conn.execute('SELECT reply FROM replies WHERE key = ?', (key,)).fetchone()
+            if not row or row[0] is not None:
+                return str(row[0]) if row else None
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+
+class ReplyCache(object):
+    """
+    回复去重缓存
+    """
+
+    def __init__(self, store=None, ttl=300, lease=60, wait_timeout=4.0):
+        """
+        构造函数
+        @param store: 存储后端, 为None则使用进程内存储
+        @param ttl: 回复的缓存时间(秒), 应覆盖微信服务器的重试周期
+        @param lease: 正在处理的消息被认为已失败前的时间(秒)
+        @param wait_timeout: 重复请求等待正在处理的请求的最长时间(秒), 应小于5秒
+        @return: ReplyCache对象实例
+        """
+        self.store = store if store is not None else MemoryReplyStore()
+        self.ttl = ttl
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    @staticmethod
+    def make_key(msg):
+        """
+        生成消息的去重键
+        @param msg: 收到的消息, dict或InboundMessage对象
+        @return: 字符串, 无法确定时返回None
+        """
+        if msg.get('MsgId'):
+            return '%s:msg:%s' % (msg.get('ToUserName'), msg['MsgId'])
+        if msg.get('FromUserName') and msg.get('CreateTime'):
+            return '%s:event:%s:%s' % (msg.get('ToUserName'), msg['FromUserName'],
+                                       msg['CreateTime'])
+        return None
+
+    def begin(self, key):
+        """
+        开始处理一条消息
+        @param key: 去重键
+        @return: (状态, 缓存的回复), 状态为CLAIMED时调用方必须随后调用finish或abort
+        """
+        claimed, reply = self.store.claim(key, self.lease)
+        if not claimed and reply is None:
+            reply = self.store.wait(key, self.wait_timeout)
+            if reply is None:
+                # 正在处理的请求失败并放弃了认领时由本请求重新处理,
+                # 只有其他请求仍持有有效的认领时才返回IN_FLIGHT, 否则空回复会让微信服务器停止重试
+                claimed, reply = self.store.claim(key, self.lease)
+        with self.lock:
+            if claimed:
+                self.misses += 1
+                return CLAIMED, None
+            if reply is None:
+                self.timeouts += 1
+                return IN_FLIGHT, None
+            self.hits += 1
+            return CACHED, reply
+
+    def finish(self, key, reply):
+        """
+        保存生成的回复
+        @param key: 去重键
+        @param reply: 加密后的回复
+        @return: None
+        """
+        self.store.put(key, reply, self.ttl)
+
+    def abort(self, key):
+        """
+        处理失败, 放弃认领
+        @param key: 去重键
+        @return: None
+        """
+        self.store.release(key)
+
+    def stats(self):
+        """
+        命中统计
+        @return: dict对象
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'timeouts': self.timeouts,
+            }
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+生产环境的多进程WSGI服务器模块
+主进程fork出若干工作进程, 每个工作进程以线程池或gevent协程池处理请求
+支持SO_REUSEPORT由内核分发连接, 收到SIGHUP时平滑重启工作进程,
+工作进程处理一定数量的请求后自动退出并由主进程重新创建
+"""
+
+import os
+import time
+import errno
+import random
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+import multiprocessing.pool
+import wsgiref.simple_server
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    不输出访问日志的请求处理类
+    """
+
+    def log_message(self, *args):
+        """
+        不输出访问日志
+        @return: None
+        """
+        pass
+
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    在固定大小的线程池中处理请求的WSGI服务器, 所有线程都繁忙时暂停接受新连接
+    """
+
+    # 每次等待新连接的最长时间(秒), 之后检查是否需要退出
+    timeout = 0.5
+
+    def __init__(self, sock, app, concurrency):
+        """
+        构造函数
+        @param sock: 已经处于监听状态的socket
+        @param app: WSGI应用
+        @param concurrency: 线程数
+        @return: ThreadPoolWSGIServer对象实例
+        """
+        wsgiref.simple_server.WSGIServer.__init__(self, sock.getsockname()[:2], QuietHandler,
+                                                  bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.pool = multiprocessing.pool.ThreadPool(concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def process_request(self, request, client_address):
+        """
+        将请求交给线程池处理
+        @param request: 客户端socket
+        @param client_address: 客户端地址
+        @return: None
+        """
+        self.slots.acquire()
+        self.pool.apply_async(self.process_request_thread, (request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        """
+        在线程池中处理请求
+        @param request: 客户端socket
+        @param client_address: 客户端地址
+        @return: None
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def close(self):
+        """
+        停止接受新连接, 等待正在处理的请求完成
+        @return: None
+        """
+        self.server_close()
+        self.pool.close()
+        self.pool.join()
+
+
+class Worker(object):
+    """
+    工作进程
+    """
+
+    def __init__(self, runner, sock):
+        """
+        构造函数
+        @param runner: Runner对象
+        @param sock: 监听socket, 为None时在工作进程中以SO_REUSEPORT创建
+        @return: Worker对象实例
+        """
+        self.runner = runner
+        self.sock = sock
+        self.alive = True
+        self.handled = 0
+        self.max_requests = runner.max_requests
+        if self.max_requests:
+            # 错开各工作进程的退出时间, 避免同时重启
+            self.max_requests += random.randint(0, runner.max_requests // 10)
+
+    def handle_term(self, signum, frame):
+        """
+        收到SIGTERM后停止接受新连接, 处理完已接受的请求后退出
+        @return: None
+        """
+        self.alive = False
+
+    def app(self, environ, start_response):
+        """
+        统计请求数的WSGI应用, 达到上限后退出
+        @param environ: WSGI环境变量
+        @param start_response: WSGI回调函数
+        @return: 响应内容
+        """
+        self.handled += 1
+        if self.max_requests and self.handled >= self.max_requests:
+            self.alive = False
+        return self.runner.app(environ, start_response)
+
+    def run(self):
+        """
+        工作进程主循环
+        @return: None
+        """
+        signal.signal(signal.SIGTERM, self.handle_term)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if self.sock is None:
+            self.sock = self.runner.create_socket(reuse_port=True)
+        if self.runner.mode == 'gevent':
+            self.run_gevent()
+        else:
+            self.run_threaded()
+
+    def run_threaded(self):
+        """
+        以线程池处理请求
+        @return: None
+        """
+        server = ThreadPoolWSGIServer(self.sock, self.app, self.runner.concurrency)
+        while self.alive:
+            server.handle_request()
+        server.close()
+
+    def run_gevent(self):
+        """
+        以gevent协程池处理请求, 需要安装gevent并在启动前执行monkey.patch_all()
+        @return: None
+        """
+        import gevent
+        import gevent.pool
+        import gevent.pywsgi
+        gevent.reinit()
+        server = gevent.pywsgi.WSGIServer(self.sock, self.app, log=None,
+                                          spawn=gevent.pool.Pool(self.runner.concurrency))
+        server.start()
+        while self.alive:
+            gevent.sleep(self.runner.poll_interval)
+        server.stop(timeout=self.runner.graceful_timeout)
+
+
+class Runner(object):
+    """
+    管理工作进程的主进程
+    """
+
+    # 主进程检查工作进程状态的间隔(秒)
+    poll_interval = 0.5
+    # 监听队列长度
+    backlog = 1024
+
+    def __init__(self, app, mode='prefork', workers=0, concurrency=None, max_requests=0,
+                 graceful_timeout=30, reuse_port=True, logger=None):
+        """
+        构造函数
+        @param app: WSGI应用
+        @param mode: prefork(多进程, 每个进程一个线程池), threaded(单个进程的线程池)或gevent
+        @param workers: 工作进程数, 为0时等于CPU核数, threaded模式固定为1
+        @param concurrency: 每个工作进程同时处理的请求数, 为None时线程池为16, gevent为1000
+        @param max_requests: 工作进程处理多少个请求后重启, 为0则不重启
+        @param graceful_timeout: 停止时等待工作进程处理完请求的最长时间(秒)
+        @param reuse_port: 是否使用SO_REUSEPORT由内核在工作进程间分发连接
+        @param logger: 日志对象
+        @return: Runner对象实例
+        """
+        if mode not in ('prefork', 'threaded', 'gevent'):
+            raise ValueError('Invalid server mode: %s' % mode)
+        self.app = app
+        self.mode = mode
+        if mode == 'threaded':
+            workers = 1
+        self.workers = workers or multiprocessing.cpu_count()
+        self.concurrency = concurrency or (1000 if mode == 'gevent' else 16)
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.logger = logger or logging.getLogger('easy_wechat')
+        self.address = None
+        self.sock = None
+        # pid -> 代数, 每次平滑重启代数加1
+        self.children = {}
+        self.generation = 0
+        self.reload_requested = False
+        self.stop_deadline = None
+
+    def create_socket(self, reuse_port=False, listen=True):
+        """
+        创建监听socket
+        @param reuse_port: 是否设置SO_REUSEPORT
+        @param listen: 是否开始监听
+        @return: socket对象
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        if listen:
+            sock.listen(self.backlog)
+        return sock
+
+    def handle_hup(self, signum, frame):
+        """
+        收到SIGHUP后平滑重启所有工作进程
+        @return: None
+        """
+        self.reload_requested = True
+
+    def handle_stop(self, signum, frame):
+        """
+        收到SIGTERM或SIGINT后停止
+        @return: None
+        """
+        if self.stop_deadline is None:
+            self.stop_deadline = time.time() + self.graceful_timeout
+
+    def serve(self, host, port):
+        """
+        启动工作进程并一直运行到收到SIGTERM或SIGINT
+        @param host: 监听地址
+        @param port: 监听端口
+        @return: None
+        """
+        self.address = (host, port)
+        if self.reuse_port:
+            # 只检查端口是否可用, 由各工作进程各自监听
+            self.create_socket(reuse_port=True, listen=False).close()
+        else:
+            self.sock = self.create_socket()
+        signal.signal(signal.SIGHUP, self.handle_hup)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        self.logger.info('serving on %s:%d with %d %s workers' %
+                         (host, port, self.workers, self.mode))
+        stopping = False
+        while True:
+            self.reap()
+            if self.stop_deadline is not None:
+                if not stopping:
+                    stopping = True
+                    self.kill_workers(self.children.keys(), signal.SIGTERM)
+                if not self.children:
+                    break
+                if time.time() > self.stop_deadline:
+                    self.kill_workers(self.children.keys(), signal.SIGKILL)
+            elif self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            else:
+                self.spawn_missing()
+            time.sleep(self.poll_interval)
+        if self.sock is not None:
+            self.sock.close()
+        self.logger.info('server stopped')
+
+    def reload(self):
+        """
+        先启动新一代工作进程, 再让旧的工作进程处理完请求后退出
+        @return: None
+        """
+        old_workers = self.children.keys()
+        self.generation += 1
+        self.logger.info('reloading %d workers' % len(old_workers))
+        self.spawn_missing()
+        self.kill_workers(old_workers, signal.SIGTERM)
+
+    def spawn_missing(self):
+        """
+        补足当前代的工作进程
+        @return: None
+        """
+        current = sum(1 for generation in self.children.values()
+                      if generation == self.generation)
+        for unused in range(self.workers - current):
+            self.spawn()
+
+    def spawn(self):
+        """
+        fork一个工作进程
+        @return: None
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return
+        code = 0
+        try:
+            Worker(self, self.sock).run()
+        except Exception as e:
+            self.logger.exception('worker %d crashed: %s' % (os.getpid(), e))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        """
+        回收已退出的工作进程
+        @return: None
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if self.children.pop(pid, None) is not None and status:
+                self.logger.error('worker %d exited with status %d' % (pid, status))
+
+    def kill_workers(self, pids, sig):
+        """
+        向工作进程发送信号
+        @param pids: 工作进程pid列表
+        @param sig: 信号
+        @return: None
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+后台消息发送模块单元测试
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import easy_wechat
+import easy_wechat.dispatcher as dispatcher
+import easy_wechat.outbox as outbox
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    令牌桶与每日配额测试类
+    """
+    def test_reserve(self):
+        """
+        测试令牌不足时按照速率计算等待时间
+        @return: None
+        """
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            bucket = dispatcher.TokenBucket(rate=2, capacity=2)
+            self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+        with mock.patch('time.time', return_value=now + 0.5):
+            self.assertEqual(bucket.reserve(), 1.0)
+            bucket.pause(10)
+            self.assertEqual(bucket.reserve(), 10.5)
+
+    def test_budget(self):
+        """
+        测试每日配额
+        @return: None
+        """
+        budget = dispatcher.DailyBudget(2)
+        self.assertTrue(budget.take())
+        self.assertTrue(budget.take())
+        self.assertFalse(budget.take())
+        budget.refund()
+        self.assertEqual(budget.remaining, 1)
+        self.assertIsNone(dispatcher.DailyBudget(0).remaining)
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    后台发送器测试类
+    """
+    def setUp(self):
+        """
+        创建客户端, 并使用独立的令牌桶与配额
+        @return: None
+        """
+        self.client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+        self.client.CorpID = 'corp-%s' % self.id()
+        self.release = threading.Event()
+        self.sent = []
+
+        def send_media(*args):
+            """
+            模拟发送消息, 等待测试用例放行
+            """
+            self.release.wait(5)
+            self.sent.append(args[2])
+            return {'errcode': 0, 'errmsg': 'ok'}
+
+        self.patcher = mock.patch.object(self.client, 'send_media', side_effect=send_media)
+        self.patcher.start()
+
+    def tearDown(self):
+        """
+        停止mock
+        @return: None
+        """
+        self.patcher.stop()
+
+    def test_enqueue(self):
+        """
+        测试队列满时丢弃消息并计数, 放行后全部发送
+        @return: None
+        """
+        sender = dispatcher.Dispatcher(self.client, workers=1, queue_size=3,
+                                       rate=6000, burst=10, daily_budget=100)
+        results = [sender.enqueue('text', {'content': 'hello'}, 'user%d' % i) for i in range(6)]
+        # 一条消息已被工作线程取出, 队列中最多还有3条
+        self.assertEqual(results.count(False), sender.stats()['dropped'])
+        self.assertGreaterEqual(results.count(False), 2)
+        self.release.set()
+        sender.join()
+        sender.close()
+        stats = sender.stats()
+        self.assertEqual(stats['sent'], results.count(True))
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['budget_remaining'], 100 - results.count(True))
+
+    def test_budget(self):
+        """
+        测试超出每日配额时拒绝入队
+        @return: None
+        """
+        self.release.set()
+        sender = dispatcher.Dispatcher(self.client, workers=2, queue_size=10,
+                                       rate=6000, burst=10, daily_budget=3)
+        results = [sender.enqueue('text', {'content': 'hello'}, 'user%d' % i) for i in range(5)]
+        sender.close()
+        self.assertEqual(results, [True] * 3 + [False] * 2)
+        self.assertEqual(sender.stats()['over_budget'], 2)
+        self.assertEqual(sorted(self.sent), ['user0', 'user1', 'user2'])
+
+    def test_budget_per_recipient(self):
+        """
+        测试配额按接收者人次扣除, 发送失败与无效用户归还配额
+        @return: None
+        """
+        self.patcher.stop()
+        results = [{'errcode': 0, 'errmsg': 'ok', 'invaliduser': 'c'},
+                   {'errcode': 40003, 'errmsg': 'invalid userid'}]
+        self.patcher = mock.patch.object(self.client, 'send_media',
+                                         side_effect=lambda *args: results.pop(0))
+        self.patcher.start()
+        sender = dispatcher.Dispatcher(self.client, workers=1, queue_size=10,
+                                       rate=6000, burst=10, daily_budget=10)
+        self.assertTrue(sender.enqueue('text', {'content': 'hello'}, 'a|b|c', [1, 2]))
+        sender.join()
+        # 5个接收者, 其中1个用户无效
+        self.assertEqual(sender.stats()['budget_remaining'], 6)
+        self.assertFalse(sender.enqueue('text', {'content': 'hello'},
+                                        '|'.join('u%d' % i for i in range(7))))
+        self.assertTrue(sender.enqueue('text', {'content': 'hello'}, 'd|e', totag='1'))
+        sender.join()
+        # 发送失败, 归还全部配额
+        self.assertEqual(sender.stats()['budget_remaining'], 6)
+        self.assertEqual(sender.stats()['failed'], 1)
+        with mock.patch.object(self.client, 'send_media', side_effect=IOError('broken')):
+            sender.enqueue('text', {'content': 'hello'}, 'f')
+            sender.join()
+        self.assertEqual(sender.stats()['budget_remaining'], 6)
+        sender.close()
+
+    def test_outbox(self):
+        """
+        测试配置了发件箱时, 频率超限的消息只由发件箱投递一次
+        @return: None
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            client.CorpID = 'corp-%s-outbox' % self.id()
+            client.outbox = outbox.Outbox(client, os.path.join(tmp_dir, 'outbox.db'), start=False)
+            sender = dispatcher.Dispatcher(client, workers=0, rate=6000, burst=10,
+                                           daily_budget=10)
+            sender.freq_limit_backoff = 0
+            with mock.patch.object(client, 'post_message', side_effect=[
+                    {'errcode': 45009, 'errmsg': 'freq limit'},
+                    {'errcode': 0, 'errmsg': 'ok'}]) as post:
+                sender.send('text', {'content': 'hello'}, 'user', '', '', None, 1)
+                self.assertEqual(post.call_count, 1)
+                conn = client.outbox.connect()
+                client.outbox.deliver_due(conn)
+                conn.close()
+                self.assertEqual(post.call_count, 2)
+            self.assertEqual(sender.stats()['outboxed'], 1)
+            self.assertEqual(client.outbox.stats()['sent'], 1)
+            client.outbox.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_mismatched_settings(self):
+        """
+        测试同一个应用与企业号的发送器设置不一致时抛出异常
+        @return: None
+        """
+        sender = dispatcher.Dispatcher(self.client, workers=1, rate=60, burst=10,
+                                       daily_budget=100)
+        self.assertRaises(ValueError, dispatcher.Dispatcher, self.client, workers=1,
+                          rate=120, burst=10, daily_budget=100)
+        self.assertRaises(ValueError, dispatcher.Dispatcher, self.client, workers=1,
+                          rate=60, burst=10, daily_budget=200)
+        dispatcher.Dispatcher(self.client, workers=1, rate=60, burst=10,
+                              daily_budget=100).close()
+        sender.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回调函数执行器单元测试
+"""
+
+import os
+import threading
+import unittest
+
+import mock
+
+import easy_wechat
+import easy_wechat.executor as executor
+from easy_wechat.test.test_wechat import RECV_DATA
+from easy_wechat.test.test_wechat import RECV_PARAMS
+
+
+def reply_pid(param):
+    """
+    进程池中执行的回调函数, 回复执行进程的pid
+    @param param: 输入参数
+    @return: 返回参数
+    """
+    param['Content'] = str(os.getpid())
+    return param
+
+
+def fail(param):
+    """
+    抛出异常的回调函数
+    @param param: 输入参数
+    @return: None
+    """
+    raise ValueError(param)
+
+
+class TestExecutor(unittest.TestCase):
+    """
+    回调函数执行器测试类
+    """
+
+    def test_inline(self):
+        """
+        测试直接执行时异常会被重新抛出, 并计入统计
+        @return: None
+        """
+        inline = executor.create_executor('inline')
+        self.assertEqual(inline.submit(len, 'abc').get(), 3)
+        self.assertRaises(ValueError, inline.submit(fail, 'x').get)
+        stats = inline.stats()
+        self.assertEqual((stats['completed'], stats['failed'], stats['pending']), (2, 1, 0))
+
+    def test_queue_bound(self):
+        """
+        测试排队数达到上限时拒绝新任务
+        @return: None
+        """
+        release = threading.Event()
+        done = []
+        pool = executor.create_executor('thread:1:2')
+        handles = [pool.submit(lambda unused: release.wait(5), None,
+                               lambda ok, value: done.append(ok)) for unused in range(2)]
+        self.assertRaises(executor.QueueFull, pool.submit, len, 'abc')
+        self.assertEqual(pool.stats()['pending'], 2)
+        release.set()
+        for handle in handles:
+            handle.get(5)
+        pool.close()
+        stats = pool.stats()
+        self.assertEqual(done, [True, True])
+        self.assertEqual((stats['completed'], stats['rejected'], stats['pending']), (2, 1, 0))
+        self.assertGreater(stats['avg_latency'], 0)
+
+    def test_process(self):
+        """
+        测试进程池中执行回调函数
+        @return: None
+        """
+        pool = executor.create_executor('process:2')
+        try:
+            res = pool.submit(reply_pid, easy_wechat.InboundMessage('<xml><Content>x</Content></xml>')).get(10)
+            self.assertNotEqual(res['Content'], str(os.getpid()))
+            self.assertRaises(ValueError, pool.submit(fail, 'x').get, 10)
+        finally:
+            pool.close()
+
+    def test_invalid_spec(self):
+        """
+        测试无效的执行器描述
+        @return: None
+        """
+        self.assertRaises(ValueError, executor.create_executor, 'fiber:2')
+        self.assertEqual(executor.create_executor('thread:3').workers, 3)
+
+    def test_server(self):
+        """
+        测试每种消息类型使用各自的执行器
+        @return: None
+        """
+        with mock.patch('flask.request') as mock_request:
+            type(mock_request).method = mock.PropertyMock(return_value='POST')
+            type(mock_request).args = mock.PropertyMock(return_value=RECV_PARAMS)
+            type(mock_request).data = mock.PropertyMock(return_value=RECV_DATA)
+            server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+            server.reply_cache = None
+            pool = executor.ProcessExecutor(workers=1)
+            try:
+                server.register_callback('text', reply_pid, executor=pool)
+                server.register_callback('image', reply_pid)
+                self.assertIn('<Encrypt>', server.callback().data)
+            finally:
+                pool.close()
+            stats = server.executor_stats()
+            self.assertEqual(stats['text']['kind'], 'process')
+            self.assertEqual(stats['text']['completed'], 1)
+            self.assertEqual(stats['image']['kind'], 'inline')
+
+    def test_server_rejected(self):
+        """
+        测试执行器已满时返回503
+        @return: None
+        """
+        release = threading.Event()
+        with mock.patch('flask.request') as mock_request:
+            type(mock_request).method = mock.PropertyMock(return_value='POST')
+            type(mock_request).args = mock.PropertyMock(return_value=RECV_PARAMS)
+            type(mock_request).data = mock.PropertyMock(return_value=RECV_DATA)
+            server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+            server.reply_cache = None
+            pool = executor.ThreadExecutor(workers=1, max_pending=1)
+            server.register_callback('text', reply_pid, executor=pool)
+            handle = pool.submit(lambda unused: release.wait(5), None)
+            try:
+                server.callback()
+            except Exception as e:
+                self.assertEqual(getattr(e, 'code', None), 503)
+            else:
+                self.fail('expected 503')
+            finally:
+                release.set()
+            handle.get(5)
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
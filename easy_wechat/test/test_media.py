@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+多媒体素材模块单元测试
+"""
+
+import os
+import cgi
+import time
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import easy_wechat
+import easy_wechat.media as media
+import easy_wechat.token_cache as token_cache
+from easy_wechat.test.test_wechat import FakeQyapiServer
+
+
+class TestMediaCache(unittest.TestCase):
+    """
+    素材缓存测试类
+    """
+    def setUp(self):
+        """
+        创建临时目录
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lru(self):
+        """
+        测试超出容量时淘汰最久未使用的素材
+        @return: None
+        """
+        cache = media.MediaCache(capacity=2)
+        cache.put('a', 'media-a')
+        cache.put('b', 'media-b')
+        self.assertEqual(cache.get('a')[0], 'media-a')
+        cache.put('c', 'media-c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a')[0], 'media-a')
+        self.assertEqual(cache.get('c')[0], 'media-c')
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_expire(self):
+        """
+        测试超过临时素材有效期后缓存失效
+        @return: None
+        """
+        cache = media.MediaCache()
+        cache.put('a', 'media-a', created_at=str(int(time.time())))
+        cache.put('b', 'media-b', created_at=time.time() - 3 * 24 * 3600)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_index(self):
+        """
+        测试磁盘索引在重启后依然有效
+        @return: None
+        """
+        index_path = os.path.join(self.tmp_dir, 'media.json')
+        cache = media.MediaCache(index_path=index_path)
+        cache.put('a', 'media-a')
+        cache.put('b', 'media-b', created_at=time.time() - 3 * 24 * 3600)
+        cache = media.MediaCache(index_path=index_path)
+        self.assertEqual(cache.get('a')[0], 'media-a')
+        self.assertIsNone(cache.get('b'))
+
+    def test_client_upload(self):
+        """
+        测试相同内容的素材只上传一次
+        @return: None
+        """
+        file_path = os.path.join(self.tmp_dir, 'image.jpg')
+        with open(file_path, 'wb') as fid:
+            fid.write('\xff\xd8' + os.urandom(1024))
+        server = FakeQyapiServer()
+        try:
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            client.api_url = server.url
+            client.token_cache = token_cache.TokenCache()
+            first = client.upload_media('image', file_path)
+            second = client.upload_media('image', file_path)
+            self.assertEqual(first['media_id'], second['media_id'])
+            self.assertTrue(second['cached'])
+            self.assertEqual(server.count('/cgi-bin/media/upload'), 1)
+            with open(file_path, 'ab') as fid:
+                fid.write('changed')
+            client.upload_media('image', file_path)
+            self.assertEqual(server.count('/cgi-bin/media/upload'), 2)
+            self.assertEqual(client.upload_media('image', '/no/such/file')['errcode'], -1)
+            # 内存中的相同内容与文件共用缓存
+            with open(file_path, 'rb') as fid:
+                content = fid.read()
+            self.assertTrue(client.upload_media('image', data=memoryview(content))['cached'])
+            self.assertTrue(client.upload_media('image', data=StringIO.StringIO(content))['cached'])
+            self.assertEqual(server.count('/cgi-bin/media/upload'), 2)
+        finally:
+            server.stop()
+
+
+
+class TestMultipartEncoder(unittest.TestCase):
+    """
+    流式multipart编码器测试类
+    """
+    def setUp(self):
+        """
+        创建临时文件
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'video.mp4')
+        self.content = os.urandom(300 * 1024)
+        with open(self.file_path, 'wb') as fid:
+            fid.write(self.content)
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def parse(self, body, content_type):
+        """
+        使用cgi模块解析multipart请求体
+        @param body: 请求体
+        @param content_type: 请求的Content-Type
+        @return: 上传的文件字段
+        """
+        form = cgi.FieldStorage(fp=StringIO.StringIO(body), environ={
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(body)),
+        })
+        return form['file']
+
+    def test_encode(self):
+        """
+        测试分块读取的请求体与预先计算的长度一致, 且能够被正确解析
+        @return: None
+        """
+        progress = []
+        with media.MultipartEncoder.from_path(
+                self.file_path, progress=lambda sent, total: progress.append((sent, total))) \
+                as encoder:
+            chunks = list(iter(lambda: encoder.read(8192), ''))
+        self.assertTrue(encoder.fileobj.closed)
+        body = ''.join(chunks)
+        self.assertEqual(len(body), len(encoder))
+        self.assertEqual(progress[-1], (len(body), len(body)))
+        self.assertEqual(len(progress), len(chunks))
+        field = self.parse(body, encoder.content_type)
+        self.assertEqual(field.filename, 'video.mp4')
+        self.assertEqual(field.type, 'video/mp4')
+        self.assertEqual(field.value, self.content)
+
+    def test_client_upload(self):
+        """
+        测试客户端流式上传并报告进度
+        @return: None
+        """
+        progress = []
+        server = FakeQyapiServer()
+        try:
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            client.api_url = server.url
+            client.media_cache = None
+            client.token_cache = token_cache.TokenCache()
+            res = client.upload_media('video', self.file_path,
+                                      progress=lambda sent, total: progress.append(sent))
+        finally:
+            server.stop()
+        self.assertIn('media_id', res)
+        self.assertEqual(progress[-1], int(res['media_id'].split('-')[1]))
+        body = [req[1] for req in server.requests if req[0] == '/cgi-bin/media/upload'][0]
+        self.assertIn('filelength=%d' % len(self.content), body)
+        self.assertIn(self.content, body)
+
+    def test_upload_data(self):
+        """
+        测试直接上传内存数据, 文件对象与分块迭代器
+        @return: None
+        """
+        sources = [
+            self.content,
+            bytearray(self.content),
+            memoryview(self.content),
+            StringIO.StringIO(self.content),
+            (self.content[i:i + 1000] for i in range(0, len(self.content), 1000)),
+        ]
+        server = FakeQyapiServer()
+        try:
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            client.api_url = server.url
+            client.media_cache = None
+            client.token_cache = token_cache.TokenCache()
+            for data in sources:
+                res = client.upload_media('video', data=data, filename=u'监控.mp4',
+                                          mimetype='video/mp4')
+                self.assertIn('media_id', res)
+            res = client.upload_media('image', data='\xff\xd8', mimetype='image/jpeg')
+            self.assertIn('media_id', res)
+            self.assertEqual(client.upload_media('image')['errcode'], -1)
+        finally:
+            server.stop()
+        bodies = [req[1] for req in server.requests if req[0] == '/cgi-bin/media/upload']
+        self.assertEqual(len(bodies), 6)
+        for body in bodies[:5]:
+            self.assertIn('filename="监控.mp4"', body)
+            self.assertIn('Content-Type: video/mp4', body)
+            self.assertIn(self.content, body)
+        self.assertIn('filelength=%d' % len(self.content), bodies[3])
+        self.assertNotIn('filelength', bodies[4])
+        self.assertIn('filename="media.jp', bodies[5])
+
+    def test_upload_many(self):
+        """
+        测试并发上传并发送, 结果顺序与输入一致且单个失败不影响其他素材
+        @return: None
+        """
+        items = [('video', self.file_path), ('image', '/no/such/file'),
+                 {'file_type': 'image', 'data': '\xff\xd8' * 10, 'filename': 'a.jpg'},
+                 ('file', self.file_path)]
+        server = FakeQyapiServer()
+        try:
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            client.api_url = server.url
+            client.media_cache = None
+            client.token_cache = token_cache.TokenCache()
+            results = client.upload_many(items, max_workers=4, touser='FinalTheory')
+            self.assertEqual(client.upload_many([]), [])
+        finally:
+            server.stop()
+        self.assertEqual([res.get('errcode') for res in results], [None, -1, None, None])
+        # 模拟服务器以请求体长度作为media_id, 可据此确认结果顺序
+        self.assertLess(int(results[2]['media_id'][6:]), int(results[0]['media_id'][6:]))
+        self.assertEqual(results[0]['send']['errcode'], 0)
+        self.assertNotIn('send', results[1])
+        self.assertEqual(server.count('/cgi-bin/gettoken'), 1)
+        self.assertEqual(server.count('/cgi-bin/media/upload'), 3)
+        self.assertEqual(server.count('/cgi-bin/message/send'), 3)
+
+    def test_memory_reader(self):
+        """
+        测试内存数据按块读取且不关闭调用方的文件对象
+        @return: None
+        """
+        reader, size = media.open_data(memoryview(self.content))
+        self.assertEqual(size, len(self.content))
+        self.assertEqual(''.join(iter(lambda: reader.read(7000), '')), self.content)
+        fileobj = StringIO.StringIO(self.content)
+        fileobj.read(100)
+        with media.MultipartEncoder.from_data(fileobj, 'video.mp4') as encoder:
+            body = encoder.read()
+        self.assertFalse(fileobj.closed)
+        self.assertEqual(len(body), len(encoder))
+        self.assertEqual(self.parse(body, encoder.content_type).value, self.content[100:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回调消息对象单元测试
+"""
+
+import pickle
+import unittest
+import collections
+
+import easy_wechat.utils as utils
+import easy_wechat.message as message
+
+
+class TestMessage(unittest.TestCase):
+    """
+    回调消息对象测试类
+    """
+    xml_string = '''<xml>
+    <ToUserName><![CDATA[mycreate]]></ToUserName>
+    <FromUserName><![CDATA[wx5823bf96d3bd56c7]]></FromUserName>
+    <CreateTime>1348831860</CreateTime>
+    <MsgType><![CDATA[text]]></MsgType>
+    <Content><![CDATA[拍照]]></Content>
+    <MsgId>1234567890123456</MsgId>
+    <AgentID>128</AgentID>
+    </xml>'''
+
+    def test_inbound(self):
+        """
+        测试收到的消息在首次访问时才解析, 并且与xml_to_dict的结果一致
+        @return: None
+        """
+        inbound = message.InboundMessage(self.xml_string)
+        self.assertIsNone(inbound.fields)
+        self.assertEqual(inbound.msg_type, 'text')
+        self.assertIsNotNone(inbound.fields)
+        self.assertEqual(inbound, utils.xml_to_dict(self.xml_string))
+        self.assertIn(u'拍照', inbound['Content'])
+        self.assertEqual(inbound.get('Missing', 'x'), 'x')
+        self.assertIsInstance(inbound, collections.Mapping)
+        self.assertFalse(hasattr(inbound, '__dict__'))
+        with self.assertRaises(TypeError):
+            inbound['Content'] = 'x'
+
+    def test_copy(self):
+        """
+        测试复制出的dict可以修改, 不会影响收到的消息, 序列化时也转换为dict
+        @return: None
+        """
+        inbound = message.InboundMessage(self.xml_string)
+        reply = inbound.copy()
+        reply['Content'] = 'hello, world'
+        del reply['MsgId']
+        self.assertIs(type(reply), dict)
+        self.assertEqual(inbound['Content'], u'拍照')
+        self.assertIn('MsgId', inbound)
+        self.assertEqual(pickle.loads(pickle.dumps(inbound)), inbound)
+        self.assertIs(type(pickle.loads(pickle.dumps(inbound))), dict)
+
+    def test_serialize(self):
+        """
+        测试收到的消息可以直接序列化为XML
+        @return: None
+        """
+        inbound = message.InboundMessage(self.xml_string)
+        self.assertEqual(utils.xml_to_dict(utils.dict_to_xml(inbound)), inbound.copy())
+
+
+if __name__ == '__main__':
+    unittest.main()
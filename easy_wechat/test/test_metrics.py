@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+耗时统计单元测试
+"""
+
+import urllib
+import unittest
+
+import werkzeug.test
+import werkzeug.wrappers
+
+import easy_wechat
+import easy_wechat.metrics as metrics
+from easy_wechat.test.test_wechat import RECV_DATA
+from easy_wechat.test.test_wechat import RECV_PARAMS
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    耗时统计测试类
+    """
+
+    def test_histogram(self):
+        """
+        测试分桶计数与文本格式
+        @return: None
+        """
+        registry = metrics.Registry(buckets=(0.1, 1.0))
+        histogram = registry.histogram('test_seconds', 'Test histogram', stage='a"b')
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertIs(registry.histogram('test_seconds', stage='a"b'), histogram)
+        self.assertEqual(histogram.snapshot(), ([2, 3, 4], 2.65, 4))
+        text = registry.render([lambda: [('test_total', 'counter', 'Test counter',
+                                          [({'reason': 'x'}, 3)])]])
+        self.assertIn('# HELP test_seconds Test histogram\n# TYPE test_seconds histogram\n', text)
+        self.assertIn('test_seconds_bucket{stage="a\\"b",le="0.1"} 2\n', text)
+        self.assertIn('test_seconds_bucket{stage="a\\"b",le="+Inf"} 4\n', text)
+        self.assertIn('test_seconds_count{stage="a\\"b"} 4\n', text)
+        self.assertIn('test_total{reason="x"} 3.0\n', text)
+
+    def test_timer(self):
+        """
+        测试抛出异常时同样记录耗时
+        @return: None
+        """
+        histogram = metrics.Histogram()
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        self.assertEqual(histogram.snapshot()[2], 1)
+
+    def test_flask_app(self):
+        """
+        测试经过Flask应用的请求同样记录总耗时
+        @return: None
+        """
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.metrics = metrics.Registry()
+        server.register_callback('text', lambda param: param)
+        client = server.app.test_client()
+        client.post('/weixin?' + urllib.urlencode(RECV_PARAMS), data=RECV_DATA)
+        client.get('/weixin')
+        werkzeug.test.Client(server.wsgi_app).open('/weixin', method='BREW')
+        data = client.get('/weixin/metrics').data
+        self.assertIn('wechat_server_request_seconds_count{method="POST",status="200"} 1\n', data)
+        self.assertIn('wechat_server_request_seconds_count{method="GET",status="403"} 1\n', data)
+        self.assertIn('wechat_server_request_seconds_count{method="other",status="405"} 1\n', data)
+        self.assertNotIn('BREW', data)
+
+    def test_server(self):
+        """
+        测试指标接口包含各处理阶段的耗时
+        @return: None
+        """
+        def reply_func(param):
+            """
+            回复hello, world
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            param['Content'] = 'hello, world'
+            return param
+
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.register_callback('text', reply_func)
+        client = werkzeug.test.Client(server.wsgi_app, werkzeug.wrappers.BaseResponse)
+        client.post('/weixin?' + urllib.urlencode(RECV_PARAMS), data=RECV_DATA)
+        for app in (server.wsgi_app, server.app):
+            res = werkzeug.test.Client(app, werkzeug.wrappers.BaseResponse).get('/weixin/metrics')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['Content-Type'], metrics.CONTENT_TYPE)
+            for stage in ('decrypt', 'parse', 'serialize', 'encrypt'):
+                self.assertIn('wechat_server_stage_seconds_count{stage="%s"}' % stage, res.data)
+            self.assertIn('wechat_server_callback_seconds_count{msg_type="text"}', res.data)
+            self.assertIn('wechat_server_request_seconds_count{method="POST",status="200"}',
+                          res.data)
+            self.assertIn('wechat_executor_completed_total{msg_type="text"}', res.data)
+            self.assertIn('wechat_replay_rejections_total{reason="malformed"}', res.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+持久化发件箱单元测试
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import mock
+import requests
+
+import easy_wechat
+import easy_wechat.outbox as outbox
+
+
+class TestOutbox(unittest.TestCase):
+    """
+    发件箱测试类
+    """
+    def setUp(self):
+        """
+        创建临时数据库路径与模拟的客户端
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'outbox.db')
+        self.client = mock.Mock()
+        self.client.send_media.return_value = {'errcode': 0, 'errmsg': 'ok'}
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for(self, box, state, count, timeout=10):
+        """
+        等待某个状态的消息数达到指定值
+        @return: None
+        """
+        deadline = time.time() + timeout
+        while box.stats()[state] < count and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(box.stats()[state], count)
+
+    def test_batch_deliver(self):
+        """
+        测试大量消息批量写入并全部投递
+        @return: None
+        """
+        box = outbox.Outbox(self.client, self.path)
+        for i in range(3000):
+            box.put('text', {'content': 'hello'}, 'user%d' % i)
+        self.assertTrue(box.flush(10))
+        self.wait_for(box, 'sent', 3000)
+        box.close()
+        self.assertEqual(self.client.send_media.call_count, 3000)
+
+    def test_retry(self):
+        """
+        测试可重试的错误会退避重试, 其他错误直接放弃
+        @return: None
+        """
+        self.client.send_media.side_effect = [
+            {'errcode': -1, 'errmsg': 'timeout'},
+            {'errcode': 45009, 'errmsg': 'freq limit'},
+            {'errcode': 0, 'errmsg': 'ok'},
+            {'errcode': 40003, 'errmsg': 'invalid userid'},
+        ]
+        box = outbox.Outbox(self.client, self.path, poll_interval=0.01, start=False)
+        box.base_delay = 0.01
+        box.put('text', {'content': 'hello'}, 'user', key='first')
+        box.start()
+        self.wait_for(box, 'sent', 1)
+        box.put('text', {'content': 'hello'}, 'nobody', key='second')
+        self.wait_for(box, 'dead', 1)
+        box.close()
+        self.assertEqual(self.client.send_media.call_count, 4)
+        self.assertTrue(0.005 <= box.backoff(1) <= 0.01)
+
+    def test_resume(self):
+        """
+        测试重启后继续投递, 且相同幂等键的消息只投递一次
+        @return: None
+        """
+        box = outbox.Outbox(self.client, self.path, start=False)
+        box.put('text', {'content': 'hello'}, 'user1', key='a')
+        box.put('text', {'content': 'hello'}, 'user1', key='a')
+        box.put('text', {'content': 'hello'}, 'user2', key='b')
+        box.close()
+        self.assertEqual(self.client.send_media.call_count, 0)
+
+        box = outbox.Outbox(self.client, self.path)
+        self.wait_for(box, 'sent', 2)
+        box.put('text', {'content': 'hello'}, 'user1', key='a')
+        box.flush(5)
+        box.close()
+        self.assertEqual(self.client.send_media.call_count, 2)
+        self.assertEqual(box.stats()['pending'], 0)
+
+    def test_client_queue_on_failure(self):
+        """
+        测试客户端发送失败时消息被放入发件箱
+        @return: None
+        """
+        client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+        client.outbox = outbox.Outbox(client, self.path, start=False)
+        with mock.patch.object(client, 'get_token', return_value='token'):
+            with mock.patch('requests.Session.post',
+                            side_effect=requests.ConnectionError('connection refused')):
+                res = client.send_media('text', {'content': 'hello'}, 'FinalTheory')
+                self.assertEqual(res['errcode'], -1)
+                self.assertIn('outbox_key', res)
+                res = client.send_media('text', {'content': 'hello'}, 'FinalTheory',
+                                        queue_on_failure=False)
+                self.assertNotIn('outbox_key', res)
+        client.outbox.close()
+        self.assertEqual(client.outbox.stats()['pending'], 1)
+
+    def test_client_key(self):
+        """
+        测试以相同的幂等键重复发送时, 已在发件箱中的消息不会再次发送或放入发件箱
+        @return: None
+        """
+        client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+        client.outbox = outbox.Outbox(client, self.path, start=False)
+        with mock.patch.object(client, 'get_token', return_value='token'):
+            with mock.patch('requests.Session.post',
+                            side_effect=requests.ConnectionError('connection refused')) as post:
+                for unused in range(2):
+                    res = client.send_media('text', {'content': 'hello'}, 'FinalTheory',
+                                            key='alarm-1')
+                    self.assertEqual((res['errcode'], res['outbox_key']), (-1, 'alarm-1'))
+                self.assertEqual(post.call_count, 1)
+        self.assertEqual(client.outbox.lookup('alarm-1'), outbox.STATE_PENDING)
+        self.assertIsNone(client.outbox.lookup('alarm-2'))
+        client.outbox.close()
+        self.assertEqual(client.outbox.stats()['pending'], 1)
+
+    def test_durable_put(self):
+        """
+        测试durable=True时put返回前消息已提交到数据库
+        @return: None
+        """
+        box = outbox.Outbox(self.client, self.path, flush_interval=10, poll_interval=10)
+        box.put('text', {'content': 'hello'}, 'user', key='a', durable=True)
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(conn.execute('SELECT key FROM outbox').fetchall(), [('a',)])
+        finally:
+            conn.close()
+        box.close()
+
+
+    def test_durable_timeout(self):
+        """
+        测试持续写入失败时durable=True的put在超时后撤回消息, send_media按发送失败返回
+        @return: None
+        """
+        client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+        client.outbox = outbox.Outbox(client, self.path, flush_interval=0.01,
+                                      poll_interval=10, durable_timeout=0.1)
+        with mock.patch.object(client.outbox, 'write_batch',
+                               side_effect=sqlite3.OperationalError('disk I/O error')):
+            self.assertRaises(outbox.OutboxTimeout, client.outbox.put, 'text',
+                              {'content': 'hello'}, 'user', key='a', durable=True)
+            with mock.patch.object(client, 'post_message',
+                                   return_value={'errcode': 45009, 'errmsg': 'freq limit'}):
+                res = client.send_media('text', {'content': 'hello'}, 'user', key='b')
+            self.assertEqual(res['errcode'], 45009)
+            self.assertNotIn('outbox_key', res)
+        self.assertTrue(client.outbox.flush(1))
+        client.outbox.close()
+        self.assertEqual(client.outbox.stats()['pending'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
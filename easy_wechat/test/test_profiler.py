@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求采样分析单元测试
+"""
+
+import os
+import glob
+import time
+import pstats
+import shutil
+import urllib
+import tempfile
+import unittest
+
+import easy_wechat
+import easy_wechat.profiler as profiler
+from easy_wechat.test.test_wechat import RECV_DATA
+from easy_wechat.test.test_wechat import RECV_PARAMS
+
+
+def busy_loop(count):
+    """
+    被分析的函数
+    @param count: 循环次数
+    @return: 求和结果
+    """
+    return sum(xrange(count))
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    请求采样分析测试类
+    """
+
+    def setUp(self):
+        """
+        创建临时目录
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def profiles(self):
+        """
+        @return: 目录中的分析结果文件列表
+        """
+        return sorted(glob.glob(os.path.join(self.tmp_dir, '*.prof')))
+
+    def test_every(self):
+        """
+        测试每N个请求分析一个, 并只保留最新的文件
+        @return: None
+        """
+        request_profiler = profiler.RequestProfiler(self.tmp_dir, every=2, keep=2)
+        results = [request_profiler.call(busy_loop, 1000) for unused in range(6)]
+        self.assertEqual(results, [499500] * 6)
+        self.assertEqual(request_profiler.saved, 3)
+        self.assertEqual(len(self.profiles()), 2)
+        # 保存的是标准的pstats格式
+        self.assertTrue(pstats.Stats(self.profiles()[-1]).stats)
+        summary = request_profiler.summary()
+        self.assertTrue(any('busy_loop' in item[0] for item in summary))
+        with open(os.path.join(self.tmp_dir, 'summary-%d.txt' % os.getpid())) as summary_file:
+            content = summary_file.read()
+        self.assertIn('3 profiles saved from 6 requests', content)
+        self.assertIn('busy_loop', content)
+
+    def test_slow(self):
+        """
+        测试只保存耗时超过阈值的请求
+        @return: None
+        """
+        request_profiler = profiler.RequestProfiler(self.tmp_dir, slow_ms=50)
+        request_profiler.call(busy_loop, 10)
+        request_profiler.call(time.sleep, 0.06)
+        self.assertEqual(len(self.profiles()), 1)
+        self.assertIn('ms.prof', self.profiles()[0])
+
+    def test_server(self):
+        """
+        测试服务器未启用时不创建分析器, 启用后分析经过Flask应用的回复流程
+        @return: None
+        """
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        self.assertIsNone(server.profiler)
+        server.profiler = profiler.RequestProfiler(self.tmp_dir)
+        server.register_callback('text', lambda param: param)
+        res = server.app.test_client().post('/weixin?' + urllib.urlencode(RECV_PARAMS),
+                                            data=RECV_DATA)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(self.profiles()), 1)
+        stats = pstats.Stats(self.profiles()[0]).stats
+        self.assertTrue(any(func[2] == 'DecryptMsg' for func in stats))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+重放防护单元测试
+"""
+
+import time
+import unittest
+
+import mock
+
+import easy_wechat
+import easy_wechat.replay as replay
+from easy_wechat.test.test_wechat import RECV_DATA
+from easy_wechat.test.test_wechat import RECV_PARAMS
+
+SIGNATURE = RECV_PARAMS['msg_signature']
+TIMESTAMP = RECV_PARAMS['timestamp']
+NONCE = RECV_PARAMS['nonce']
+
+
+class TestReplayGuard(unittest.TestCase):
+    """
+    重放防护测试类
+    """
+
+    def test_malformed(self):
+        """
+        测试参数格式检查
+        @return: None
+        """
+        guard = replay.ReplayGuard()
+        self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, NONCE), (None, None))
+        self.assertEqual(guard.admit('', TIMESTAMP, NONCE)[0], replay.MALFORMED)
+        self.assertEqual(guard.admit(SIGNATURE, '12a', NONCE)[0], replay.MALFORMED)
+        self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, '<x>')[0], replay.MALFORMED)
+        self.assertEqual(guard.stats()['malformed'], 3)
+
+    def test_window(self):
+        """
+        测试时间窗口与重放检查
+        @return: None
+        """
+        guard = replay.ReplayGuard(window=60)
+        with mock.patch('time.time', return_value=int(TIMESTAMP) + 61):
+            self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, NONCE)[0], replay.STALE)
+        with mock.patch('time.time', return_value=int(TIMESTAMP) + 10):
+            self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, NONCE), (None, None))
+            guard.remember(SIGNATURE, TIMESTAMP, NONCE)
+            guard.remember(SIGNATURE, TIMESTAMP, '1', 'key')
+            self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, NONCE)[0], replay.REPLAY)
+            self.assertEqual(guard.admit(SIGNATURE, TIMESTAMP, '1'), (None, 'key'))
+        # 超出时间窗口的记录被丢弃
+        with mock.patch('time.time', return_value=int(TIMESTAMP) + 100):
+            guard.admit(SIGNATURE, str(int(TIMESTAMP) + 100), NONCE)
+        stats = guard.stats()
+        self.assertEqual((stats['stale'], stats['replay'], stats['retries']), (1, 1, 1))
+        self.assertEqual(stats['tracked'], 0)
+
+    def test_future_timestamp(self):
+        """
+        测试时间戳晚于当前时间的请求在时间戳超出窗口前一直被视为重放
+        @return: None
+        """
+        guard = replay.ReplayGuard(window=60)
+        future = str(int(TIMESTAMP) + 50)
+        with mock.patch('time.time', return_value=int(TIMESTAMP)):
+            guard.remember(SIGNATURE, future, NONCE)
+        # 距离记录时已超过一个窗口, 但时间戳仍在窗口之内
+        with mock.patch('time.time', return_value=int(TIMESTAMP) + 100):
+            self.assertEqual(guard.admit(SIGNATURE, future, NONCE)[0], replay.REPLAY)
+        self.assertEqual(guard.stats()['tracked'], 1)
+
+    def test_capacity(self):
+        """
+        测试超出容量时丢弃最早的桶
+        @return: None
+        """
+        guard = replay.ReplayGuard(window=40, capacity=2)
+        now = time.time()
+        for index in range(4):
+            with mock.patch('time.time', return_value=now + index * 10):
+                guard.remember(SIGNATURE, TIMESTAMP, str(index))
+        self.assertLessEqual(guard.stats()['tracked'], 2)
+
+    def test_server(self):
+        """
+        测试服务器在解密之前拒绝过期的请求, 并由回复缓存应答重试
+        @return: None
+        """
+        def reply_func(param):
+            """
+            回复hello, world
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            param['Content'] = 'hello, world'
+            return param
+
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.replay_guard = replay.ReplayGuard(window=300)
+        server.register_callback('text', reply_func)
+        with mock.patch.object(server.wxcpt, 'DecryptMsg', wraps=server.wxcpt.DecryptMsg) as decrypt:
+            self.assertEqual(server.handle('POST', RECV_PARAMS, RECV_DATA), (403, ''))
+            self.assertEqual(decrypt.call_count, 0)
+            with mock.patch('time.time', return_value=int(TIMESTAMP)):
+                first = server.handle('POST', RECV_PARAMS, RECV_DATA)
+                second = server.handle('POST', RECV_PARAMS, RECV_DATA)
+            self.assertEqual(decrypt.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(server.replay_guard.stats()['retries'], 1)
+        bad_params = dict(RECV_PARAMS, msg_signature='0' * 40)
+        self.assertEqual(server.handle('POST', bad_params, RECV_DATA)[0], 403)
+        server.replay_guard.window = 0
+        self.assertEqual(server.handle('POST', bad_params, RECV_DATA)[0], 400)
+        self.assertEqual(server.replay_guard.stats()['signature'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+回复去重缓存单元测试
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import easy_wechat
+import easy_wechat.reply_cache as reply_cache
+from easy_wechat.test.test_wechat import RECV_DATA
+from easy_wechat.test.test_wechat import RECV_PARAMS
+
+
+class TestReplyCache(unittest.TestCase):
+    """
+    回复去重缓存测试类
+    """
+    def setUp(self):
+        """
+        创建临时目录
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def check_wait(self, first, second):
+        """
+        测试重复的请求等待正在处理的请求, 并得到相同的回复
+        @param first: 处理请求的ReplyCache对象
+        @param second: 收到重复请求的ReplyCache对象
+        @return: None
+        """
+        self.assertEqual(first.begin('a'), (reply_cache.CLAIMED, None))
+        timer = threading.Timer(0.2, first.finish, ('a', '<xml>reply</xml>'))
+        timer.start()
+        self.assertEqual(second.begin('a'), (reply_cache.CACHED, '<xml>reply</xml>'))
+        self.assertEqual(first.begin('a'), (reply_cache.CACHED, '<xml>reply</xml>'))
+        timer.join()
+        # 处理失败时放弃认领, 重试的请求会重新处理
+        self.assertEqual(first.begin('b'), (reply_cache.CLAIMED, None))
+        first.abort('b')
+        self.assertEqual(second.begin('b'), (reply_cache.CLAIMED, None))
+        # 重试的请求正在等待时处理失败, 重试的请求重新认领而不是返回空回复
+        self.assertEqual(first.begin('c'), (reply_cache.CLAIMED, None))
+        timer = threading.Timer(0.2, first.abort, ('c',))
+        timer.start()
+        self.assertEqual(second.begin('c'), (reply_cache.CLAIMED, None))
+        timer.join()
+        # 等待超时
+        second.wait_timeout = 0.1
+        self.assertEqual(second.begin('b'), (reply_cache.IN_FLIGHT, None))
+
+    def test_memory(self):
+        """
+        测试进程内存储
+        @return: None
+        """
+        cache = reply_cache.ReplyCache()
+        self.check_wait(cache, cache)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 5, 'timeouts': 1})
+
+    def test_sqlite(self):
+        """
+        测试两个工作进程通过SQLite共享缓存
+        @return: None
+        """
+        path = os.path.join(self.tmp_dir, 'replies.db')
+        first = reply_cache.ReplyCache(reply_cache.SQLiteReplyStore(path))
+        second = reply_cache.ReplyCache(reply_cache.SQLiteReplyStore(path))
+        self.check_wait(first, second)
+        self.assertEqual(second.stats(), {'hits': 1, 'misses': 2, 'timeouts': 1})
+
+    def test_expire(self):
+        """
+        测试容量与有效期
+        @return: None
+        """
+        cache = reply_cache.ReplyCache(reply_cache.MemoryReplyStore(capacity=2), ttl=0.1)
+        for key in ('a', 'b', 'c'):
+            cache.begin(key)
+            cache.finish(key, key)
+        self.assertEqual(cache.begin('a')[0], reply_cache.CLAIMED)
+        self.assertEqual(cache.begin('c')[0], reply_cache.CACHED)
+        time.sleep(0.15)
+        self.assertEqual(cache.begin('c')[0], reply_cache.CLAIMED)
+
+    def test_make_key(self):
+        """
+        测试普通消息以MsgId去重, 事件消息以发送者与创建时间去重
+        @return: None
+        """
+        self.assertEqual(reply_cache.ReplyCache.make_key(
+            {'ToUserName': 'corp', 'MsgId': '123', 'CreateTime': '1'}), 'corp:msg:123')
+        self.assertEqual(reply_cache.ReplyCache.make_key(
+            {'ToUserName': 'corp', 'FromUserName': 'user', 'CreateTime': '1'}),
+            'corp:event:user:1')
+        self.assertIsNone(reply_cache.ReplyCache.make_key({'ToUserName': 'corp'}))
+
+    def test_server_retry(self):
+        """
+        测试微信服务器重试时不会再次调用回调函数
+        @return: None
+        """
+        calls = []
+
+        def reply_func(param):
+            """
+            记录调用次数的回调函数
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            calls.append(param['MsgId'])
+            param['Content'] = 'hello, world'
+            return param
+
+        with mock.patch('flask.request') as mock_request:
+            type(mock_request).method = mock.PropertyMock(return_value='POST')
+            type(mock_request).args = mock.PropertyMock(return_value=RECV_PARAMS)
+            type(mock_request).data = mock.PropertyMock(return_value=RECV_DATA)
+            server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+            server.register_callback('text', reply_func)
+            first = server.callback()
+            second = server.callback()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(server.reply_cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
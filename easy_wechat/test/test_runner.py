@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+多进程WSGI服务器单元测试
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import urllib2
+import unittest
+import subprocess
+
+import easy_wechat.runner as runner
+
+# 在子进程中运行的服务器, 返回处理请求的工作进程pid
+SERVER_SCRIPT = '''
+import os
+import sys
+import easy_wechat.runner as runner
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+runner.Runner(app, sys.argv[1], workers=2, concurrency=4, max_requests=3,
+              graceful_timeout=5).serve('127.0.0.1', int(sys.argv[2]))
+'''
+
+
+class TestRunner(unittest.TestCase):
+    """
+    多进程WSGI服务器测试类
+    """
+
+    def setUp(self):
+        """
+        初始化
+        @return: None
+        """
+        self.process = None
+        self.url = None
+
+    def start_server(self, mode):
+        """
+        在子进程中启动服务器
+        @param mode: 运行模式
+        @return: 监听端口
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.process = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT, mode, str(port)],
+                                        cwd=root)
+        self.url = 'http://127.0.0.1:%d/' % port
+        self.get_pid()
+        return port
+
+    def tearDown(self):
+        """
+        停止服务器
+        @return: None
+        """
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def get_pid(self):
+        """
+        请求服务器, 连接被正在退出的工作进程重置时重试
+        @return: 处理请求的工作进程pid
+        """
+        for unused in range(50):
+            try:
+                return int(urllib2.urlopen(self.url, timeout=5).read())
+            except (urllib2.URLError, socket.error):
+                time.sleep(0.1)
+        self.fail('server is not responding')
+
+    def test_prefork(self):
+        """
+        测试工作进程达到请求数上限后被替换, SIGHUP平滑重启, SIGTERM正常退出
+        @return: None
+        """
+        self.start_server('prefork')
+        pids = set(self.get_pid() for unused in range(12))
+        self.assertGreater(len(pids), 2)
+        self.process.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        self.assertFalse(pids & set(self.get_pid() for unused in range(4)))
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(), 0)
+
+    def test_threaded(self):
+        """
+        测试单进程线程池模式
+        @return: None
+        """
+        self.start_server('threaded')
+        self.assertTrue(all(self.get_pid() for unused in range(5)))
+        self.process.send_signal(signal.SIGINT)
+        self.assertEqual(self.process.wait(), 0)
+
+    def test_invalid_mode(self):
+        """
+        测试无效的运行模式
+        @return: None
+        """
+        self.assertRaises(ValueError, runner.Runner, None, 'fork')
+
+
+if __name__ == '__main__':
+    unittest.main()
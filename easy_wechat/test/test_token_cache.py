@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+access_token缓存单元测试
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import easy_wechat.token_cache as token_cache
+
+
+class TokenFetcher(object):
+    """
+    模拟的token获取函数, 记录调用次数
+    """
+    def __init__(self, expires_in=7200, delay=0):
+        """
+        构造函数
+        @param expires_in: 返回的有效期
+        @param delay: 模拟的网络延迟
+        @return: TokenFetcher对象
+        """
+        self.expires_in = expires_in
+        self.delay = delay
+        self.count = 0
+
+    def __call__(self):
+        """
+        获取一个新token
+        @return: (token, expires_in)
+        """
+        time.sleep(self.delay)
+        self.count += 1
+        return 'token-%d' % self.count, self.expires_in
+
+
+class TestTokenCache(unittest.TestCase):
+    """
+    TokenCache测试类
+    """
+    def test_cached(self):
+        """
+        测试有效期内不会重复获取token
+        @return: None
+        """
+        cache = token_cache.TokenCache()
+        fetcher = TokenFetcher()
+        self.assertEqual(cache.get('key', fetcher), 'token-1')
+        self.assertEqual(cache.get('key', fetcher), 'token-1')
+        self.assertEqual(cache.get('other', fetcher), 'token-2')
+        self.assertEqual(fetcher.count, 2)
+
+    def test_refresh_ahead(self):
+        """
+        测试在过期前提前刷新token
+        @return: None
+        """
+        cache = token_cache.TokenCache(refresh_ahead=300)
+        fetcher = TokenFetcher()
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            self.assertEqual(cache.get('key', fetcher), 'token-1')
+        with mock.patch('time.time', return_value=now + 7200 - 299):
+            self.assertEqual(cache.get('key', fetcher), 'token-2')
+        with mock.patch('time.time', return_value=now + 7200 - 301):
+            self.assertEqual(cache.get('key', fetcher), 'token-2')
+
+    def test_concurrent_refresh(self):
+        """
+        测试并发请求只会触发一次刷新
+        @return: None
+        """
+        cache = token_cache.TokenCache()
+        fetcher = TokenFetcher(delay=0.05)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key', fetcher)))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetcher.count, 1)
+        self.assertEqual(results, ['token-1'] * 20)
+
+    def test_invalidate(self):
+        """
+        测试只有当前缓存的token才会被丢弃
+        @return: None
+        """
+        cache = token_cache.TokenCache()
+        fetcher = TokenFetcher()
+        cache.get('key', fetcher)
+        cache.invalidate('key', 'token-0')
+        self.assertEqual(cache.get('key', fetcher), 'token-1')
+        cache.invalidate('key', 'token-1')
+        self.assertEqual(cache.get('key', fetcher), 'token-2')
+
+
+class TestTokenStore(unittest.TestCase):
+    """
+    跨进程token存储测试类
+    """
+    def setUp(self):
+        """
+        创建临时目录
+        @return: None
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        删除临时目录
+        @return: None
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def check_shared(self, store_class):
+        """
+        使用两个独立的TokenCache模拟两个进程, 检查token是否共享
+        @param store_class: 存储后端类
+        @return: None
+        """
+        path = os.path.join(self.tmp_dir, 'token')
+        fetcher = TokenFetcher()
+        first = token_cache.TokenCache(store_class(path))
+        second = token_cache.TokenCache(store_class(path))
+        self.assertEqual(first.get(('corp', 'secret'), fetcher), 'token-1')
+        self.assertEqual(second.get(('corp', 'secret'), fetcher), 'token-1')
+        self.assertEqual(fetcher.count, 1)
+        # 一个进程丢弃token后, 另一个进程刷新得到的新token会被共享
+        second.invalidate(('corp', 'secret'), 'token-1')
+        self.assertEqual(second.get(('corp', 'secret'), fetcher), 'token-2')
+        first.invalidate(('corp', 'secret'), 'token-1')
+        self.assertEqual(first.get(('corp', 'secret'), fetcher), 'token-2')
+        self.assertEqual(fetcher.count, 2)
+        self.assertNotIn('secret', open(path, 'rb').read())
+
+    def test_file_store(self):
+        """
+        测试本地文件存储
+        @return: None
+        """
+        self.check_shared(token_cache.FileTokenStore)
+
+    def test_sqlite_store(self):
+        """
+        测试SQLite存储
+        @return: None
+        """
+        self.check_shared(token_cache.SQLiteTokenStore)
+
+    def test_sqlite_lease(self):
+        """
+        测试获取token期间不持有数据库写锁, 并发的刷新被合并, 租约过期后可以接管
+        @return: None
+        """
+        path = os.path.join(self.tmp_dir, 'token')
+        fetcher = TokenFetcher(delay=0.5)
+        first = token_cache.TokenCache(token_cache.SQLiteTokenStore(path, timeout=0.1))
+        second_store = token_cache.SQLiteTokenStore(path, timeout=0.1)
+        second = token_cache.TokenCache(second_store)
+        thread = threading.Thread(target=first.get, args=(('corp', 'secret'), fetcher))
+        thread.start()
+        time.sleep(0.1)
+        # 其他键的写入不会等待正在进行的HTTP请求
+        start = time.time()
+        second_store.save(('corp', 'other'), ('other', time.time() + 60, time.time() + 60))
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(second.get(('corp', 'secret'), fetcher), 'token-1')
+        thread.join()
+        self.assertEqual(fetcher.count, 1)
+        # 持有租约的进程崩溃后, 租约过期即可被接管
+        second_store.lease_time = 0.1
+        self.assertTrue(second_store.acquire_lease(('corp', 'crashed'), 'dead'))
+        self.assertFalse(second_store.acquire_lease(('corp', 'crashed'), 'alive'))
+        time.sleep(0.15)
+        self.assertTrue(second_store.acquire_lease(('corp', 'crashed'), 'alive'))
+
+    def test_sqlite_fork(self):
+        """
+        测试fork出的子进程使用新的数据库连接
+        @return: None
+        """
+        store = token_cache.SQLiteTokenStore(os.path.join(self.tmp_dir, 'token'))
+        conn = store.connect()
+        self.assertIs(store.connect(), conn)
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(store.connect(), conn)
+
+    def test_get_cache(self):
+        """
+        测试相同配置共享同一个缓存对象
+        @return: None
+        """
+        path = os.path.join(self.tmp_dir, 'token')
+        self.assertIs(token_cache.get_cache(), token_cache.get_cache('memory'))
+        self.assertIs(token_cache.get_cache('sqlite', path),
+                      token_cache.get_cache('sqlite', path))
+        self.assertRaises(ValueError, token_cache.get_cache, 'redis')
+
+
+if __name__ == '__main__':
+    unittest.main()
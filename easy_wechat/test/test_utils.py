@@ -15,10 +15,14 @@ XML模块单元测试
 """
 
 import sys
+import base64
+import random
 import unittest
 import collections
+import xml.etree.cElementTree as ElementTree
 
 import easy_wechat.utils as utils
+import easy_wechat.ierror as ierror
 
 
 class XMLTestCase(unittest.TestCase):
@@ -41,7 +45,8 @@ class XMLTestCase(unittest.TestCase):
         @return: None
         """
         dict_data = utils.xml_to_dict(self.xml_string)
-        self.assertIsInstance(dict_data, collections.OrderedDict)
+        self.assertIsInstance(dict_data, dict)
+        self.assertEqual(dict_data['Content'], u'thisisatest')
         self.assertIn('ToUserName', dict_data)
         self.assertIn('FromUserName', dict_data)
         self.assertIn('CreateTime', dict_data)
@@ -59,6 +64,62 @@ class XMLTestCase(unittest.TestCase):
         xml_data = utils.dict_to_xml(dict_data)
         self.assertEqual(xml_data, self.xml_string.replace('\n', '').replace(' ', ''))
 
+    def test_xml2dict_fallback(self):
+        """
+        测试嵌套, 重复字段与实体引用等格式的解析结果与xmltodict一致
+        @return: None
+        """
+        dict_data = utils.xml_to_dict(
+            '<xml><MsgType><![CDATA[event]]></MsgType><Content>a &amp; b</Content>'
+            '<SendPicsInfo><Count>2</Count><PicList><item><PicMd5Sum>x</PicMd5Sum></item>'
+            '<item><PicMd5Sum>y</PicMd5Sum></item></PicList></SendPicsInfo><Empty> </Empty></xml>')
+        self.assertEqual(dict_data, {
+            'MsgType': u'event',
+            'Content': u'a & b',
+            'SendPicsInfo': {'Count': u'2', 'PicList': {'item': [{'PicMd5Sum': u'x'},
+                                                                 {'PicMd5Sum': u'y'}]}},
+            'Empty': None,
+        })
+        dict_data = utils.xml_to_dict('<xml>\n<Content><![CDATA[ 你好 ]]></Content>\n</xml>')
+        self.assertEqual(dict_data, {'Content': u'你好'})
+        self.assertRaises(KeyError, utils.xml_to_dict, '<root><a>1</a></root>')
+
+    def test_xml2dict_empty(self):
+        """
+        测试空的CDATA段与空节点转换为None, 与xmltodict一致
+        @return: None
+        """
+        dict_data = utils.xml_to_dict(
+            '<xml><MsgType><![CDATA[event]]></MsgType><EventKey><![CDATA[]]></EventKey>'
+            '<Content></Content></xml>')
+        self.assertEqual(dict_data, {'MsgType': u'event', 'EventKey': None, 'Content': None})
+
+    def test_dict2xml_template(self):
+        """
+        测试按照消息类型模板输出字段, 以及CDATA中']]>'的转义
+        @return: None
+        """
+        xml_data = utils.dict_to_xml({
+            'Articles': [{'Url': 'http://a', 'Title': u'标题]]>'}],
+            'ArticleCount': 1,
+            'MsgType': 'news',
+            'CreateTime': '1348831860',
+            'FromUserName': 'wx5823bf96d3bd56c7',
+            'ToUserName': 'mycreate',
+        })
+        self.assertIsInstance(xml_data, str)
+        self.assertEqual(xml_data, '<xml><ToUserName><![CDATA[mycreate]]></ToUserName>'
+                                   '<FromUserName><![CDATA[wx5823bf96d3bd56c7]]></FromUserName>'
+                                   '<CreateTime>1348831860</CreateTime>'
+                                   '<MsgType><![CDATA[news]]></MsgType>'
+                                   '<ArticleCount>1</ArticleCount><Articles><item>'
+                                   '<Title><![CDATA[标题]]]]><![CDATA[>]]></Title>'
+                                   '<Url><![CDATA[http://a]]></Url></item></Articles></xml>')
+        dict_data = utils.xml_to_dict(xml_data)
+        self.assertEqual(dict_data['Articles']['item']['Title'], u'标题]]>')
+        self.assertEqual(utils.dict_to_xml({'Content': 'a&b<c>', 'Empty': None}),
+                         '<xml><Content><![CDATA[a&b<c>]]></Content><Empty></Empty></xml>')
+
     def test_wrap_cdata(self):
         """
         测试将Dict中字符串全部包裹上<![CDATA[]]>标签的函数
@@ -104,6 +165,189 @@ class XMLTestCase(unittest.TestCase):
         self.assertIsInstance(dict_data['c']['e'], dict)
 
 
+class CryptTestCase(unittest.TestCase):
+    """
+    消息加解密单元测试类
+    """
+    token = '8wdYqOgJWQlFRE13FaBAUOU2FxXVtGr'
+    aes_key = 'jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C'
+    corp_id = 'wx5823bf96d3bd56c7'
+
+    def setUp(self):
+        """
+        创建加解密对象
+        @return: None
+        """
+        self.wxcpt = utils.WXBizMsgCrypt(self.token, self.aes_key, self.corp_id)
+
+    def decrypt(self, resp_xml, nonce='1320562132'):
+        """
+        解密EncryptMsg生成的回复消息
+        @param resp_xml: 加密后的XML字符串
+        @param nonce: 随机串
+        @return: (错误码, 明文)
+        """
+        resp = utils.xml_to_dict(resp_xml)
+        post_data = '<xml><ToUserName><![CDATA[%s]]></ToUserName>' \
+                    '<Encrypt><![CDATA[%s]]></Encrypt></xml>' % (self.corp_id, resp['Encrypt'])
+        return self.wxcpt.DecryptMsg(post_data, resp['MsgSignature'], resp['TimeStamp'], nonce)
+
+    def test_round_trip(self):
+        """
+        测试不同长度的明文加密后能够被解密, 且随机前缀每次不同
+        @return: None
+        """
+        for length in (0, 1, 11, 12, 31, 32, 1000):
+            text = '<xml>%s</xml>' % ('x' * length)
+            ret, resp_xml = self.wxcpt.EncryptMsg(text, '1320562132')
+            self.assertEqual(ret, 0)
+            self.assertEqual(self.decrypt(resp_xml), (0, text))
+        ret, resp_xml = self.wxcpt.EncryptMsg(u'<xml>你好</xml>', '1320562132')
+        self.assertEqual(self.decrypt(resp_xml), (0, u'<xml>你好</xml>'.encode('utf-8')))
+        self.assertNotEqual(self.wxcpt.EncryptMsg('<xml/>', '1', '1')[1],
+                            self.wxcpt.EncryptMsg('<xml/>', '1', '1')[1])
+
+    def test_invalid(self):
+        """
+        测试签名错误, 企业号ID不符以及密文损坏时返回对应的错误码
+        @return: None
+        """
+        ret, resp_xml = self.wxcpt.EncryptMsg('<xml/>', '1320562132')
+        self.assertEqual(self.decrypt(resp_xml, nonce='0')[0],
+                         ierror.WXBizMsgCrypt_ValidateSignature_Error)
+        other = utils.WXBizMsgCrypt(self.token, self.aes_key, 'wx0000000000000000')
+        ret, resp_xml = other.EncryptMsg('<xml/>', '1320562132')
+        self.assertEqual(self.decrypt(resp_xml)[0], ierror.WXBizMsgCrypt_ValidateCorpid_Error)
+        pc = utils.Prpcrypt(self.wxcpt.key)
+        ret, encrypt = pc.encrypt('<xml/>', self.corp_id)
+        broken = base64.b64encode(base64.b64decode(encrypt)[:32])
+        self.assertEqual(pc.decrypt(broken, self.corp_id)[0], ierror.WXBizMsgCrypt_IllegalBuffer)
+
+    def test_batch(self):
+        """
+        测试批量加解密的结果与逐条调用一致, 且进程池中的结果顺序不变
+        @return: None
+        """
+        replies = [('<xml>%d</xml>' % i, str(i), '1450093931') for i in range(50)]
+        encrypted = self.wxcpt.EncryptMsgBatch(replies)
+        self.assertEqual(len(encrypted), 50)
+        items = []
+        for resp_xml in [xml for ret, xml in encrypted]:
+            resp = utils.xml_to_dict(resp_xml)
+            items.append(('<xml><ToUserName><![CDATA[%s]]></ToUserName>'
+                          '<Encrypt><![CDATA[%s]]></Encrypt></xml>' % (self.corp_id, resp['Encrypt']),
+                          resp['MsgSignature'], resp['TimeStamp'], resp['Nonce']))
+        items[7] = items[7][:1] + ('bad-signature',) + items[7][2:]
+        expected = [self.wxcpt.DecryptMsg(*item) for item in items]
+        self.assertEqual(expected[0], (0, '<xml>0</xml>'))
+        self.assertEqual(expected[7][0], ierror.WXBizMsgCrypt_ValidateSignature_Error)
+        self.assertEqual(self.wxcpt.DecryptMsgBatch(items), expected)
+        self.assertEqual(self.wxcpt.DecryptMsgBatch(items, processes=2, chunk_size=8), expected)
+        encrypted = self.wxcpt.EncryptMsgBatch(replies, processes=2, chunk_size=8)
+        self.assertEqual([ret for ret, xml in encrypted], [0] * 50)
+        self.assertEqual(self.wxcpt.DecryptMsgBatch([]), [])
+
+
+class EnvelopeTestCase(unittest.TestCase):
+    """
+    消息信封快速扫描的兼容性测试类
+    """
+    envelopes = [
+        '<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>'
+        '<Encrypt><![CDATA[RypEvHKD8QQKFhvQ6QleEB4J58tiPdvo+rtK1I9qca6aM/wvqnLSV5zEPeusUiX5]]></Encrypt>'
+        '<AgentID><![CDATA[218]]></AgentID></xml>',
+        '<xml>\n    <ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>\r\n'
+        '    <Encrypt>RypEvHKD8QQKFhvQ6QleEB4J58tiPdvo+rtK1I9q==</Encrypt>\n'
+        '    <AgentID>218</AgentID>\n</xml>\n',
+    ]
+    # 变异时插入的字符, 覆盖XML中有特殊含义的字符与非法字符
+    alphabet = list('<>/![]CDAT&;#"\'=? \t\r\nxE') + ['\x00', '\x1f', '\x7f', '\xe4', '\xff',
+                                                        ']]>', '<![CDATA[', '</', '&amp;']
+
+    def assert_compatible(self, xmltext):
+        """
+        快速扫描接受的输入必须能被ElementTree解析, 且各子节点文本一致
+        @param xmltext: xml字符串
+        @return: 快速扫描是否接受该输入
+        """
+        elements = utils.XMLParse().scan(xmltext)
+        if elements is None:
+            return False
+        try:
+            xml_tree = ElementTree.fromstring(xmltext)
+        except ElementTree.ParseError:
+            self.fail('fast path accepted malformed xml: %r' % xmltext)
+        self.assertEqual(xml_tree.tag, 'xml')
+        expected = {}
+        for child in xml_tree:
+            self.assertEqual(len(child), 0)
+            expected.setdefault(child.tag, child.text)
+        self.assertEqual(elements, expected, repr(xmltext))
+        return True
+
+    def mutate(self, rand, xmltext):
+        """
+        对xml字符串做随机的插入, 删除, 替换与重复
+        @param rand: random.Random对象
+        @param xmltext: xml字符串
+        @return: 变异后的字符串
+        """
+        for _ in range(rand.randint(1, 3)):
+            pos = rand.randint(0, len(xmltext))
+            end = min(len(xmltext), pos + rand.randint(1, 12))
+            op = rand.randint(0, 3)
+            if op == 0:
+                xmltext = xmltext[:pos] + rand.choice(self.alphabet) + xmltext[pos:]
+            elif op == 1:
+                xmltext = xmltext[:pos] + xmltext[end:]
+            elif op == 2:
+                xmltext = xmltext[:pos] + rand.choice(self.alphabet) + xmltext[end:]
+            else:
+                xmltext = xmltext[:pos] + xmltext[pos:end] * 2 + xmltext[end:]
+        return xmltext
+
+    def test_envelope(self):
+        """
+        测试标准的回调消息信封走快速路径, 且与ElementTree结果一致
+        @return: None
+        """
+        for xmltext in self.envelopes:
+            self.assertTrue(self.assert_compatible(xmltext))
+        ret, encrypt, touser_name = utils.XMLParse().extract(self.envelopes[1])
+        self.assertEqual((ret, touser_name), (0, 'wx5823bf96d3bd56c7'))
+        self.assertEqual(encrypt, 'RypEvHKD8QQKFhvQ6QleEB4J58tiPdvo+rtK1I9q==')
+
+    def test_fallback(self):
+        """
+        测试不符合固定格式的输入交给ElementTree处理, 结果与原实现一致
+        @return: None
+        """
+        xml_parse = utils.XMLParse()
+        for xmltext in ['<?xml version="1.0"?>' + self.envelopes[0],
+                        self.envelopes[0].replace('<Encrypt>', '<Encrypt a="1">'),
+                        self.envelopes[1].replace('218', '&#50;18'),
+                        self.envelopes[0].replace('<xml>', '<root>').replace('</xml>', '</root>'),
+                        self.envelopes[0].decode('utf-8')]:
+            self.assertIsNone(xml_parse.scan(xmltext))
+            self.assertEqual(xml_parse.extract(xmltext)[0], 0)
+        for xmltext in ['', '<xml>', self.envelopes[0].replace('</Encrypt>', '</Encrypt2>'),
+                        '<xml><ToUserName>a</ToUserName></xml>', '<xml></xml>']:
+            self.assertEqual(xml_parse.extract(xmltext)[0], ierror.WXBizMsgCrypt_ParseXml_Error)
+
+    def test_fuzz(self):
+        """
+        随机变异标准信封, 快速路径绝不能接受ElementTree拒绝的输入
+        @return: None
+        """
+        rand = random.Random(20151211)
+        accepted = 0
+        for i in range(5000):
+            xmltext = self.mutate(rand, self.envelopes[i % len(self.envelopes)])
+            accepted += self.assert_compatible(xmltext)
+        # 保证变异后仍有相当一部分输入走快速路径, 测试才有意义
+        self.assertGreater(accepted, 500)
+
+
 # test entry
 if __name__ == '__main__':
     unittest.main()
@@ -16,13 +16,23 @@
 
 import mock
 import json
+import time
 import unittest
 import urllib
+import urlparse
+import threading
+import SocketServer
+import multiprocessing.pool
+import BaseHTTPServer
 
 import flask
+import werkzeug.test
+import werkzeug.wrappers
 import werkzeug.exceptions as http_exceptions
 
 import easy_wechat.utils as utils
+import easy_wechat.wechat as wechat
+import easy_wechat.token_cache as token_cache
 import easy_wechat
 
 
@@ -75,6 +85,139 @@ def mocked_requests_post(*args, **kwargs):
                                         'errmsg': 'error'}), 400)
 
 
+# 一条加密的文本消息回调及其URL参数
+RECV_DATA = ('<xml><ToUserName><![CDATA[wx82ef843a5129db66]]>'
+             '</ToUserName><Encrypt><![CDATA[OoM+8tz/6B7iGq55'
+             'mU5PoP6u9w4iJW2BP/L8MWMRGMGll3kue5NRtkqPcOwUVdyFTW'
+             'saqUYvFXm0k7WVTt5d1ixBCb8FupfKP3eIar7ZPqwf7CYlXFT/'
+             'vxUkO/y12LNr7LOJzxe2hKDwBMyZ/SJEo0OYuit8BzfiyvlBv'
+             '300lnqDUnGvOumfp25i3WVxzV3FulKg/8VvAbqTBhiTUL3oRH'
+             'xbBCIth6HlrNlrT4ePVz0Azkh++hRL57IRHU+FTTFz9wLjnyhm'
+             'Agd8ka/j/SMrGtF0SiIGTjbzdWViKI8Jmpzox1N4ggBoABmbZTA'
+             'HqgZZIKsKwVFnmZg+4kGbqDff+BuHqGzyuIVzfORJNTHT8sS8G'
+             'meODAJeO+9HtR6lOO981tlsvfWgYAsfGyzMxRh1gxTEWBfqz6P'
+             'A1unAlfLUNjr54Q0aJOwP2ELqQnMYFgggSGqoe638SISc3bLle'
+             'rvxdw==]]></Encrypt><AgentID><![CDATA[2]]></AgentID></xml>')
+RECV_PARAMS = {
+    'msg_signature': '3483710b6ece7efff2dfcebb8aa258347eea6313',
+    'timestamp': '1450092658',
+    'nonce': '2095700682',
+}
+
+
+class FakeQyapiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    模拟的微信企业号接口请求处理类
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        """
+        不输出访问日志
+        @return: None
+        """
+        pass
+
+    def reply(self, res_dict):
+        """
+        返回json数据
+        @param res_dict: 返回值dict
+        @return: None
+        """
+        body = json.dumps(res_dict)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_chunked(self):
+        """
+        读取分块传输编码的请求体
+        @return: 请求体字符串
+        """
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return ''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_GET(self):
+        """
+        处理gettoken请求
+        @return: None
+        """
+        self.server.record(urlparse.urlparse(self.path).path, '')
+        self.reply({'errcode': 0, 'access_token': 'fake-token', 'expires_in': 7200})
+
+    def do_POST(self):
+        """
+        处理发送消息与上传素材请求
+        @return: None
+        """
+        if self.headers.getheader('Transfer-Encoding') == 'chunked':
+            body = self.read_chunked()
+        else:
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        path = urlparse.urlparse(self.path).path
+        self.server.record(path, body)
+        if path == '/cgi-bin/media/upload':
+            self.reply({'type': 'image', 'media_id': 'media-%d' % len(body),
+                        'created_at': str(int(time.time()))})
+        else:
+            self.reply({'errcode': 0, 'errmsg': 'ok'})
+
+
+class FakeQyapiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    在后台线程中运行的模拟微信企业号接口服务器
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        """
+        构造函数, 监听随机端口并启动服务线程
+        @return: FakeQyapiServer对象
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeQyapiHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, path, body):
+        """
+        记录收到的请求
+        @param path: 请求路径
+        @param body: 请求内容
+        @return: None
+        """
+        with self.lock:
+            self.requests.append((path, body))
+
+    def count(self, path):
+        """
+        统计某个路径收到的请求数
+        @param path: 请求路径
+        @return: 请求数
+        """
+        with self.lock:
+            return len([req for req in self.requests if req[0] == path])
+
+    def stop(self):
+        """
+        关闭服务器
+        @return: None
+        """
+        self.shutdown()
+        self.server_close()
+
+
 class TestWeChat(unittest.TestCase):
     """
     单测入口类
@@ -84,8 +227,8 @@ class TestWeChat(unittest.TestCase):
         测试能否正常发送消息
         @return: None
         """
-        with mock.patch('requests.get', side_effect=mocked_requests_get):
-            with mock.patch('requests.post', side_effect=mocked_requests_post):
+        with mock.patch('requests.Session.get', side_effect=mocked_requests_get):
+            with mock.patch('requests.Session.post', side_effect=mocked_requests_post):
                 client = easy_wechat.WeChatClient('demo', 'config_test.ini')
                 res_dict = client.send_media('text', {'content': 'hello, world'}, 'FinalTheory')
                 self.assertEqual(res_dict['errcode'], 0)
@@ -93,6 +236,119 @@ class TestWeChat(unittest.TestCase):
                         client.send_media('text', {'content': 'hello, world'},
                                           '645645')['errcode'], 0)
 
+    def test_token_cached(self):
+        """
+        测试多次发送消息只获取一次token, token失效时自动刷新重试
+        @return: None
+        """
+        def mocked_post(*args, **kwargs):
+            """
+            第一次请求返回token过期的错误
+            """
+            if mock_get.call_count == 1:
+                return MockResponse(json.dumps({'errcode': 42001,
+                                                'errmsg': 'access_token expired'}), 200)
+            return mocked_requests_post(*args, **kwargs)
+
+        with mock.patch('requests.Session.get', side_effect=mocked_requests_get) as mock_get:
+            with mock.patch('requests.Session.post', side_effect=mocked_post):
+                client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+                client.token_cache = token_cache.TokenCache()
+                res_dict = client.send_media('text', {'content': 'hello'}, 'FinalTheory')
+                self.assertEqual(res_dict['errcode'], 0)
+                self.assertEqual(mock_get.call_count, 2)
+                for _ in range(3):
+                    client.send_media('text', {'content': 'hello'}, 'FinalTheory')
+                self.assertEqual(mock_get.call_count, 2)
+
+    def test_session(self):
+        """
+        测试所有请求复用同一个带连接池的会话
+        @return: None
+        """
+        client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+        adapter = client.session.get_adapter('https://qyapi.weixin.qq.com')
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        with mock.patch('requests.Session.post', side_effect=mocked_requests_post) as mock_post:
+            client.token_cache = token_cache.TokenCache()
+            with mock.patch('requests.Session.get', side_effect=mocked_requests_get) as mock_get:
+                client.send_media('text', {'content': 'hello'}, 'FinalTheory')
+            self.assertEqual(mock_get.call_args[1]['timeout'], (5.0, 30.0))
+            self.assertEqual(mock_post.call_args[1]['timeout'], (5.0, 30.0))
+
+    def test_async_client(self):
+        """
+        测试异步客户端在并发发送时共享token与连接池
+        @return: None
+        """
+        server = FakeQyapiServer()
+        try:
+            with easy_wechat.AsyncWeChatClient('demo', 'config_test.ini',
+                                               max_workers=8, max_pending=16) as client:
+                client.client.api_url = server.url
+                client.client.token_cache = token_cache.TokenCache()
+                results = [client.send_media('text', {'content': 'hello'}, 'user%d' % i)
+                           for i in range(100)]
+                self.assertEqual(client.get_token().get(5), 'fake-token')
+            self.assertEqual([res.get(5)['errcode'] for res in results], [0] * 100)
+            self.assertEqual(server.count('/cgi-bin/gettoken'), 1)
+            self.assertEqual(server.count('/cgi-bin/message/send'), 100)
+        finally:
+            server.stop()
+
+    def test_send_many(self):
+        """
+        测试批量发送时接收者的去重, 分组与结果合并
+        @return: None
+        """
+        sent = []
+
+        def mocked_post(*args, **kwargs):
+            """
+            记录每次请求的接收者, 并将部分用户标记为无效
+            """
+            data = json.loads(args[1])
+            sent.append(data)
+            invalid = [user for user in data['touser'].split('|') if user.endswith('99')]
+            return MockResponse(json.dumps({'errcode': 0, 'errmsg': 'ok',
+                                            'invaliduser': '|'.join(invalid)}), 200)
+
+        users = ['user%d' % i for i in range(2500)] * 2
+        parties = '|'.join(str(i) for i in range(150))
+        with mock.patch('requests.Session.get', side_effect=mocked_requests_get):
+            with mock.patch('requests.Session.post', side_effect=mocked_post):
+                client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+                report = client.send_many('text', {'content': 'hello'}, users, parties)
+        self.assertEqual(report['errcode'], 0)
+        self.assertEqual(report['requests'], 3)
+        self.assertEqual(len(sent), 3)
+        sent.sort(key=lambda data: len(data['toparty']), reverse=True)
+        self.assertEqual(len(sent[0]['toparty'].split('|')), 100)
+        self.assertEqual(len(sent[1]['toparty'].split('|')), 50)
+        self.assertEqual(sent[2]['toparty'], '')
+        all_users = sum([data['touser'].split('|') for data in sent], [])
+        self.assertEqual(sorted(all_users), sorted(set(users)))
+        self.assertEqual(len(report['invaliduser'].split('|')), 25)
+        self.assertEqual(client.send_many('text', {'content': 'hello'})['errcode'], -1)
+
+    def test_split_recipients(self):
+        """
+        测试接收者拆分支持整数的部门与标签ID
+        @return: None
+        """
+        self.assertEqual(easy_wechat.wechat.split_recipients([1, 2, ' 3 ', 2, u'4']),
+                         [u'1', u'2', '3', u'4'])
+        self.assertEqual(easy_wechat.wechat.split_recipients(5), [u'5'])
+        self.assertEqual(easy_wechat.wechat.split_recipients('a| b|a'), ['a', 'b'])
+        sent = []
+        with mock.patch.object(easy_wechat.WeChatClient, 'send_media',
+                               side_effect=lambda *args: sent.append(args) or {'errcode': 0}):
+            client = easy_wechat.WeChatClient('demo', 'config_test.ini')
+            report = client.send_many('text', {'content': 'hello'}, parties=[1, 2, 2], tags=[7])
+        self.assertEqual(report['errcode'], 0)
+        self.assertEqual([args[3:] for args in sent], [('1|2', '7')])
+
     def test_callback(self):
         """
         测试回调是否正常工作
@@ -126,24 +382,6 @@ class TestWeChat(unittest.TestCase):
         测试接收正确消息时是否能够返回Response对象
         @return: None
         """
-        recv_data = ('<xml><ToUserName><![CDATA[wx82ef843a5129db66]]>'
-                     '</ToUserName><Encrypt><![CDATA[OoM+8tz/6B7iGq55'
-                     'mU5PoP6u9w4iJW2BP/L8MWMRGMGll3kue5NRtkqPcOwUVdyFTW'
-                     'saqUYvFXm0k7WVTt5d1ixBCb8FupfKP3eIar7ZPqwf7CYlXFT/'
-                     'vxUkO/y12LNr7LOJzxe2hKDwBMyZ/SJEo0OYuit8BzfiyvlBv'
-                     '300lnqDUnGvOumfp25i3WVxzV3FulKg/8VvAbqTBhiTUL3oRH'
-                     'xbBCIth6HlrNlrT4ePVz0Azkh++hRL57IRHU+FTTFz9wLjnyhm'
-                     'Agd8ka/j/SMrGtF0SiIGTjbzdWViKI8Jmpzox1N4ggBoABmbZTA'
-                     'HqgZZIKsKwVFnmZg+4kGbqDff+BuHqGzyuIVzfORJNTHT8sS8G'
-                     'meODAJeO+9HtR6lOO981tlsvfWgYAsfGyzMxRh1gxTEWBfqz6P'
-                     'A1unAlfLUNjr54Q0aJOwP2ELqQnMYFgggSGqoe638SISc3bLle'
-                     'rvxdw==]]></Encrypt><AgentID><![CDATA[2]]></AgentID></xml>')
-        param_dict = {
-            'msg_signature': '3483710b6ece7efff2dfcebb8aa258347eea6313',
-            'timestamp': '1450092658',
-            'nonce': '2095700682',
-        }
-
         def reply_func(param):
             """
             自动回复函数
@@ -155,12 +393,167 @@ class TestWeChat(unittest.TestCase):
         with mock.patch('flask.request') as mock_request:
             # mock properties
             type(mock_request).method = mock.PropertyMock(return_value='POST')
-            type(mock_request).args = mock.PropertyMock(return_value=param_dict)
-            type(mock_request).data = mock.PropertyMock(return_value=recv_data)
+            type(mock_request).args = mock.PropertyMock(return_value=RECV_PARAMS)
+            type(mock_request).data = mock.PropertyMock(return_value=RECV_DATA)
             # load the server and do tests
             server = easy_wechat.WeChatServer('demo', 'config_test.ini')
             server.register_callback('text', reply_func)
             self.assertIsInstance(server.callback(), flask.Response)
+            # 微信服务器的重试由回复缓存直接应答
+            self.assertIsInstance(server.do_reply(), flask.Response)
+
+    def test_deferred_reply(self):
+        """
+        测试回调函数超过执行期限时立即返回空回复, 结果随后主动发送
+        @return: None
+        """
+        sent = threading.Event()
+
+        def slow_func(param):
+            """
+            执行缓慢的回调函数
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            time.sleep(0.5)
+            param['Content'] = 'hello, world'
+            return param
+
+        with mock.patch('flask.request') as mock_request:
+            type(mock_request).method = mock.PropertyMock(return_value='POST')
+            type(mock_request).args = mock.PropertyMock(return_value=RECV_PARAMS)
+            type(mock_request).data = mock.PropertyMock(return_value=RECV_DATA)
+            server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+            server.reply_cache = None
+            server.client = mock.Mock()
+            server.client.send_media.side_effect = lambda *args: sent.set()
+            server.register_callback('text', slow_func, deadline=0.1)
+            start = time.time()
+            res = server.callback()
+            self.assertLess(time.time() - start, 0.4)
+            self.assertEqual(res.data, '')
+            self.assertTrue(sent.wait(5))
+            args = server.client.send_media.call_args[0]
+            self.assertEqual(args[:2], ('text', {'content': 'hello, world'}))
+            # 按时完成时返回加密的被动回复
+            server.register_callback('text', slow_func, deadline=2)
+            self.assertIn('<Encrypt>', server.callback().data)
+            self.assertEqual(server.client.send_media.call_count, 1)
+
+    def test_reply_to_media(self):
+        """
+        测试被动回复消息转换为主动发送的消息
+        @return: None
+        """
+        self.assertEqual(wechat.reply_to_media({'MsgType': 'image', 'Image': {'MediaId': 'm'}}),
+                         ('image', {'media_id': 'm'}))
+        media_type, content = wechat.reply_to_media({
+            'MsgType': 'news', 'ArticleCount': 1,
+            'Articles': [{'Title': 't', 'Url': 'http://a'}]})
+        self.assertEqual(media_type, 'news')
+        self.assertEqual(content['articles'][0]['url'], 'http://a')
+        self.assertIsNone(wechat.reply_to_media({'MsgType': 'unknown'}))
+
+    def test_callback_dict(self):
+        """
+        测试回调函数收到普通的dict, 可以直接序列化或复制
+        @return: None
+        """
+        received = []
+
+        def reply_func(param):
+            """
+            记录收到的参数并回复hello, world
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            received.append((type(param), json.loads(json.dumps(param)), param.copy()))
+            param['Content'] = 'hello, world'
+            return param
+
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.register_callback('text', reply_func)
+        self.assertEqual(server.handle('POST', RECV_PARAMS, RECV_DATA)[0], 200)
+        param_type, decoded, copied = received[0]
+        self.assertIs(param_type, dict)
+        self.assertEqual(decoded['MsgType'], 'text')
+        self.assertEqual(copied['FromUserName'], decoded['FromUserName'])
+
+    def test_wsgi_app(self):
+        """
+        测试不依赖Flask的WSGI应用与Flask视图返回相同的结果
+        @return: None
+        """
+        def reply_func(param):
+            """
+            回复hello, world
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            param['Content'] = 'hello, world'
+            return param
+
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.reply_cache = None
+        server.register_callback('text', reply_func)
+        for app in (server.wsgi_app, server.app):
+            client = werkzeug.test.Client(app, werkzeug.wrappers.BaseResponse)
+            with mock.patch.object(server, 'handle', wraps=server.handle) as handle:
+                res = client.post('/weixin?' + urllib.urlencode(RECV_PARAMS), data=RECV_DATA)
+            # Flask视图与WSGI应用都经由handle处理请求
+            self.assertEqual(handle.call_count, 1)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.headers['Content-Type'].startswith('text/xml'))
+            self.assertIn('<Encrypt>', res.data)
+            self.assertEqual(client.post('/weixin?nonce=1', data=RECV_DATA).status_code, 400)
+            self.assertEqual(client.get('/weixin').status_code, 403)
+            self.assertEqual(client.put('/weixin').status_code, 405)
+            self.assertEqual(client.get('/other').status_code, 404)
+
+    def test_future_callback(self):
+        """
+        测试回调函数返回异步对象, 超过期限时随后主动发送结果
+        @return: None
+        """
+        pool = multiprocessing.pool.ThreadPool(2)
+        sent = threading.Event()
+
+        def slow_reply(param):
+            """
+            执行缓慢的处理
+            @param param: 输入参数
+            @return: 返回参数
+            """
+            time.sleep(param.pop('Delay'))
+            param['Content'] = 'hello, world'
+            return param
+
+        def async_func(param):
+            """
+            将处理交给线程池, 立即返回异步对象
+            @param param: 输入参数
+            @return: AsyncResult对象
+            """
+            param['Delay'] = delay[0]
+            return pool.apply_async(slow_reply, (param,))
+
+        delay = [0]
+        server = easy_wechat.WeChatServer('demo', 'config_test.ini')
+        server.reply_cache = None
+        server.client = mock.Mock()
+        server.client.send_media.side_effect = lambda *args: sent.set()
+        server.register_callback('text', async_func, deadline=0.2, executor='inline')
+        status, body = server.handle('POST', RECV_PARAMS, RECV_DATA)
+        self.assertEqual(status, 200)
+        self.assertIn('<Encrypt>', body)
+        delay[0] = 0.5
+        start = time.time()
+        self.assertEqual(server.handle('POST', RECV_PARAMS, RECV_DATA), (200, ''))
+        self.assertLess(time.time() - start, 0.45)
+        self.assertTrue(sent.wait(5))
+        self.assertEqual(server.client.send_media.call_args[0][:2],
+                         ('text', {'content': 'hello, world'}))
+        pool.close()
 
     def test_verify_err(self):
         """
@@ -179,6 +572,7 @@ class TestWeChat(unittest.TestCase):
             type(mock_request).data = mock.PropertyMock(return_value='')
             server = easy_wechat.WeChatServer('demo', 'config_test.ini')
             self.assertRaises(http_exceptions.Forbidden, server.callback)
+            self.assertRaises(http_exceptions.Forbidden, server.verify)
 
     def test_verify_OK(self):
         """
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+access_token缓存模块
+同一(corpid, secret)下的所有WeChatClient共享同一个token, 并在过期前自动刷新
+通过可替换的存储后端, 同一主机上的多个进程也可以共享token
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def key_id(key):
+    """
+    将缓存键转换为可以落地存储的字符串, 避免secret以明文写入磁盘
+    @param key: 缓存键, 一般为(corpid, secret)
+    @return: 字符串
+    """
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+class MemoryTokenStore(object):
+    """
+    进程内的token存储, 不在进程之间共享
+    """
+
+    def __init__(self):
+        """
+        构造函数
+        @return: MemoryTokenStore对象实例
+        """
+        self.entries = {}
+        self.mutex = threading.RLock()
+
+    def load(self, key):
+        """
+        读取token
+        @param key: 缓存键
+        @return: (token, refresh_at, expires_at), 不存在时返回None
+        """
+        return self.entries.get(key)
+
+    def save(self, key, entry):
+        """
+        写入token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param entry: (token, refresh_at, expires_at)
+        @return: None
+        """
+        self.entries[key] = entry
+
+    def delete(self, key, token=None):
+        """
+        删除token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param token: 若指定, 则只有存储的token与之相同时才删除
+        @return: None
+        """
+        entry = self.entries.get(key)
+        if entry and (token is None or entry[0] == token):
+            del self.entries[key]
+
+    def lock(self, key):
+        """
+        获取刷新token时使用的互斥锁
+        @param key: 缓存键
+        @return: 支持with语句的锁对象
+        """
+        return self.mutex
+
+
+class FileTokenStore(object):
+    """
+    基于本地文件的token存储, 通过文件锁在多个进程间互斥刷新
+    写入时先写临时文件再原子地重命名, 所以读取不需要加锁
+    """
+
+    def __init__(self, path):
+        """
+        构造函数
+        @param path: 存储文件路径, 同目录下会生成'.lock'后缀的锁文件
+        @return: FileTokenStore对象实例
+        """
+        if fcntl is None:
+            raise RuntimeError('file token store requires fcntl')
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def read_all(self):
+        """
+        读取存储文件的全部内容
+        @return: dict对象
+        """
+        try:
+            with open(self.path, 'rb') as fid:
+                return json.load(fid)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_all(self, entries):
+        """
+        原子地写入存储文件
+        @param entries: dict对象
+        @return: None
+        """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.token')
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                json.dump(entries, fid)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def load(self, key):
+        """
+        无锁地读取token
+        @param key: 缓存键
+        @return: (token, refresh_at, expires_at), 不存在时返回None
+        """
+        entry = self.read_all().get(key_id(key))
+        return tuple(entry) if entry else None
+
+    def save(self, key, entry):
+        """
+        写入token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param entry: (token, refresh_at, expires_at)
+        @return: None
+        """
+        entries = self.read_all()
+        entries[key_id(key)] = list(entry)
+        self.write_all(entries)
+
+    def delete(self, key, token=None):
+        """
+        删除token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param token: 若指定, 则只有存储的token与之相同时才删除
+        @return: None
+        """
+        entries = self.read_all()
+        entry = entries.get(key_id(key))
+        if entry and (token is None or entry[0] == token):
+            del entries[key_id(key)]
+            self.write_all(entries)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+        获取跨进程的文件锁
+        @param key: 缓存键
+        @return: 上下文管理器
+        """
+        with open(self.lock_path, 'a') as fid:
+            fcntl.flock(fid.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fid.fileno(), fcntl.LOCK_UN)
+
+
+class SQLiteTokenStore(object):
+    """
+    基于SQLite的token存储
+    使用WAL模式, 读取不会被写入阻塞; 刷新时通过租约行在多个进程间互斥,
+    获取token的HTTP请求期间不持有数据库的写锁
+    """
+
+    # 等待其他进程释放租约时轮询的间隔(秒)
+    poll_interval = 0.05
+
+    def __init__(self, path, timeout=30, lease_time=30):
+        """
+        构造函数
+        @param path: 数据库文件路径
+        @param timeout: 等待数据库锁的超时时间(秒)
+        @param lease_time: 刷新租约的有效期(秒), 持有租约的进程崩溃后其他进程最多等待这么久,
+                           应大于获取token的请求超时时间
+        @return: SQLiteTokenStore对象实例
+        """
+        self.path = path
+        self.timeout = timeout
+        self.lease_time = lease_time
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS tokens ('
+                     'key TEXT PRIMARY KEY, token TEXT, refresh_at REAL, expires_at REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS leases ('
+                     'key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def connect(self):
+        """
+        获取当前线程的数据库连接, fork出的子进程不会沿用父进程的连接
+        @return: sqlite3.Connection对象
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def load(self, key):
+        """
+        读取token
+        @param key: 缓存键
+        @return: (token, refresh_at, expires_at), 不存在时返回None
+        """
+        row = self.connect().execute(
+            'SELECT token, refresh_at, expires_at FROM tokens WHERE key = ?',
+            (key_id(key),)).fetchone()
+        return tuple(row) if row else None
+
+    def save(self, key, entry):
+        """
+        写入token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param entry: (token, refresh_at, expires_at)
+        @return: None
+        """
+        self.connect().execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)',
+                               (key_id(key),) + tuple(entry))
+
+    def delete(self, key, token=None):
+        """
+        删除token, 调用方需持有lock(key)
+        @param key: 缓存键
+        @param token: 若指定, 则只有存储的token与之相同时才删除
+        @return: None
+        """
+        if token is None:
+            self.connect().execute('DELETE FROM tokens WHERE key = ?', (key_id(key),))
+        else:
+            self.connect().execute('DELETE FROM tokens WHERE key = ? AND token = ?',
+                                   (key_id(key), token))
+
+    def acquire_lease(self, key, owner):
+        """
+        尝试获取刷新租约, 只在检查与写入租约行的短事务中持有写锁
+        @param key: 缓存键
+        @param owner: 租约持有者标识
+        @return: 是否获取成功
+        """
+        now = time.time()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT expires_at FROM leases WHERE key = ?',
+                               (key_id(key),)).fetchone()
+            if row and row[0] > now:
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                         (key_id(key), owner, now + self.lease_time))
+            return True
+        finally:
+            conn.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+        获取跨进程的刷新租约, 其他进程的租约过期后可以接管
+        @param key: 缓存键
+        @return: 上下文管理器
+        """
+        owner = uuid.uuid4().hex
+        while not self.acquire_lease(key, owner):
+            time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self.connect().execute('DELETE FROM leases WHERE key = ? AND owner = ?',
+                                   (key_id(key), owner))
+
+
+class TokenCache(object):
+    """
+    线程安全的access_token缓存
+    每个键同时最多只有一个线程在刷新, 并发的刷新请求会被合并为一次
+    进程内的缓存命中时不会加锁, 也不会访问存储后端
+    """
+
+    logger = logging.getLogger('easy_wechat')
+
+    # 提前刷新的时间(秒), 避免token在发送过程中过期
+    refresh_ahead = 300
+
+    def __init__(self, store=None, refresh_ahead=None):
+        """
+        构造函数
+        @param store: token存储后端, 为None则只在进程内缓存
+        @param refresh_ahead: 提前刷新的时间(秒), 为None则使用类的默认值
+        @return: TokenCache对象实例
+        """
+        if refresh_ahead is not None:
+            self.refresh_ahead = refresh_ahead
+        self.store = store or MemoryTokenStore()
+        # key -> (token, refresh_at, expires_at)
+        self.entries = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def get_lock(self, key):
+        """
+        获取某个键对应的刷新锁
+        @param key: 缓存键
+        @return: threading.Lock对象
+        """
+        with self.lock:
+            lock = self.key_locks.get(key)
+            if lock is None:
+                lock = self.key_locks[key] = threading.Lock()
+            return lock
+
+    def load(self, key):
+        """
+        从存储后端读取token并放入进程内缓存
+        @param key: 缓存键
+        @return: (token, refresh_at, expires_at), 不存在时返回None
+        """
+        entry = self.store.load(key)
+        if entry:
+            self.entries[key] = entry
+        return entry
+
+    def get(self, key, fetch_func):
+        """
+        获取token, 缓存失效时调用fetch_func刷新
+        @param key: 缓存键, 一般为(corpid, secret)
+        @param fetch_func: 获取新token的函数, 返回(token, expires_in)元组
+        @return: token字符串
+        """
+        entry = self.entries.get(key) or self.load(key)
+        if entry:
+            token, refresh_at, expires_at = entry
+            now = time.time()
+            if now < refresh_at:
+                return token
+            if now < expires_at:
+                # 已进入提前刷新区间但旧token仍然有效
+                # 只让一个线程去刷新, 其余线程继续使用旧token
+                lock = self.get_lock(key)
+                if not lock.acquire(False):
+                    return token
+                try:
+                    return self.refresh(key, fetch_func)
+                finally:
+                    lock.release()
+
+        with self.get_lock(key):
+            # 等待锁的过程中其他线程可能已经完成了刷新
+            entry = self.entries.get(key)
+            if entry and time.time() < entry[1]:
+                return entry[0]
+            return self.refresh(key, fetch_func)
+
+    def refresh(self, key, fetch_func):
+        """
+        调用fetch_func获取新token并写入缓存, 调用方需持有该键的刷新锁
+        @param key: 缓存键
+        @param fetch_func: 获取新token的函数, 返回(token, expires_in)元组
+        @return: token字符串
+        """
+        with self.store.lock(key):
+            # 其他进程可能已经完成了刷新
+            entry = self.load(key)
+            if entry and time.time() < entry[1]:
+                return entry[0]
+            token, expires_in = fetch_func()
+            now = time.time()
+            expires_at = now + expires_in
+            # 有效期过短时按一半的有效期提前刷新
+            refresh_at = expires_at - min(self.refresh_ahead, expires_in / 2.0)
+            entry = (token, refresh_at, expires_at)
+            self.store.save(key, entry)
+        self.entries[key] = entry
+        self.logger.info('access token refreshed, expires in %d seconds' % expires_in)
+        return token
+
+    def invalidate(self, key, token=None):
+        """
+        使缓存的token失效
+        @param key: 缓存键
+        @param token: 若指定, 则只有缓存中的token与之相同时才失效,
+                      避免多个线程或进程重复丢弃刚刚刷新过的token
+        @return: None
+        """
+        with self.get_lock(key):
+            entry = self.entries.get(key)
+            if entry and (token is None or entry[0] == token):
+                del self.entries[key]
+            with self.store.lock(key):
+                self.store.delete(key, token)
+
+
+# 已创建的缓存, 同一进程内相同配置的客户端共享同一个TokenCache
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(store_type='memory', path=None):
+    """
+    根据存储类型获取共享的TokenCache对象
+    @param store_type: 存储类型, 'memory', 'file'或'sqlite'
+    @param path: 'file'与'sqlite'类型的存储文件路径
+    @return: TokenCache对象
+    """
+    store_classes = {
+        'memory': None,
+        'file': FileTokenStore,
+        'sqlite': SQLiteTokenStore,
+    }
+    if store_type not in store_classes:
+        raise ValueError('Invalid token store type: %s' % store_type)
+    if store_type == 'memory':
+        path = None
+    elif not path:
+        path = os.path.join(tempfile.gettempdir(), 'easy_wechat_token.%s' % store_type)
+    with _caches_lock:
+        cache = _caches.get((store_type, path))
+        if cache is None:
+            store = store_classes[store_type](path) if path else None
+            cache = _caches[(store_type, path)] = TokenCache(store)
+        return cache
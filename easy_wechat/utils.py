@@ -14,19 +14,18 @@
 """
 
 import os
+import re
 import sys
-import socket
 import base64
-import string
-import random
+import binascii
 import hashlib
 import time
 import struct
 import logging
+import itertools
 import collections
+import multiprocessing
 
-import dicttoxml
-import xmltodict
 import ConfigParser
 import Crypto.Cipher.AES as AES
 import xml.etree.cElementTree as ElementTree
@@ -75,26 +74,144 @@ def wrap_cdata(dict_data):
     return dict_data
 
 
+# 回复消息中各类型的字段顺序, 未列出的字段按名称排序后追加在末尾
+REPLY_HEADER = ('ToUserName', 'FromUserName', 'CreateTime', 'MsgType')
+REPLY_TRAILER = ('MsgId', 'AgentID')
+REPLY_FIELDS = {
+    'text': REPLY_HEADER + ('Content',) + REPLY_TRAILER,
+    'image': REPLY_HEADER + ('Image',) + REPLY_TRAILER,
+    'voice': REPLY_HEADER + ('Voice',) + REPLY_TRAILER,
+    'video': REPLY_HEADER + ('Video',) + REPLY_TRAILER,
+    'news': REPLY_HEADER + ('ArticleCount', 'Articles') + REPLY_TRAILER,
+    'Video': ('MediaId', 'Title', 'Description'),
+    'item': ('Title', 'Description', 'PicUrl', 'Url'),
+}
+
+# 会被原样输出而不包裹CDATA的整数字符串
+INTEGER_RE = re.compile(r'[ \t\r\n]*[+-]?[0-9]+[ \t\r\n]*\Z')
+
+# 扁平消息的扫描规则, 字段内容只允许单个CDATA段或不含实体引用与控制字符的文本
+# 嵌套节点, 重复字段等其他格式交给ElementTree处理
+XML_HEAD_RE = re.compile(r'[ \t\r\n]*<xml>')
+XML_FIELD_RE = re.compile(
+    r'[ \t\r\n]*<([A-Za-z_][A-Za-z0-9_.-]*)>'
+    r'(?:<!\[CDATA\[([^\]\x00-\x08\x0b\x0c\x0e-\x1f\r]*(?:\](?!\]>)[^\]\x00-\x08\x0b\x0c\x0e-\x1f\r]*)*)\]\]>'
+    r'|([^<&\]\x00-\x08\x0b\x0c\x0e-\x1f\r]*))</\1>')
+XML_TAIL_RE = re.compile(r'[ \t\r\n]*</xml>[ \t\r\n]*\Z')
+
+
+def ordered_fields(dict_data, template):
+    """
+    按照字段模板确定输出顺序
+    @param dict_data: 字典对象
+    @param template: 字段名元组, 为None则没有模板
+    @return: 字段名列表
+    """
+    fields = [key for key in template or () if key in dict_data]
+    rest = [key for key in dict_data if key not in fields]
+    if not isinstance(dict_data, collections.OrderedDict):
+        rest.sort()
+    return fields + rest
+
+
+def encode_value(key, val, output):
+    """
+    将单个字段序列化为XML片段, 追加到输出列表中
+    字符串包裹在CDATA中, 内容中的']]>'被拆分到两个CDATA段
+    @param key: 字段名
+    @param val: 字段值
+    @param output: 输出的字符串列表
+    @return: None
+    """
+    output.append('<%s>' % key)
+    if isinstance(val, dict):
+        for field in ordered_fields(val, REPLY_FIELDS.get(key)):
+            encode_value(field, val[field], output)
+    elif isinstance(val, (list, tuple)):
+        for item in val:
+            encode_value('item', item, output)
+    elif isinstance(val, basestring):
+        if isinstance(val, unicode):
+            val = val.encode('utf-8')
+        if INTEGER_RE.match(val):
+            output.append(str(int(val)))
+        elif val:
+            output.append('<![CDATA[%s]]>' % val.replace(']]>', ']]]]><![CDATA[>'))
+    elif val is not None:
+        output.append(str(val))
+    output.append('</%s>' % key)
+
+
 def dict_to_xml(dict_data):
     """
     将字典对象转换为XML字符串
-    @param dict_data: OrderedDict对象
-    @return: XML字符串
+    字段顺序由MsgType对应的模板决定, 整数原样输出, 字符串包裹在CDATA中
+    @param dict_data: 字典对象
+    @return: UTF-8编码的XML字符串
+    """
+    output = ['<xml>']
+    for field in ordered_fields(dict_data, REPLY_FIELDS.get(dict_data.get('MsgType'))):
+        encode_value(field, dict_data[field], output)
+    output.append('</xml>')
+    return ''.join(output)
+
+
+def element_to_dict(element):
+    """
+    将ElementTree节点转换为字典对象, 转换规则与xmltodict相同
+    文本去除首尾空白后为空的节点转换为None, 重复的子节点转换为列表
+    @param element: Element对象
+    @return: dict对象或unicode字符串
     """
-    # this fucking module would escape '<' and '>'
-    # so we should replace it back
-    return ('<xml>%s</xml>' % dicttoxml.dicttoxml(wrap_cdata(dict_data), root=False,
-                                                  custom_root='xml', attr_type=False, ids=False)) \
-        .replace('&lt;', '<').replace('&gt;', '>')
+    text = (element.text or '').strip()
+    if not len(element) and not element.attrib:
+        return unicode(text) if text else None
+    dict_data = dict(('@' + key, unicode(val)) for key, val in element.attrib.items())
+    for child in element:
+        value = element_to_dict(child)
+        if child.tag not in dict_data:
+            dict_data[child.tag] = value
+        elif isinstance(dict_data[child.tag], list):
+            dict_data[child.tag].append(value)
+        else:
+            dict_data[child.tag] = [dict_data[child.tag], value]
+    if text:
+        dict_data['#text'] = unicode(text)
+    return dict_data
 
 
 def xml_to_dict(xml_string):
     """
     将XML字符串转换为字典对象
+    扁平的消息只扫描一遍即可得到结果, 其他格式使用ElementTree解析
     @param xml_string: XML字符串
-    @return: OrderedDict对象
+    @return: dict对象, 字段值为unicode字符串或None
     """
-    return xmltodict.parse(xml_string)['xml']
+    if isinstance(xml_string, str):
+        match = XML_HEAD_RE.match(xml_string)
+        pos = match.end() if match else None
+        dict_data = {}
+        while pos is not None:
+            match = XML_FIELD_RE.match(xml_string, pos)
+            if not match:
+                break
+            key, cdata, text = match.groups()
+            if key in dict_data:
+                break
+            try:
+                # 空的CDATA段匹配为cdata == '', 此时text为None
+                value = cdata if cdata is not None else (text or '')
+                value = value.strip().decode('utf-8')
+            except UnicodeDecodeError:
+                break
+            dict_data[key] = value or None
+            pos = match.end()
+        if pos is not None and XML_TAIL_RE.match(xml_string, pos):
+            return dict_data
+    root = ElementTree.fromstring(xml_string)
+    if root.tag != 'xml':
+        raise KeyError('xml')
+    return element_to_dict(root) or {}
 
 
 def get_config(ini_name="config.ini"):
@@ -114,6 +231,27 @@ def get_config(ini_name="config.ini"):
     return config
 
 
+def get_option(config, section, option, default=None):
+    """
+    读取可选的配置项, 并按照默认值的类型进行转换
+    @param config: ConfigParser对象
+    @param section: 配置段名称
+    @param option: 配置项名称
+    @param default: 配置项不存在或为空时的默认值
+    @return: 配置项的值
+    """
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option).strip().strip('\'"')
+    if not value:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, long, float)):
+        return type(default)(value)
+    return value
+
+
 class FormatException(Exception):
     """
     格式错误异常类
@@ -148,9 +286,7 @@ class SHA1(object):
         try:
             sortlist = [token, timestamp, nonce, encrypt]
             sortlist.sort()
-            sha = hashlib.sha1()
-            sha.update("".join(sortlist))
-            return ierror.WXBizMsgCrypt_OK, sha.hexdigest()
+            return ierror.WXBizMsgCrypt_OK, hashlib.sha1("".join(sortlist)).hexdigest()
         except Exception as e:
             self.logger.error('SHA1 failed with exception: %s' % e.message)
             return ierror.WXBizMsgCrypt_ComputeSignature_Error, None
@@ -169,6 +305,32 @@ class XMLParse(object):
     <Nonce><![CDATA[%(nonce)s]]></Nonce>
     </xml>"""
 
+    # 回调消息外层信封的严格格式: 根节点为<xml>, 只包含一层不带属性的子节点,
+    # 子节点内容为纯文本或单个CDATA段, 且只允许不需要转义的ASCII字符
+    # 不符合该格式的输入一律交给完整的XML解析器处理
+    ENVELOPE_RE = re.compile(
+        r'\A[ \t\r\n]*<xml>'
+        r'(?:[ \t\r\n]*<([A-Za-z_][A-Za-z0-9_]*)>'
+        r'(?:<!\[CDATA\[[\t\n\x20-\x5c\x5e-\x7e]*\]\]>|[\t\n\x20-\x25\x27-\x3b\x3d-\x5c\x5e-\x7e]*)'
+        r'</\1>)*'
+        r'[ \t\r\n]*</xml>[ \t\r\n]*\Z')
+    ELEMENT_RE = re.compile(r'<([A-Za-z_][A-Za-z0-9_]*)>(?:<!\[CDATA\[([^\]]*)\]\]>|([^<]*))</\1>')
+
+    def scan(self, xmltext):
+        """
+        不构造DOM树, 直接扫描固定格式的消息信封
+        @param xmltext: 待提取的xml字符串
+        @return: 子节点名称到文本的dict, 与ElementTree一样空文本为None, 格式不符时返回None
+        """
+        if not isinstance(xmltext, str) or not self.ENVELOPE_RE.match(xmltext):
+            return None
+        elements = {}
+        for name, cdata, text in self.ELEMENT_RE.findall(xmltext):
+            # 与ElementTree的find一致, 同名节点取第一个
+            if name not in elements:
+                elements[name] = cdata or text or None
+        return elements
+
     def extract(self, xmltext):
         """
         提取出xml数据包中的加密消息
@@ -176,6 +338,9 @@ class XMLParse(object):
         @return: 提取出的加密消息字符串
         """
         try:
+            elements = self.scan(xmltext)
+            if elements is not None:
+                return ierror.WXBizMsgCrypt_OK, elements['Encrypt'], elements['ToUserName']
             xml_tree = ElementTree.fromstring(xmltext)
             encrypt = xml_tree.find("Encrypt")
             touser_name = xml_tree.find("ToUserName")
@@ -207,19 +372,23 @@ class PKCS7Encoder(object):
 
     block_size = 32
 
+    # 预先生成所有可能的补位字符串
+    PADDINGS = [chr(amount) * amount for amount in range(block_size + 1)]
+
+    def padding(self, text_length):
+        """ 计算需要追加到明文末尾的补位字符串
+        @param text_length: 明文长度
+        @return: 补位字符串
+        """
+        # 明文长度恰好是块大小的整数倍时补一整块
+        return self.PADDINGS[self.block_size - (text_length % self.block_size)]
+
     def encode(self, text):
         """ 对需要加密的明文进行填充补位
         @param text: 需要进行填充补位操作的明文
         @return: 补齐明文字符串
         """
-        text_length = len(text)
-        # 计算需要填充的位数
-        amount_to_pad = self.block_size - (text_length % self.block_size)
-        if amount_to_pad == 0:
-            amount_to_pad = self.block_size
-        # 获得补位所用的字符
-        pad = chr(amount_to_pad)
-        return text + pad * amount_to_pad
+        return text + self.padding(len(text))
 
     def decode(self, decrypted):
         """删除解密后明文的补位字符
@@ -237,14 +406,18 @@ class Prpcrypt(object):
 
     logger = logging.getLogger('easy_wechat')
 
+    # 无状态的补位工具, 所有实例共用
+    pkcs7 = PKCS7Encoder()
+
     def __init__(self, key):
         """
-        构造函数
+        构造函数, 预先计算加解密所需的秘钥与初始向量
         @param key: AES秘钥
         @return:
         """
         # self.key = base64.b64decode(key+"=")
         self.key = key
+        self.iv = key[:16]
         # 设置加解密模式为AES的CBC模式
         self.mode = AES.MODE_CBC
 
@@ -254,13 +427,14 @@ class Prpcrypt(object):
         @param corpid: 企业号ID
         @return: 加密得到的字符串
         """
-        # 16位随机字符串添加到明文开头
-        text = self.get_random_str() + struct.pack("I", socket.htonl(len(text))) + text + corpid
-        # 使用自定义的填充方式对明文进行补位填充
-        pkcs7 = PKCS7Encoder()
-        text = pkcs7.encode(text)
-        # 加密
-        cryptor = AES.new(self.key, self.mode, self.key[:16])
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        # 16位随机字符串 + 网络字节序的明文长度 + 明文 + 企业号ID + 补位, 一次拼接完成
+        length = 20 + len(text) + len(corpid)
+        text = ''.join((self.get_random_str(), struct.pack('!I', len(text)), text, corpid,
+                        self.pkcs7.padding(length)))
+        # CBC模式的加密对象带有状态, 每条消息需要单独创建
+        cryptor = AES.new(self.key, self.mode, self.iv)
         try:
             ciphertext = cryptor.encrypt(text)
             # 使用BASE64对加密后的字符串进行编码
@@ -276,36 +450,33 @@ class Prpcrypt(object):
         @return: 删除填充补位后的明文
         """
         try:
-            cryptor = AES.new(self.key, self.mode, self.key[:16])
+            cryptor = AES.new(self.key, self.mode, self.iv)
             # 使用BASE64对密文进行解码，然后AES-CBC解密
             plain_text = cryptor.decrypt(base64.b64decode(text))
         except Exception as e:
             self.logger.error('base64 decrypt failed with exception: %s' % e.message)
             return ierror.WXBizMsgCrypt_DecryptAES_Error, None
         try:
-            pad = ord(plain_text[-1])
-            # 去掉补位字符串
-            # pkcs7 = PKCS7Encoder()
-            # plain_text = pkcs7.encode(plain_text)
-            # 去除16位随机字符串
-            content = plain_text[16:-pad]
-            xml_len = socket.ntohl(struct.unpack("I", content[: 4])[0])
-            xml_content = content[4: xml_len + 4]
-            from_corpid = content[xml_len + 4:]
+            # 通过memoryview定位各个字段, 只复制最终返回的明文
+            view = memoryview(plain_text)
+            # 去掉补位字符串与16位随机字符串
+            end = len(view) - ord(view[-1])
+            xml_len = struct.unpack_from('!I', plain_text, 16)[0]
+            xml_end = 20 + xml_len
+            if xml_end > end:
+                raise ValueError('xml length %d out of range' % xml_len)
         except Exception as e:
             self.logger.error('data unpack failed with exception: %s' % e.message)
             return ierror.WXBizMsgCrypt_IllegalBuffer, None
-        if from_corpid != corpid:
+        if view[xml_end:end] != corpid:
             return ierror.WXBizMsgCrypt_ValidateCorpid_Error, None
-        return 0, xml_content
+        return 0, view[20:xml_end].tobytes()
 
     def get_random_str(self):
-        """ 随机生成16位字符串
+        """ 使用操作系统的安全随机数生成16位字符串
         @return: 16位字符串
         """
-        rule = string.letters + string.digits
-        str_data = random.sample(rule, 16)
-        return "".join(str_data)
+        return binascii.hexlify(os.urandom(8))
 
 
 class WXBizMsgCrypt(object):
@@ -315,6 +486,10 @@ class WXBizMsgCrypt(object):
 
     logger = logging.getLogger('easy_wechat')
 
+    # 无状态的签名与XML工具, 所有实例共用
+    sha1 = SHA1()
+    xml_parse = XMLParse()
+
     def __init__(self, sToken, sEncodingAESKey, sCorpId):
         """
         构造函数
@@ -330,7 +505,10 @@ class WXBizMsgCrypt(object):
             self.logger.error('base64 decode failed with exception: %s' % e.message)
             throw_exception("[error]: EncodingAESKey invalid !", FormatException)
         self.m_sToken = sToken
+        self.m_sEncodingAESKey = sEncodingAESKey
         self.m_sCorpid = sCorpId
+        # 加解密上下文只在构造时创建一次, 之后每条消息复用
+        self.pc = Prpcrypt(self.key)
 
     def VerifyURL(self, sMsgSignature, sTimeStamp, sNonce, sEchoStr):
         """
@@ -342,14 +520,12 @@ class WXBizMsgCrypt(object):
         @return sReplyEchoStr: 解密之后的echostr，当return返回0时有效
         @return：成功0，失败返回对应的错误码
         """
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, sEchoStr)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, sReplyEchoStr = pc.decrypt(sEchoStr, self.m_sCorpid)
+        ret, sReplyEchoStr = self.pc.decrypt(sEchoStr, self.m_sCorpid)
         return ret, sReplyEchoStr
 
     def EncryptMsg(self, sReplyMsg, sNonce, timestamp=None):
@@ -362,19 +538,16 @@ class WXBizMsgCrypt(object):
         @return sEncryptMsg: 加密后的可以直接回复用户的密文，包括msg_signature, timestamp, nonce, encrypt的xml格式的字符串
         @return 成功0，sEncryptMsg, 失败返回对应的错误码None
         """
-        pc = Prpcrypt(self.key)
-        ret, encrypt = pc.encrypt(sReplyMsg, self.m_sCorpid)
+        ret, encrypt = self.pc.encrypt(sReplyMsg, self.m_sCorpid)
         if ret != 0:
             return ret, None
         if timestamp is None:
             timestamp = str(int(time.time()))
         # 生成安全签名
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, timestamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
-        xmlParse = XMLParse()
-        return ret, xmlParse.generate(encrypt, signature, timestamp, sNonce)
+        return ret, self.xml_parse.generate(encrypt, signature, timestamp, sNonce)
 
     def DecryptMsg(self, sPostData, sMsgSignature, sTimeStamp, sNonce):
         """
@@ -387,16 +560,111 @@ class WXBizMsgCrypt(object):
         @return: 成功0，失败返回对应的错误码
         """
         # 验证安全签名
-        xml_parse = XMLParse()
-        ret, encrypt, touser_name = xml_parse.extract(sPostData)
+        ret, encrypt, touser_name = self.xml_parse.extract(sPostData)
         if ret != 0:
             return ret, None
-        sha1 = SHA1()
-        ret, signature = sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
+        ret, signature = self.sha1.getSHA1(self.m_sToken, sTimeStamp, sNonce, encrypt)
         if ret != 0:
             return ret, None
         if not signature == sMsgSignature:
             return ierror.WXBizMsgCrypt_ValidateSignature_Error, None
-        pc = Prpcrypt(self.key)
-        ret, xml_content = pc.decrypt(encrypt, self.m_sCorpid)
+        ret, xml_content = self.pc.decrypt(encrypt, self.m_sCorpid)
         return ret, xml_content
+
+    def DecryptMsgBatch(self, items, processes=None, chunk_size=1000):
+        """
+        批量检验并解密消息, 每条消息的结果与DecryptMsg完全相同
+        @param items: (sPostData, sMsgSignature, sTimeStamp, sNonce)序列
+        @param processes: 进程数, 为None时在当前进程中解密, 否则消息数超过chunk_size时使用进程池
+        @param chunk_size: 分发给每个子进程的消息数
+        @return: 与items顺序一致的(错误码, 明文)列表
+        """
+        return self.run_batch(decrypt_batch, decrypt_chunk, items, processes, chunk_size)
+
+    def EncryptMsgBatch(self, items, processes=None, chunk_size=1000):
+        """
+        批量加密并签名回复消息, 每条消息的结果与EncryptMsg完全相同
+        @param items: (sReplyMsg, sNonce)或(sReplyMsg, sNonce, timestamp)序列
+        @param processes: 进程数, 为None时在当前进程中加密, 否则消息数超过chunk_size时使用进程池
+        @param chunk_size: 分发给每个子进程的消息数
+        @return: 与items顺序一致的(错误码, 加密后的XML)列表
+        """
+        return self.run_batch(encrypt_batch, encrypt_chunk, items, processes, chunk_size)
+
+    def run_batch(self, func, chunk_func, items, processes, chunk_size):
+        """
+        在当前进程或进程池中执行批量加解密
+        @param func: 当前进程中的批量处理函数, 参数为(WXBizMsgCrypt对象, 消息列表)
+        @param chunk_func: 子进程中的批量处理函数, 参数为消息列表
+        @param items: 消息序列
+        @param processes: 进程数
+        @param chunk_size: 每个任务的消息数
+        @return: 结果列表
+        """
+        items = list(items)
+        if not processes or len(items) <= chunk_size:
+            return func(self, items)
+        chunks = [items[i:i + chunk_size] for i in xrange(0, len(items), chunk_size)]
+        pool = multiprocessing.Pool(processes, init_batch_worker,
+                                    (self.m_sToken, self.m_sEncodingAESKey, self.m_sCorpid))
+        try:
+            results = pool.map(chunk_func, chunks, chunksize=1)
+        finally:
+            pool.terminate()
+        return list(itertools.chain.from_iterable(results))
+
+
+def decrypt_batch(wxcpt, items):
+    """
+    在当前进程中逐条解密消息
+    @param wxcpt: WXBizMsgCrypt对象
+    @param items: (sPostData, sMsgSignature, sTimeStamp, sNonce)列表
+    @return: (错误码, 明文)列表
+    """
+    decrypt = wxcpt.DecryptMsg
+    return [decrypt(*item) for item in items]
+
+
+def encrypt_batch(wxcpt, items):
+    """
+    在当前进程中逐条加密消息
+    @param wxcpt: WXBizMsgCrypt对象
+    @param items: (sReplyMsg, sNonce[, timestamp])列表
+    @return: (错误码, 加密后的XML)列表
+    """
+    encrypt = wxcpt.EncryptMsg
+    return [encrypt(*item) for item in items]
+
+
+# 批量处理子进程中的加解密对象, 由进程池的initializer创建
+batch_wxcpt = None
+
+
+def init_batch_worker(token, encoding_aes_key, corpid):
+    """
+    进程池初始化函数, 在每个子进程中创建一次加解密对象
+    @param token: Token
+    @param encoding_aes_key: EncodingAESKey
+    @param corpid: 企业号ID
+    @return: None
+    """
+    global batch_wxcpt
+    batch_wxcpt = WXBizMsgCrypt(token, encoding_aes_key, corpid)
+
+
+def decrypt_chunk(items):
+    """
+    子进程中解密一组消息
+    @param items: 消息列表
+    @return: 结果列表
+    """
+    return decrypt_batch(batch_wxcpt, items)
+
+
+def encrypt_chunk(items):
+    """
+    子进程中加密一组消息
+    @param items: 消息列表
+    @return: 结果列表
+    """
+    return encrypt_batch(batch_wxcpt, items)
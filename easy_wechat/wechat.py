@@ -17,19 +17,112 @@
 import os
 import sys
 import time
-import copy
 import json
 import logging
-import tempfile
+import httplib
+import urlparse
 import mimetypes
+import tempfile
+import threading
+import multiprocessing.pool
 
 import flask
 import requests
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
 
 import easy_wechat.utils as utils
+import easy_wechat.token_cache as token_cache
+import easy_wechat.outbox as outbox
+import easy_wechat.media as media
+import easy_wechat.message as message
+import easy_wechat.reply_cache as reply_cache
+import easy_wechat.executor as executor
+import easy_wechat.runner as runner
+import easy_wechat.replay as replay
+import easy_wechat.ierror as ierror
+import easy_wechat.metrics as metrics
+import easy_wechat.profiler as profiler
 
 WEIXIN_URL = 'https://qyapi.weixin.qq.com'
 
+# 表示access_token无效或过期的错误码, 遇到时需要刷新token后重试
+TOKEN_ERRCODES = (40001, 40014, 42001)
+
+# 发送消息接口单次请求允许的最大接收者数量
+MAX_USERS = 1000
+MAX_PARTIES = 100
+MAX_TAGS = 100
+
+
+def split_recipients(recipients):
+    """
+    将接收者列表或'|'分割的字符串拆分为去重后的列表, 保持原有顺序
+    @param recipients: 列表或'|'分割的字符串, 列表元素与单个ID也可以是整数
+    @return: 列表
+    """
+    if not recipients:
+        return []
+    if isinstance(recipients, basestring):
+        recipients = recipients.split('|')
+    elif isinstance(recipients, (int, long)):
+        recipients = [recipients]
+    result = []
+    seen = set()
+    for item in recipients:
+        # 部门与标签ID通常是整数
+        if not isinstance(item, basestring):
+            item = unicode(item)
+        item = item.strip()
+        if item and item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def make_chunks(items, size):
+    """
+    将列表按照指定大小切分
+    @param items: 列表
+    @param size: 每一块的大小
+    @return: 切分后的列表
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def reply_to_media(res_dict):
+    """
+    将被动回复消息转换为send_media的参数
+    @param res_dict: 回复消息dict
+    @return: (media_type, media_content), 不支持的消息类型返回None
+    """
+    msg_type = res_dict.get('MsgType')
+    if msg_type == 'text':
+        return 'text', {'content': res_dict.get('Content', '')}
+    if msg_type in ('image', 'voice'):
+        media_dict = res_dict.get(msg_type.capitalize()) or {}
+        return msg_type, {'media_id': media_dict.get('MediaId')}
+    if msg_type == 'video':
+        media_dict = res_dict.get('Video') or {}
+        return 'video', {
+            'media_id': media_dict.get('MediaId'),
+            'title': media_dict.get('Title', ''),
+            'description': media_dict.get('Description', ''),
+        }
+    if msg_type == 'news':
+        articles = res_dict.get('Articles') or []
+        if isinstance(articles, dict):
+            articles = articles.get('item') or []
+        if isinstance(articles, dict):
+            articles = [articles]
+        return 'news', {'articles': [{
+            'title': article.get('Title', ''),
+            'description': article.get('Description', ''),
+            'url': article.get('Url', ''),
+            'picurl': article.get('PicUrl', ''),
+        } for article in articles]}
+    return None
+
 
 class WeChatBase(object):
     """
@@ -52,6 +145,7 @@ class WeChatBase(object):
             self.config = utils.get_config()
         self.logger = logging.getLogger('easy_wechat')
         self.init_logger()
+        self.metrics = metrics.REGISTRY
 
     def init_logger(self):
         """
@@ -103,9 +197,54 @@ class WeChatClient(WeChatBase):
         self.CorpID = self.config.get(self.appname, 'corpid')
         self.Secret = self.config.get(self.appname, 'secret')
         self.AppID = self.config.get(self.appname, 'appid')
+        self.api_url = utils.get_option(self.config, 'system', 'api_url', WEIXIN_URL)
+        # 相同存储配置的客户端共享同一个access_token缓存
+        self.token_cache = token_cache.get_cache(
+            utils.get_option(self.config, 'system', 'token_store', 'memory'),
+            utils.get_option(self.config, 'system', 'token_store_path'))
+        # 所有请求复用同一个连接池, 避免每次请求都重新建立TCP和TLS连接
+        self.timeout = (
+            utils.get_option(self.config, 'system', 'http_connect_timeout', 5.0),
+            utils.get_option(self.config, 'system', 'http_read_timeout', 30.0))
+        self.session = self.create_session()
+        # 按内容缓存已上传素材的media_id, 容量为0时不启用
+        self.media_cache = None
+        media_cache_size = utils.get_option(self.config, 'system', 'media_cache_size', 1000)
+        if media_cache_size > 0:
+            self.media_cache = media.MediaCache(
+                media_cache_size, utils.get_option(self.config, 'system', 'media_cache_path'))
+        # 配置了发件箱时, 发送失败的消息会被持久化并在后台重试
+        self.outbox = None
+        outbox_path = utils.get_option(self.config, 'system', 'outbox_path')
+        if outbox_path:
+            self.outbox = outbox.Outbox(
+                self, outbox_path,
+                durable_timeout=utils.get_option(self.config, 'system',
+                                                 'outbox_durable_timeout', 5.0))
 
-    @staticmethod
-    def url_request(url, get=True, data=''):
+    def create_session(self, pool_size=None):
+        """
+        根据配置文件创建带连接池的HTTP会话
+        @param pool_size: 连接池大小, 为None则从配置文件读取
+        @return: requests.Session对象
+        """
+        max_retries = utils.get_option(self.config, 'system', 'http_max_retries', 2)
+        # 只有幂等的请求会在读取超时后重试, POST请求只在建立连接失败时重试
+        retries = Retry(total=max_retries, connect=max_retries, read=max_retries, status=0,
+                        backoff_factor=utils.get_option(
+                            self.config, 'system', 'http_retry_backoff', 0.5))
+        if pool_size is None:
+            pool_size = utils.get_option(self.config, 'system', 'http_pool_size', 10)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                                max_retries=retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not utils.get_option(self.config, 'system', 'http_keep_alive', True):
+            session.headers['Connection'] = 'close'
+        return session
+
+    def url_request(self, url, get=True, data=''):
         """
         请求指定的URL
         @param url: 字符串
@@ -114,10 +253,12 @@ class WeChatClient(WeChatBase):
         @return: 转换为dict的请求结果
         """
         try:
-            if get:
-                req = requests.get(url)
-            else:
-                req = requests.post(url, data)
+            with self.metrics.time('wechat_client_request_seconds',
+                                   endpoint=urlparse.urlsplit(url).path):
+                if get:
+                    req = self.session.get(url, timeout=self.timeout)
+                else:
+                    req = self.session.post(url, data, timeout=self.timeout)
         except Exception as e:
             # wrap exception message with more detail
             raise type(e)('unable to retrieve URL: %s with exception: %s', (url, e.message))
@@ -131,19 +272,40 @@ class WeChatClient(WeChatBase):
 
     def get_token(self):
         """
-        获取发送消息时的验证token
+        获取发送消息时的验证token, 优先使用缓存
         @return: token字符串
         """
+        return self.token_cache.get((self.CorpID, self.Secret), self.fetch_token)
+
+    def fetch_token(self):
+        """
+        从微信服务器获取新的token
+        @return: (token字符串, 有效期秒数)
+        """
         token_url = '%s/cgi-bin/gettoken?corpid=%s&corpsecret=%s' \
-                    % (WEIXIN_URL, self.CorpID, self.Secret)
+                    % (self.api_url, self.CorpID, self.Secret)
         res = self.url_request(token_url)
-        return res['access_token']
+        return res['access_token'], int(res.get('expires_in', 7200))
 
-    def upload_media(self, file_type, file_path):
+    def invalidate_token(self, token=None):
+        """
+        丢弃缓存的token, 下次调用get_token时将重新获取
+        @param token: 被服务器判定为无效的token
+        @return: None
+        """
+        self.token_cache.invalidate((self.CorpID, self.Secret), token)
+
+    def upload_media(self, file_type, file_path=None, progress=None,
+                     data=None, filename=None, mimetype=None):
         """
         上传临时媒体素材到微信服务器
+        素材内容可以是文件路径, 也可以通过data参数直接传入内存中的数据
         @param file_type: 文件类型
         @param file_path: 文件绝对路径
+        @param progress: 上传进度回调函数, 参数为(已发送字节数, 总字节数)
+        @param data: 字符串, bytearray, memoryview, 文件对象或产生字符串的可迭代对象
+        @param filename: 上传的文件名, 为None时使用文件路径或文件对象的文件名
+        @param mimetype: 文件的MIME类型, 为None则根据文件名猜测
         @return: 服务器返回值dict
         """
 
@@ -162,29 +324,106 @@ class WeChatClient(WeChatBase):
             errmsg = 'Invalid media/message format'
             self.logger.error(errmsg)
             return make_err_return(errmsg)
-        try:
-            post_url = '%s/cgi-bin/media/upload?access_token=%s&type=%s' \
-                       % (WEIXIN_URL, self.get_token(), file_type)
-        except Exception as e:
-            self.logger.error(e.message)
-            return make_err_return(e.message)
-        try:
-            file_dir, file_name = os.path.split(file_path)
-            files = {'file': (file_name, open(file_path, 'rb'),
-                              mimetypes.guess_type(file_path, strict=False), {'Expires': '0'})}
-            r = requests.post(post_url, files=files)
-        except Exception as e:
-            self.logger.error(e.message)
-            return make_err_return(e.message)
-        try:
-            res_dict = json.loads(r.content)
-        except Exception as e:
-            raise type(e)('invalid json content: %s with exception: %s',
-                          (r.content, e.message))
+        if (file_path is None) == (data is None):
+            errmsg = 'Exactly one of file_path and data must be given'
+            self.logger.error(errmsg)
+            return make_err_return(errmsg)
+        cache_key = None
+        if self.media_cache:
+            try:
+                digest = media.hash_file(file_path) if data is None else media.hash_data(data)
+            except (IOError, OSError) as e:
+                self.logger.error(str(e))
+                return make_err_return(str(e))
+            # 分块迭代器只能读取一次, 无法预先计算摘要, 此时不使用缓存
+            if digest:
+                cache_key = self.media_cache.make_key(self.CorpID, file_type, digest)
+            entry = self.media_cache.get(cache_key) if cache_key else None
+            if entry:
+                # 相同内容的素材已上传过且尚未过期, 直接返回缓存的media_id
+                return {
+                    'type': file_type,
+                    'media_id': entry[0],
+                    'created_at': str(int(entry[1] - self.media_cache.lifetime)),
+                    'cached': True,
+                }
+        res_dict = self.post_media(file_type, file_path, progress, data, filename, mimetype)
+        if cache_key and 'media_id' in res_dict:
+            self.media_cache.put(cache_key, res_dict['media_id'], res_dict.get('created_at'))
         return res_dict
 
+    def post_media(self, file_type, file_path=None, progress=None,
+                   data=None, filename=None, mimetype=None):
+        """
+        调用上传临时素材接口, 参数与upload_media相同
+        @return: 服务器返回值dict
+        """
+        if data is not None and filename is None:
+            filename = getattr(data, 'name', None)
+            if isinstance(filename, basestring):
+                filename = os.path.basename(filename)
+            else:
+                filename = 'media' + (mimetypes.guess_extension(mimetype or '') or '')
+        # 记录文件对象的初始位置, 以便token失效后重新上传
+        start_pos = None
+        if hasattr(data, 'read'):
+            try:
+                start_pos = data.tell()
+            except (AttributeError, IOError, OSError, ValueError):
+                pass
+        for attempt in range(2):
+            try:
+                token = self.get_token()
+                post_url = '%s/cgi-bin/media/upload?access_token=%s&type=%s' \
+                           % (self.api_url, token, file_type)
+            except Exception as e:
+                self.logger.error(e.message)
+                return {
+                    'errcode': -1,
+                    'errmsg': e.message,
+                }
+            try:
+                # 流式上传文件内容, 上传结束后文件会被立即关闭
+                if data is None:
+                    encoder = media.MultipartEncoder.from_path(
+                        file_path, mimetype, progress=progress)
+                else:
+                    if attempt and start_pos is not None:
+                        data.seek(start_pos)
+                    encoder = media.MultipartEncoder.from_data(
+                        data, filename, mimetype, progress=progress)
+                with encoder:
+                    # 长度未知时使用分块传输编码
+                    body = encoder if encoder.length is not None else encoder.iter_chunks()
+                    with self.metrics.time('wechat_client_request_seconds',
+                                           endpoint='/cgi-bin/media/upload'):
+                        r = self.session.post(post_url, data=body, timeout=self.timeout,
+                                              headers={'Content-Type': encoder.content_type})
+                self.logger.info('uploaded %d bytes of %s at %.1f KB/s'
+                                 % (encoder.sent, file_path or filename,
+                                    encoder.throughput / 1024))
+            except Exception as e:
+                self.logger.error(e.message)
+                return {
+                    'errcode': -1,
+                    'errmsg': e.message,
+                }
+            try:
+                res_dict = json.loads(r.content)
+            except Exception as e:
+                raise type(e)('invalid json content: %s with exception: %s',
+                              (r.content, e.message))
+            if attempt == 0 and res_dict.get('errcode') in TOKEN_ERRCODES:
+                # token已被服务器判定为无效, 刷新后重试一次
+                self.invalidate_token(token)
+                # 分块迭代器与不可定位的文件对象已被读取, 无法重新上传
+                if data is None or isinstance(data, (str, bytearray, memoryview, buffer)) \
+                        or start_pos is not None:
+                    continue
+            return res_dict
+
     def send_media(self, media_type, media_content, touser,
-                   toparty='', totag=''):
+                   toparty='', totag='', queue_on_failure=True, key=None):
         """
         发送消息/视频/图片给指定的用户
         @param media_type: 消息类型
@@ -192,26 +431,46 @@ class WeChatClient(WeChatBase):
         @param touser: 用户名, '|'分割
         @param toparty: 分组名, '|'分割
         @param totag: 标签名, '|'分割
-        @return: 服务器返回值dict
+        @param queue_on_failure: 配置了发件箱时, 是否将可重试的失败消息放入发件箱
+        @param key: 发件箱的幂等键, 以相同的键重复调用时, 已在发件箱中的消息不会被再次发送,
+                    为None时每次失败都会放入一条新的消息
+        @return: 服务器返回值dict, 消息被放入发件箱时包含'outbox_key'
         """
-        if media_type not in ('text', 'image', 'voice', 'video', 'file'):
+        if media_type not in ('text', 'image', 'voice', 'video', 'file', 'news'):
             errmsg = 'Invalid media/message format'
             self.logger.error(errmsg)
             return {
                 'errcode': -1,
                 'errmsg': errmsg,
             }
-        try:
-            send_url = '%s/cgi-bin/message/send?access_token=%s' \
-                       % (WEIXIN_URL, self.get_token())
-        except Exception as e:
-            # since all error code definitions of wechat is unknown
-            # we simply just return -1 as our error code
-            self.logger.error(e.message)
-            return {
-                'errcode': -1,
-                'errmsg': e.message,
-            }
+        if queue_on_failure and self.outbox and key is not None:
+            state = self.outbox.lookup(key)
+            if state is not None:
+                self.logger.info('message %s is already in outbox, skipped' % key)
+                return {
+                    # 只有已投递的消息才视为发送成功
+                    'errcode': 0 if state == outbox.STATE_SENT else -1,
+                    'errmsg': 'already in outbox',
+                    'outbox_key': key,
+                }
+        res = self.post_message(media_type, media_content, touser, toparty, totag)
+        if queue_on_failure and self.outbox and res['errcode'] in outbox.RETRYABLE_ERRCODES:
+            # 等待写入磁盘后再返回, 调用方据此认为消息不会丢失
+            try:
+                res['outbox_key'] = self.outbox.put(media_type, media_content, touser,
+                                                    toparty, totag, key=key, durable=True)
+            except outbox.OutboxTimeout as e:
+                # 写入超时的消息已被撤回, 仍按发送失败返回
+                self.logger.error('failed to queue message to %s in outbox: %s' % (touser, e))
+            else:
+                self.logger.info('message to %s queued in outbox for retry' % touser)
+        return res
+
+    def post_message(self, media_type, media_content, touser, toparty, totag):
+        """
+        调用发送消息接口, 参数与send_media相同
+        @return: 服务器返回值dict
+        """
         message_data = {
             "touser": touser,
             "toparty": toparty,
@@ -222,22 +481,280 @@ class WeChatClient(WeChatBase):
             "safe": "0"
         }
         raw_data = json.dumps(message_data, ensure_ascii=False)
+        for attempt in range(2):
+            try:
+                token = self.get_token()
+                send_url = '%s/cgi-bin/message/send?access_token=%s' \
+                           % (self.api_url, token)
+            except Exception as e:
+                # since all error code definitions of wechat is unknown
+                # we simply just return -1 as our error code
+                self.logger.error(e.message)
+                return {
+                    'errcode': -1,
+                    'errmsg': e.message,
+                }
+            try:
+                res = self.url_request(send_url, False, raw_data.encode('utf-8'))
+            except Exception as e:
+                sys.stderr.write(str(e) + '\n')
+                errmsg = 'failed when post json data: %s to wechat server with exception: %s' \
+                         % (raw_data, e.message)
+                self.logger.error(errmsg)
+                return {
+                    'errcode': -1,
+                    'errmsg': errmsg,
+                }
+            if attempt == 0 and int(res['errcode']) in TOKEN_ERRCODES:
+                # token已被服务器判定为无效, 刷新后重试一次
+                self.invalidate_token(token)
+                continue
+            break
+        if int(res['errcode']) == 0:
+            self.logger.info('send message successful to %s' % touser)
+        else:
+            self.logger.error('send message failed with error: %s' % res['errmsg'])
+        return res
+
+    def map_concurrently(self, func, items, max_workers=None):
+        """
+        使用线程池并发地对每个元素调用func, 单个元素的异常不会影响其他元素
+        @param func: 函数对象, 接受一个参数
+        @param items: 参数列表
+        @param max_workers: 最大并发数, 为None则与连接池大小一致
+        @return: 与items顺序一致的结果列表, 抛出异常的元素对应一个错误信息dict
+        """
+        def call(item):
+            """
+            调用func并将异常转换为错误信息
+            @param item: 参数
+            @return: 返回值
+            """
+            try:
+                return func(item)
+            except Exception as e:
+                self.logger.error('concurrent call failed with exception: %s' % e)
+                return {
+                    'errcode': -1,
+                    'errmsg': str(e),
+                }
+
+        if max_workers is None:
+            max_workers = utils.get_option(self.config, 'system', 'http_pool_size', 10)
+        max_workers = min(max_workers, len(items))
+        if max_workers <= 1:
+            return [call(item) for item in items]
+        pool = multiprocessing.pool.ThreadPool(max_workers)
         try:
-            res = self.url_request(send_url, False, raw_data.encode('utf-8'))
+            return pool.map(call, items, chunksize=1)
+        finally:
+            pool.terminate()
+
+    def upload_many(self, items, max_workers=None, touser=None, toparty='', totag=''):
+        """
+        并发上传一批临时素材, 可以在每个素材上传完成后立即发送给指定的接收者
+        @param items: 素材列表, 每个元素为(file_type, file_path)或upload_media的关键字参数dict
+        @param max_workers: 最大并发请求数
+        @param touser: 用户名, '|'分割, 与toparty和totag均为空时只上传不发送
+        @param toparty: 分组名, '|'分割
+        @param totag: 标签名, '|'分割
+        @return: 与items顺序一致的上传结果列表, 发送时每个结果中的'send'为发送消息的返回值
+        """
+        def upload(item):
+            """
+            上传单个素材并按需发送
+            @param item: 素材
+            @return: 服务器返回值dict
+            """
+            kwargs = dict(item) if isinstance(item, dict) else \
+                dict(zip(('file_type', 'file_path'), item))
+            res_dict = self.upload_media(**kwargs)
+            if 'media_id' in res_dict and (touser or toparty or totag):
+                res_dict['send'] = self.send_media(
+                    kwargs['file_type'], {'media_id': res_dict['media_id']},
+                    touser or '', toparty, totag)
+            return res_dict
+
+        items = list(items)
+        if not items:
+            return []
+        # 预先获取token, 使所有并发请求共用同一个token而不是同时去刷新
+        try:
+            self.get_token()
         except Exception as e:
-            sys.stderr.write(str(e) + '\n')
-            errmsg = 'failed when post json data: %s to wechat server with exception: %s' \
-                     % (raw_data, e.message)
+            self.logger.error(e.message)
+        return self.map_concurrently(upload, items, max_workers)
+
+    def send_many(self, media_type, media_content, users=None, parties=None,
+                  tags=None, max_workers=None):
+        """
+        向大量接收者发送同一条消息
+        接收者会被去重并按照接口限制分组, 各组并发发送, 最终合并为一个结果
+        @param media_type: 消息类型
+        @param media_content: 消息内容, 是一个dict, 包含具体的描述信息
+        @param users: 用户名列表或'|'分割的字符串
+        @param parties: 部门ID列表或'|'分割的字符串
+        @param tags: 标签ID列表或'|'分割的字符串
+        @param max_workers: 最大并发请求数
+        @return: 合并后的结果dict, 'results'中为每个请求的服务器返回值
+        """
+        users = split_recipients(users)
+        if '@all' in users:
+            users = ['@all']
+        user_chunks = make_chunks(users, MAX_USERS)
+        party_chunks = make_chunks(split_recipients(parties), MAX_PARTIES)
+        tag_chunks = make_chunks(split_recipients(tags), MAX_TAGS)
+        count = max(len(user_chunks), len(party_chunks), len(tag_chunks))
+        if not count:
+            errmsg = 'No recipient specified'
             self.logger.error(errmsg)
             return {
                 'errcode': -1,
                 'errmsg': errmsg,
             }
-        if int(res['errcode']) == 0:
-            self.logger.info('send message successful to %s' % touser)
-        else:
-            self.logger.error('send message failed with error: %s' % res['errmsg'])
-        return res
+
+        def get_chunk(chunks, index):
+            """
+            取出第index组接收者并拼接为字符串
+            """
+            return '|'.join(chunks[index]) if index < len(chunks) else ''
+
+        jobs = [(get_chunk(user_chunks, i), get_chunk(party_chunks, i), get_chunk(tag_chunks, i))
+                for i in range(count)]
+        results = self.map_concurrently(
+            lambda job: self.send_media(media_type, media_content, *job), jobs, max_workers)
+
+        report = {
+            'errcode': 0,
+            'errmsg': 'ok',
+            'requests': count,
+            'failed': 0,
+            'results': results,
+        }
+        for field in ('invaliduser', 'invalidparty', 'invalidtag'):
+            merged = []
+            for res in results:
+                merged.extend(split_recipients(res.get(field)))
+            report[field] = '|'.join(merged)
+        errors = [res for res in results if int(res.get('errcode', 0)) != 0]
+        if errors:
+            report['failed'] = len(errors)
+            report['errcode'] = errors[0]['errcode']
+            report['errmsg'] = '; '.join(res.get('errmsg', '') for res in errors)
+        return report
+
+
+class AsyncWeChatClient(object):
+    """
+    异步消息发送类
+    所有接口都会立即返回一个AsyncResult对象, 调用其get方法即可等待并获取结果
+    内部由一个线程池执行实际的请求, 与WeChatClient共享token缓存和连接池
+    """
+
+    def __init__(self, appname, ini_name=None, max_workers=None, max_pending=None):
+        """
+        构造函数
+        @param appname: 应用名称, 需要与配置文件中section对应
+        @param ini_name: 配置文件路径
+        @param max_workers: 同时进行的请求数, 为None则从配置文件读取
+        @param max_pending: 已提交但尚未完成的请求数上限, 超出后提交操作将阻塞
+        @return: AsyncWeChatClient对象实例
+        """
+        self.client = WeChatClient(appname, ini_name)
+        config = self.client.config
+        if max_workers is None:
+            max_workers = utils.get_option(config, 'system', 'async_workers', 10)
+        if max_pending is None:
+            max_pending = utils.get_option(config, 'system', 'async_max_pending', 1000)
+        self.logger = self.client.logger
+        # 保证每个工作线程都能分到一个长连接
+        if max_workers > utils.get_option(config, 'system', 'http_pool_size', 10):
+            self.client.session = self.client.create_session(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max(max_pending, max_workers))
+        self.pool = multiprocessing.pool.ThreadPool(max_workers)
+
+    def __enter__(self):
+        """
+        支持with语句
+        @return: 对象自身
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        退出with语句时等待所有请求完成
+        @return: None
+        """
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        将一个函数调用提交到线程池中执行, 在途请求数达到上限时阻塞
+        @param func: 函数对象
+        @param args: 参数列表
+        @param kwargs: 参数字典
+        @return: AsyncResult对象
+        """
+        self.semaphore.acquire()
+
+        def run():
+            """
+            执行函数并在结束后释放信号量
+            @return: 函数返回值
+            """
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.semaphore.release()
+
+        try:
+            return self.pool.apply_async(run)
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def get_token(self):
+        """
+        异步获取发送消息时的验证token
+        @return: AsyncResult对象, 结果为token字符串
+        """
+        return self.submit(self.client.get_token)
+
+    def upload_media(self, *args, **kwargs):
+        """
+        异步上传临时媒体素材, 参数与WeChatClient.upload_media相同
+        @return: AsyncResult对象, 结果为服务器返回值dict
+        """
+        return self.submit(self.client.upload_media, *args, **kwargs)
+
+    def upload_many(self, *args, **kwargs):
+        """
+        异步地并发上传一批临时素材, 参数与WeChatClient.upload_many相同
+        @return: AsyncResult对象, 结果为上传结果列表
+        """
+        return self.submit(self.client.upload_many, *args, **kwargs)
+
+    def send_media(self, *args, **kwargs):
+        """
+        异步发送消息, 参数与WeChatClient.send_media相同
+        @return: AsyncResult对象, 结果为服务器返回值dict
+        """
+        return self.submit(self.client.send_media, *args, **kwargs)
+
+    def send_many(self, *args, **kwargs):
+        """
+        异步地向大量接收者发送同一条消息, 参数与WeChatClient.send_many相同
+        @return: AsyncResult对象, 结果为合并后的结果dict
+        """
+        return self.submit(self.client.send_many, *args, **kwargs)
+
+    def close(self):
+        """
+        不再接受新的请求, 并等待已提交的请求全部完成
+        @return: None
+        """
+        self.pool.close()
+        self.pool.join()
 
 
 class WeChatServer(WeChatBase):
@@ -264,6 +781,7 @@ class WeChatServer(WeChatBase):
         @return: 构造的对象
         """
         super(WeChatServer, self).__init__(appname, ini_name)
+        self.ini_name = ini_name
         self.callback_funcs = {
             'text': None,
             'image': None,
@@ -272,105 +790,486 @@ class WeChatServer(WeChatBase):
             'shortvideo': None,
             'location': None,
         }
+        # 各消息类型回调函数的执行期限(秒)与执行器
+        self.callback_deadlines = {}
+        self.callback_executors = {}
+        self.default_deadline = utils.get_option(self.config, 'system', 'reply_deadline', 0.0)
+        # 用于主动发送超时回复的客户端, 首次使用时创建
+        self.client = None
+        self.client_lock = threading.Lock()
         token = self.config.get(appname, 'token')
         aes_key = self.config.get(appname, 'encoding_aes_key')
         corp_id = self.config.get(appname, 'corpid')
         self.wxcpt = utils.WXBizMsgCrypt(token, aes_key, corp_id)
+        # 在解密之前拒绝格式错误, 时间戳过期与重放的请求
+        self.replay_guard = replay.ReplayGuard(
+            window=utils.get_option(self.config, 'system', 'replay_window', 0),
+            capacity=utils.get_option(self.config, 'system', 'replay_capacity', 100000))
+        # 按MsgId缓存已加密的回复, 微信服务器重试时不再重复调用回调函数
+        self.reply_cache = None
+        cache_size = utils.get_option(self.config, 'system', 'reply_cache_size', 10000)
+        if cache_size > 0:
+            cache_path = utils.get_option(self.config, 'system', 'reply_cache_path')
+            store = reply_cache.SQLiteReplyStore(cache_path) if cache_path \
+                else reply_cache.MemoryReplyStore(cache_size)
+            self.reply_cache = reply_cache.ReplyCache(
+                store,
+                ttl=utils.get_option(self.config, 'system', 'reply_cache_ttl', 300),
+                wait_timeout=utils.get_option(self.config, 'system', 'reply_wait_timeout', 4.0))
         # 初始化Flask对象
         self.app = flask.Flask(__name__)
         # 添加路由规则
-        self.app.add_url_rule('/' + self.config.get('system', 'route_name'),
-                              None, self.callback, methods=['GET', 'POST'])
+        self.route = '/' + self.config.get('system', 'route_name')
+        self.app.add_url_rule(self.route, None, self.callback, methods=['GET', 'POST'])
+        # 各处理阶段的耗时直方图, 预先创建以免每次请求查找
+        self.stage_histograms = dict(
+            (stage, self.metrics.histogram('wechat_server_stage_seconds',
+                                           'Time spent in each stage of callback handling',
+                                           stage=stage))
+            for stage in ('verify', 'decrypt', 'parse', 'serialize', 'encrypt', 'log'))
+        self.callback_histograms = {}
+        # 配置了profile_dir时对请求进行采样分析, 否则不产生任何开销
+        self.profiler = None
+        profile_dir = utils.get_option(self.config, 'system', 'profile_dir')
+        if profile_dir:
+            self.profiler = profiler.RequestProfiler(
+                profile_dir,
+                every=utils.get_option(self.config, 'system', 'profile_every', 0),
+                slow_ms=utils.get_option(self.config, 'system', 'profile_slow_ms', 0),
+                keep=utils.get_option(self.config, 'system', 'profile_keep', 100),
+                top=utils.get_option(self.config, 'system', 'profile_top', 30))
+        self.metrics_route = None
+        if utils.get_option(self.config, 'system', 'metrics_endpoint', True):
+            self.metrics_route = self.route + '/metrics'
+            self.app.add_url_rule(self.metrics_route, None, self.metrics_view, methods=['GET'])
 
-    def register_callback(self, msg_type, func):
+    def register_callback(self, msg_type, func, deadline=None, executor=None):
         """
         注册收到某种类型消息后的回调函数
         @param msg_type: 消息类型
-        @param func: 回调函数
+        @param func: 回调函数, 返回回复消息dict, 或在消息处理完成时得到该dict的异步对象
+        @param deadline: 执行期限(秒), 为None时使用配置中的reply_deadline, 为0则一直等待回调函数完成
+                         超过期限时立即返回空回复, 回调函数的结果随后通过WeChatClient.send_media主动发送
+                         使用inline执行器时, 期限只作用于回调函数返回的异步对象
+        @param executor: 执行回调函数的Executor对象或'类型[:并发数[:排队数]]'描述字符串,
+                         为None时使用配置中的executor_<msg_type>, 未配置时设置了期限的回调函数
+                         在线程池中执行, 其余在请求线程中直接执行
         @return: None
         """
-        if msg_type in self.callback_funcs:
-            self.callback_funcs[msg_type] = func
-        else:
+        if msg_type not in self.callback_funcs:
             raise KeyError('Invalid media type.')
+        if deadline is None:
+            deadline = self.default_deadline
+        callback_executor = self.make_executor(msg_type, executor, deadline)
+        self.callback_funcs[msg_type] = func
+        self.callback_deadlines[msg_type] = deadline
+        self.callback_executors[msg_type] = callback_executor
+        self.callback_histograms[msg_type] = self.metrics.histogram(
+            'wechat_server_callback_seconds', 'Time spent waiting for callbacks',
+            msg_type=msg_type)
+
+    def make_executor(self, msg_type, spec, deadline):
+        """
+        根据参数与配置创建回调函数的执行器
+        @param msg_type: 消息类型
+        @param spec: Executor对象, 描述字符串或None
+        @param deadline: 执行期限(秒)
+        @return: Executor对象
+        """
+        if isinstance(spec, executor.Executor):
+            return spec
+        if spec is None:
+            spec = utils.get_option(self.config, 'system', 'executor_' + msg_type)
+        if spec is None:
+            workers = utils.get_option(self.config, 'system', 'callback_workers', 10)
+            spec = 'thread:%d' % workers if deadline else 'inline'
+        return executor.create_executor(spec)
+
+    def executor_stats(self):
+        """
+        各消息类型回调函数的排队与执行耗时统计
+        @return: dict对象, 消息类型 -> Executor.stats()
+        """
+        return dict((msg_type, callback_executor.stats())
+                    for msg_type, callback_executor in self.callback_executors.items())
+
+    def get_client(self):
+        """
+        获取用于主动发送消息的客户端
+        @return: WeChatClient对象
+        """
+        with self.client_lock:
+            if self.client is None:
+                self.client = WeChatClient(self.appname, self.ini_name)
+            return self.client
+
+    def call_with_deadline(self, callback_executor, func, reply, deadline):
+        """
+        在执行器中执行回调函数, 最多等待deadline秒
+        回调函数可以返回异步对象(见executor.is_future), 期限同样作用于等待异步对象的时间
+        超时后回调函数继续执行, 其结果在完成时主动发送给用户
+        @param callback_executor: 执行回调函数的Executor对象
+        @param func: 回调函数
+        @param reply: 传入回调函数的消息dict
+        @param deadline: 执行期限(秒), 为0则一直等待
+        @return: (是否按时完成, 回调函数的返回值)
+        """
+        lock = threading.Lock()
+        state = {'late': False, 'done': False}
+        touser = reply['FromUserName']
+        start = time.time()
+
+        def on_done(ok, value):
+            """
+            回调函数执行完毕, 超时的结果交给deliver_late发送
+            @param ok: 是否成功
+            @param value: 返回值或异常对象
+            @return: None
+            """
+            with lock:
+                state['done'] = True
+                late = state['late']
+            if not late:
+                return
+            if ok:
+                self.deliver_late(value, touser)
+            else:
+                self.logger.error('deferred callback failed with exception: %s' % value)
+
+        handle = callback_executor.submit(func, reply, on_done)
+        if not deadline:
+            res = handle.get()
+        else:
+            try:
+                res = handle.get(deadline)
+            except multiprocessing.TimeoutError:
+                with lock:
+                    if not state['done']:
+                        state['late'] = True
+                        return False, None
+                # 恰好在超时的同时执行完毕
+                res = handle.get()
+        if not executor.is_future(res):
+            return True, res
+        timeout = max(deadline - (time.time() - start), 0) if deadline else None
+        if not executor.wait_future(res, timeout):
+            self.deliver_late(res, touser)
+            return False, None
+        return True, res.get()
+
+    def deliver_late(self, res, touser):
+        """
+        在新线程中主动发送超时的回调结果, 避免阻塞执行器的结果处理线程
+        使用gevent的monkey patch时新线程即为greenlet
+        @param res: 回调函数的返回值或尚未完成的异步对象
+        @param touser: 接收者
+        @return: None
+        """
+        def deliver():
+            """
+            等待异步对象完成并发送结果
+            @return: None
+            """
+            res_dict = res
+            if executor.is_future(res_dict):
+                try:
+                    res_dict = res_dict.get()
+                except Exception as e:
+                    self.logger.error('deferred callback failed with exception: %s' % e)
+                    return
+            self.send_deferred(res_dict, touser)
+
+        sender = threading.Thread(target=deliver)
+        sender.daemon = True
+        sender.start()
+
+    def send_deferred(self, res_dict, touser):
+        """
+        将超时的回调结果转换为主动消息并发送
+        @param res_dict: 回调函数返回的回复消息
+        @param touser: 接收者, 即收到的消息的发送者
+        @return: 服务器返回值dict, 无法转换时返回None
+        """
+        converted = reply_to_media(res_dict) if res_dict else None
+        if not converted:
+            self.logger.error('unable to deliver deferred reply to %s' % touser)
+            return None
+        self.logger.info('delivering deferred reply to %s' % touser)
+        return self.get_client().send_media(converted[0], converted[1], touser)
 
     def callback(self):
         """
-        响应对/weixin请求的函数
-        @return: 返回响应内容
+        响应对/weixin请求的Flask视图, 由handle完成实际处理
+        @return: GET请求返回回显字符串, POST请求返回加密后的回复
         """
         method = flask.request.method
         if method == 'GET':
             return self.verify()
         elif method == 'POST':
             return self.do_reply()
+        status, unused = self.handle(method, flask.request.args, flask.request.data)
+        flask.abort(status)
+
+    def verify(self):
+        """
+        在Flask请求上下文中验证接口可用性
+        @return: 回显字符串, 验证失败时返回403
+        """
+        status, body = self.handle('GET', flask.request.args, flask.request.data)
+        if status != 200:
+            flask.abort(status)
+        return body
+
+    def do_reply(self):
+        """
+        在Flask请求上下文中根据消息类型调用对应的回调函数进行回复
+        @return: 回复的消息, 按照微信接口加密, 处理失败时返回对应的错误码
+        """
+        status, body = self.handle('POST', flask.request.args, flask.request.data)
+        if status != 200:
+            flask.abort(status)
+        return flask.Response(body, mimetype='text/xml')
+
+    def handle(self, method, args, data):
+        """
+        与Web框架无关的请求处理入口, Flask视图与WSGI应用共用
+        @param method: HTTP方法
+        @param args: 查询参数, 支持get方法的dict类对象
+        @param data: 请求体
+        @return: (HTTP状态码, 响应内容)
+        """
+        start = time.time()
+        if method == 'GET':
+            status, body = self.verify_request(args)
+        elif method == 'POST':
+            if self.profiler is None:
+                status, body = self.reply_request(args, data)
+            else:
+                status, body = self.profiler.call(self.reply_request, args, data)
         else:
             self.logger.error('unsupported method, return 405 method not allowed')
-            # unknown method, return 405 method not allowed
-            flask.abort(405)
+            status, body = 405, ''
+        # 其他方法的名称由客户端决定, 统一记为other以免产生无限多的时间序列
+        self.metrics.histogram('wechat_server_request_seconds', 'Total time of callback requests',
+                               method=method if method in ('GET', 'POST') else 'other',
+                               status=status).observe(time.time() - start)
+        return status, body
 
-    def verify(self):
+    def collect_metrics(self):
+        """
+        将执行器, 重放防护与回复缓存的计数转换为指标
+        @return: (指标名, 类型, 说明, [(标签dict, 数值)])列表
+        """
+        executor_stats = self.executor_stats()
+        res = [
+            ('wechat_executor_%s' % name, metric_type, description,
+             [({'msg_type': msg_type}, stats[key]) for msg_type, stats in executor_stats.items()])
+            for name, key, metric_type, description in (
+                ('pending', 'pending', 'gauge', 'Callbacks queued or running'),
+                ('completed_total', 'completed', 'counter', 'Callbacks completed'),
+                ('failed_total', 'failed', 'counter', 'Callbacks that raised an exception'),
+                ('rejected_total', 'rejected', 'counter', 'Callbacks rejected by a full queue'))]
+        replay_stats = self.replay_guard.stats()
+        res.append(('wechat_replay_rejections_total', 'counter', 'Requests rejected by reason',
+                    [({'reason': reason}, value) for reason, value in replay_stats.items()
+                     if reason not in ('retries', 'tracked')]))
+        res.append(('wechat_replay_retries_total', 'counter',
+                    'Retries answered from the reply cache without decryption',
+                    [({}, replay_stats['retries'])]))
+        if self.reply_cache:
+            res.append(('wechat_reply_cache_total', 'counter', 'Reply cache lookups by result',
+                        [({'result': result}, value)
+                         for result, value in self.reply_cache.stats().items()]))
+        return res
+
+    def render_metrics(self):
+        """
+        输出Prometheus文本格式的指标, 每个工作进程只包含自身的数据
+        @return: 字符串
+        """
+        return self.metrics.render([self.collect_metrics])
+
+    def metrics_view(self):
+        """
+        指标接口的Flask视图
+        @return: Response对象
+        """
+        return flask.Response(self.render_metrics(), content_type=metrics.CONTENT_TYPE)
+
+    def verify_request(self, args):
         """
         验证接口可用性
-        @return: 回显字符串
+        @param args: 查询参数
+        @return: (HTTP状态码, 回显字符串)
         """
-        verify_msg_sig = flask.request.args.get('msg_signature', '')
-        timestamp = flask.request.args.get('timestamp', '')
-        nonce = flask.request.args.get('nonce', '')
-        echo_str = flask.request.args.get('echostr', '')
+        verify_msg_sig = args.get('msg_signature', '')
+        timestamp = args.get('timestamp', '')
+        nonce = args.get('nonce', '')
+        echo_str = args.get('echostr', '')
+        reason, unused = self.replay_guard.admit(verify_msg_sig, timestamp, nonce, track=False)
+        if reason:
+            self.logger.error('verification rejected: %s' % reason)
+            return 403, ''
         # do decoding and return
-        ret, echo_str_res = self.wxcpt.VerifyURL(verify_msg_sig, timestamp, nonce, echo_str)
+        with self.stage_histograms['verify'].time():
+            ret, echo_str_res = self.wxcpt.VerifyURL(verify_msg_sig, timestamp, nonce, echo_str)
         if ret != 0:
             self.logger.error('verification failed with return value %d' % ret)
             # if verification failed, return 403 forbidden
-            flask.abort(403)
-        else:
-            return echo_str_res
+            return 403, ''
+        return 200, echo_str_res
 
-    def do_reply(self):
+    def reply_request(self, args, req_data):
         """
-        根据消息类型调用对应的回调函数进行回复
-        @return: 回复的消息, 按照微信接口加密
+        解密收到的消息, 调用对应的回调函数并加密回复
+        @param args: 查询参数
+        @param req_data: 请求体
+        @return: (HTTP状态码, 加密后的回复)
         """
-        req_msg_sig = flask.request.args.get('msg_signature', '')
-        timestamp = flask.request.args.get('timestamp', '')
-        nonce = flask.request.args.get('nonce', '')
-        req_data = flask.request.data
-        ret, xml_str = self.wxcpt.DecryptMsg(req_data, req_msg_sig, timestamp, nonce)
+        req_msg_sig = args.get('msg_signature', '')
+        timestamp = args.get('timestamp', '')
+        nonce = args.get('nonce', '')
+        reason, cache_key = self.replay_guard.admit(req_msg_sig, timestamp, nonce)
+        if reason:
+            self.logger.error('request rejected before decryption: %s' % reason)
+            return (400 if reason == replay.MALFORMED else 403), ''
+        if cache_key and self.reply_cache:
+            # 已处理过的请求的重试, 无需解密即可由回复缓存应答
+            status, encrypted_data = self.reply_cache.begin(cache_key)
+            if status == reply_cache.CACHED:
+                return 200, encrypted_data
+            if status == reply_cache.IN_FLIGHT:
+                return 200, ''
+            # 上一次处理失败, 放弃认领后重新处理
+            self.reply_cache.abort(cache_key)
+        with self.stage_histograms['decrypt'].time():
+            ret, xml_str = self.wxcpt.DecryptMsg(req_data, req_msg_sig, timestamp, nonce)
+        if ret == ierror.WXBizMsgCrypt_ValidateSignature_Error:
+            self.replay_guard.reject(replay.SIGNATURE)
+        elif ret != 0:
+            self.replay_guard.reject(replay.INVALID)
         if ret == 0:
-            param_dict = utils.xml_to_dict(xml_str)
-            msg_type = param_dict.get("MsgType", '')
-            if msg_type in self.callback_funcs:
-                callback_func = self.callback_funcs[msg_type]
-                if callback_func:
-                    # call the callback function and get return message (dict)
-                    res_dict = callback_func(copy.deepcopy(param_dict))
-                    default_params = {
-                        'MsgType': param_dict['MsgType'],
-                        'CreateTime': int(time.time())
-                    }
-                    for key, val in default_params.items():
-                        if not res_dict.get(key, None):
-                            res_dict[key] = val
-                    res_dict['ToUserName'] = param_dict['FromUserName']
-                    res_dict['FromUserName'] = param_dict['ToUserName']
-                    xml_data = utils.dict_to_xml(res_dict)
-                    ret_val, encrypted_data = \
-                        self.wxcpt.EncryptMsg(xml_data, nonce, timestamp)
-                    if ret_val == 0:
-                        self.logger.info('replied a message to %s' %
-                                         res_dict.get('ToUserName', 'null'))
-                        return flask.Response(encrypted_data, mimetype='text/xml')
+            param_dict = message.InboundMessage(xml_str)
+            with self.stage_histograms['parse'].time():
+                param_dict.parse()
+            cache_key = self.reply_cache.make_key(param_dict) if self.reply_cache else None
+            self.replay_guard.remember(req_msg_sig, timestamp, nonce, cache_key)
+            if cache_key:
+                status, encrypted_data = self.reply_cache.begin(cache_key)
+                if status == reply_cache.CACHED:
+                    # 微信服务器重试的消息, 直接返回之前的回复
+                    return 200, encrypted_data
+                if status == reply_cache.IN_FLIGHT:
+                    # 上一次请求仍在处理, 返回空串避免重复调用回调函数
+                    self.logger.info('message %s is still being processed' % cache_key)
+                    return 200, ''
+            encrypted_data = None
+            try:
+                encrypted_data = self.make_reply(param_dict, nonce, timestamp)
+            except executor.QueueFull as e:
+                # 执行器已满, 返回503, 微信服务器稍后会重试
+                self.logger.warning('callback rejected: %s' % e)
+                return 503, ''
+            finally:
+                if cache_key and encrypted_data is not None:
+                    self.reply_cache.finish(cache_key, encrypted_data)
+                elif cache_key:
+                    self.reply_cache.abort(cache_key)
+            if encrypted_data is not None:
+                return 200, encrypted_data
         # 如果没有正确走完这个流程, 就记录日志返回错误
         self.logger.error('request failed with request data: %r' % req_data)
         # if decryption failed or all other reasons, return 400 bad request code
-        flask.abort(400)
+        return 400, ''
+
+    def wsgi_app(self, environ, start_response):
+        """
+        不依赖Flask的WSGI应用, 可以直接运行在gevent.pywsgi, gunicorn或uwsgi等WSGI服务器上
+        @param environ: WSGI环境变量
+        @param start_response: WSGI回调函数
+        @return: 响应内容列表
+        """
+        path = environ.get('PATH_INFO', '')
+        content_type = 'text/xml'
+        if path == self.metrics_route and environ['REQUEST_METHOD'] == 'GET':
+            status, body, content_type = 200, self.render_metrics(), metrics.CONTENT_TYPE
+        elif path != self.route:
+            status, body = 404, ''
+        else:
+            args = dict((key, values[0]) for key, values
+                        in urlparse.parse_qs(environ.get('QUERY_STRING', '')).items())
+            data = ''
+            if environ['REQUEST_METHOD'] == 'POST':
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                data = environ['wsgi.input'].read(length) if length > 0 else ''
+            status, body = self.handle(environ['REQUEST_METHOD'], args, data)
+        start_response('%d %s' % (status, httplib.responses.get(status, '')),
+                       [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
 
-    def run(self, *args, **kwargs):
+    def make_reply(self, param_dict, nonce, timestamp):
+        """
+        调用回调函数并加密其返回的消息
+        @param param_dict: 收到的消息, InboundMessage对象
+        @param nonce: 随机串
+        @param timestamp: 时间戳
+        @return: 加密后的回复, 回复被推迟时为空串, 没有注册回调函数或加密失败时返回None
+        """
+        msg_type = param_dict.msg_type
+        callback_func = self.callback_funcs.get(msg_type)
+        if not callback_func:
+            return None
+        # call the callback function and get return message (dict)
+        # 回调函数收到普通的dict, 与以前的版本兼容; 顶层字段的修改不会影响收到的消息
+        reply = dict(param_dict.parse())
+        deadline = self.callback_deadlines.get(msg_type)
+        with self.callback_histograms[msg_type].time():
+            finished, res_dict = self.call_with_deadline(self.callback_executors[msg_type],
+                                                         callback_func, reply, deadline)
+        if not finished:
+            # 返回空串, 微信服务器不会重试, 回复随后主动发送
+            self.logger.info('callback for %s exceeded %.1fs deadline, reply deferred'
+                             % (param_dict['FromUserName'], deadline))
+            return ''
+        default_params = {
+            'MsgType': param_dict['MsgType'],
+            'CreateTime': int(time.time())
+        }
+        for key, val in default_params.items():
+            if not res_dict.get(key, None):
+                res_dict[key] = val
+        res_dict['ToUserName'] = param_dict['FromUserName']
+        res_dict['FromUserName'] = param_dict['ToUserName']
+        with self.stage_histograms['serialize'].time():
+            xml_data = utils.dict_to_xml(res_dict)
+        with self.stage_histograms['encrypt'].time():
+            ret_val, encrypted_data = self.wxcpt.EncryptMsg(xml_data, nonce, timestamp)
+        if ret_val != 0:
+            return None
+        with self.stage_histograms['log'].time():
+            self.logger.info('replied a message to %s' % res_dict.get('ToUserName', 'null'))
+        return encrypted_data
+
+    def run(self, host=None, port=None, mode=None, **kwargs):
         """
         启动server循环
-        @param args: 参数列表
-        @param kwargs: 参数字典
+        @param host: 监听地址
+        @param port: 监听端口
+        @param mode: 运行模式, 为None时使用配置中的server_mode
+                     flask为Flask自带的调试服务器, prefork, threaded与gevent见runner.Runner
+        @param kwargs: flask模式下传给Flask.run的其他参数
         @return: None
         """
-        self.app.run(*args, **kwargs)
+        mode = mode or utils.get_option(self.config, 'system', 'server_mode', 'flask')
+        if mode == 'flask':
+            self.app.run(host, port, **kwargs)
+            return
+        server_runner = runner.Runner(
+            self.wsgi_app, mode,
+            workers=utils.get_option(self.config, 'system', 'server_workers', 0),
+            concurrency=utils.get_option(self.config, 'system', 'server_concurrency', 0),
+            max_requests=utils.get_option(self.config, 'system', 'server_max_requests', 0),
+            graceful_timeout=utils.get_option(self.config, 'system', 'server_graceful_timeout', 30),
+            reuse_port=utils.get_option(self.config, 'system', 'server_reuse_port', True),
+            logger=self.logger)
+        server_runner.serve(host or '127.0.0.1', port or 5000)